@@ -2,9 +2,28 @@
 import sys
 import os
 import json
+import time
+import base64
+import copy
+import threading
+import math
+import random
+import re
+import subprocess
+import sqlite3
+import hashlib
+import socket
+import fcntl
+import shlex
+import tempfile
+import asyncio
+from contextlib import contextmanager, nullcontext
+from collections import deque
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlencode
 import argparse
-import boto3
+import urllib3
 
 # Simple logger class (Don't need logging library for basic logging)
 class Logger:
@@ -17,7 +36,532 @@ class Logger:
         if self.debug:
             print(msg)
 
+# Error from a cloud call, with the status the rate limiter uses to decide whether to retry it
+class CloudError(Exception):
+    # Statuses that are worth retrying (quota, server and timeout errors)
+    retryableStatuses = {429, 500, 502, 503, 504, "RESOURCE_EXHAUSTED", "UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED", "ABORTED"}
+    # Init Arg:
+    #   message [str] - error message
+    #   status [int or str] *opt - http status code or gcloud error status (default=None)
+    #   retryAfter [float] *opt - seconds the api asked us to wait before retrying (default=None)
+    def __init__(self, message, status=None, retryAfter=None):
+        super().__init__(f"{status}: {message}" if status else message)
+        self.status = status
+        self.retryAfter = retryAfter
+    # Check if the call hit a quota
+    @property
+    def throttled(self):
+        return self.status in (429, "RESOURCE_EXHAUSTED")
+    # Check if the call is worth retrying
+    @property
+    def retryable(self):
+        return self.status in self.retryableStatuses
+    # Check if the resource doesn't exist
+    @property
+    def notFound(self):
+        return self.status in (404, "NOT_FOUND")
+
+# Error from a GCP call (raised instead of returning None so failures can't look like empty results)
+class GCPError(CloudError):
+    # Build an error from gcloud's stderr (e.g. "ERROR: (gcloud.secrets.describe) NOT_FOUND: Secret [x] not found")
+    # Arg:
+    #   stderr [str] - gcloud error output
+    #   returnCode [int] - gcloud exit code
+    @classmethod
+    def from_gcloud(cls, stderr, returnCode):
+        message = stderr.strip().splitlines()[-1] if stderr.strip() else f"gcloud exited with {returnCode}"
+        match = re.search(r"\b([A-Z]+(?:_[A-Z]+)+|INTERNAL|UNAVAILABLE|ABORTED)\b|\[(\d{3})\]|\b(429|5\d\d)\b", stderr)
+        status = None
+        if match:
+            status = match.group(1) or int(match.group(2) or match.group(3))
+        elif "Quota exceeded" in stderr:
+            status = "RESOURCE_EXHAUSTED"
+        return cls(message, status)
+
+# Error from an SES send
+class SESError(CloudError):
+    # Build an error from an SES client error, mapping its code onto the statuses the rate limiter understands
+    # (429 for throttling, 503 for errors worth retrying)
+    # Arg:
+    #   error [obj] - exception raised by the SES client
+    @classmethod
+    def from_ses(cls, error):
+        code = getattr(error, "response", {}).get("Error", {}).get("Code")
+        message = str(error)
+        status = None
+        if code == "Throttling" or "Maximum sending rate exceeded" in message:
+            status = 429
+        elif code in ("ServiceUnavailable", "InternalFailure", "RequestTimeout"):
+            status = 503
+        return cls(message, status)
+
+# Class to limit the rate of calls to an api family with a token bucket
+# The rate adapts to the quota responses: it is halved when a call is throttled and creeps back up while calls succeed
+# Calls are retried with exponential backoff and full jitter when they fail with a retryable error
+# The same instance is shared by every thread (and both backends) calling the api family
+class RateLimiter:
+    attempts = 5
+    baseDelay = 0.5
+    maxDelay = 30
+    # Init Arg:
+    #   family [str] - api family (e.g. secrets.read)
+    #   rate [float] - starting calls per second
+    #   minRate [float] *opt - lowest calls per second after throttling (default=rate/20)
+    #   maxRate [float] *opt - highest calls per second while calls succeed (default=rate*10)
+    def __init__(self, family, rate, minRate=None, maxRate=None):
+        self.family = family
+        self.lock = threading.Lock()
+        self.configure(rate, minRate, maxRate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+        self.calls = 0
+        self.retries = 0
+        self.throttles = 0
+        self.failures = 0
+        self.waitSeconds = 0
+    # Set the starting rate (and the range it can adapt in)
+    def configure(self, rate, minRate=None, maxRate=None):
+        with self.lock:
+            self.rate = rate
+            self.minRate = minRate or rate / 20
+            self.maxRate = maxRate or rate * 10
+            self.burst = max(1, rate)
+    # Wait for a token (tokens can be reserved ahead, so waiting threads are served in order)
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.pausedUntil - now, 0)
+            self.calls += 1
+            self.waitSeconds += wait
+        if wait:
+            time.sleep(wait)
+    # Speed up a little after a successful call (about +1 call per second, each second)
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + 1 / self.rate)
+            self.burst = max(1, self.rate)
+    # Slow down after a call hits a quota
+    # Arg:
+    #   retryAfter [float] *opt - seconds the api asked us to wait (default=None)
+    def throttled(self, retryAfter=None):
+        with self.lock:
+            self.throttles += 1
+            self.rate = max(self.minRate, self.rate / 2)
+            self.burst = max(1, self.rate)
+            self.tokens = min(self.tokens, 0)
+            if retryAfter:
+                self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+    # Get how long to wait before a retry (full jitter)
+    # Arg:
+    #   attempt [int] - number of attempts so far
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+    # Make a call at the limited rate, retrying retryable errors
+    # Arg:
+    #   func [function] - call to make (raises a CloudError, e.g. GCPError, when it fails)
+    # Returns:
+    #   result of the call
+    def call(self, func):
+        for attempt in range(self.attempts):
+            self.acquire()
+            try:
+                result = func()
+            except CloudError as e:
+                if e.throttled:
+                    self.throttled(e.retryAfter)
+                if not e.retryable or attempt == self.attempts - 1:
+                    with self.lock:
+                        self.failures += 1
+                    raise
+                with self.lock:
+                    self.retries += 1
+                time.sleep(self.backoff(attempt))
+                continue
+            self.succeeded()
+            return result
+    # Returns:
+    #   state [dict] - current rate and counters
+    def state(self):
+        with self.lock:
+            return {"rate": round(self.rate, 3), "calls": self.calls, "retries": self.retries, "throttles": self.throttles,
+                    "failures": self.failures, "waitSeconds": round(self.waitSeconds, 6)}
+
+# Rate limiters for each api family, shared by the whole run
+# The starting rates are per project quotas (calls per second) and can be changed with set_rate_limits
+LIMITERS = {
+    "secrets.read": RateLimiter("secrets.read", 10),
+    "secrets.write": RateLimiter("secrets.write", 10),
+    "api-keys": RateLimiter("api-keys", 5),
+    # SES's default sending quota is 14 emails per second
+    "ses.send": RateLimiter("ses.send", 14),
+    # Pub/Sub pulls and acks for the secret change events (see secret_events.py)
+    "pubsub": RateLimiter("pubsub", 10),
+}
+
+# Change the starting rates of the rate limiters
+# Arg:
+#   rates [dict] - api family -> calls per second
+def set_rate_limits(rates):
+    for family, rate in rates.items():
+        LIMITERS[family].configure(rate)
+
+# Class to count and time backend calls and rotation phases
+# One instance (METRICS) is shared by the whole run and exported at the end as JSON or a Prometheus textfile
+class Metrics:
+    quantiles = (0.5, 0.95, 0.99)
+    # Init Arg:
+    #   limiters [dict] *opt - api family -> rate limiter to report on (default=None)
+    def __init__(self, limiters=None):
+        self.lock = threading.Lock()
+        self.limiters = limiters or {}
+        # name -> rate limiter state merged from other processes
+        self.mergedLimits = {}
+        self.startTime = time.monotonic()
+        # operation -> call count / error count / latencies (seconds)
+        self.calls = {}
+        self.errors = {}
+        self.latencies = {}
+        # phase -> durations (seconds)
+        self.phases = {}
+        # secretName -> {phase: seconds}
+        self.secrets = {}
+    # Clear everything recorded so far (e.g. between invocations of a long-lived process)
+    def reset(self):
+        with self.lock:
+            self.mergedLimits = {}
+            self.startTime = time.monotonic()
+            self.calls = {}
+            self.errors = {}
+            self.latencies = {}
+            self.phases = {}
+            self.secrets = {}
+    # Record a call
+    # Arg:
+    #   operation [str] - operation label (e.g. secrets.describe)
+    #   seconds [float] - how long the call took
+    #   error [bool] *opt - set to True if the call failed (default=False)
+    def record(self, operation, seconds, error=False):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.latencies.setdefault(operation, []).append(seconds)
+            if error:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+    # Record time spent in a phase
+    # Arg:
+    #   phase [str] - phase label (e.g. rotate key)
+    #   seconds [float] - how long the phase took
+    #   secretName [str] *opt - secret the phase was for (default=None)
+    def record_phase(self, phase, seconds, secretName=None):
+        with self.lock:
+            self.phases.setdefault(phase, []).append(seconds)
+            if secretName:
+                spans = self.secrets.setdefault(secretName, {})
+                spans[phase] = spans.get(phase, 0) + seconds
+    # Time a call (e.g. with METRICS.timer("ses.send"): ...)
+    # Arg:
+    #   operation [str] - operation label
+    @contextmanager
+    def timer(self, operation):
+        start = time.monotonic()
+        try:
+            yield
+        except:
+            self.record(operation, time.monotonic() - start, error=True)
+            raise
+        self.record(operation, time.monotonic() - start)
+    # Time a phase (e.g. with METRICS.span("rotate key", secretName): ...)
+    # Arg:
+    #   phase [str] - phase label
+    #   secretName [str] *opt - secret the phase is for (default=None)
+    @contextmanager
+    def span(self, phase, secretName=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.monotonic() - start, secretName)
+    # Yield from an iterable, counting only the time spent waiting for items
+    # Arg:
+    #   iterable [iterable] - items to yield (e.g. a streamed listing)
+    #   operation [str] *opt - operation label to record the wait under (default=None)
+    #   phase [str] *opt - phase label to record the wait under (default=None)
+    def timed_iter(self, iterable, operation=None, phase=None):
+        iterator = iter(iterable)
+        waited = 0
+        error = False
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    waited += time.monotonic() - start
+                    return
+                except:
+                    waited += time.monotonic() - start
+                    error = True
+                    raise
+                waited += time.monotonic() - start
+                yield item
+        finally:
+            if operation:
+                self.record(operation, waited, error)
+            if phase:
+                self.record_phase(phase, waited)
+    # Get the raw metrics (e.g. to send from a worker process back to be merged)
+    # Returns:
+    #   snapshot [dict] - calls, errors, latencies, phases, per-secret spans and rate limiter state
+    def snapshot(self):
+        rateLimits = {family: limiter.state() for family, limiter in self.limiters.items()}
+        with self.lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors), "latencies": {op: list(samples) for op, samples in self.latencies.items()},
+                    "phases": {phase: list(samples) for phase, samples in self.phases.items()},
+                    "secrets": {secretName: dict(spans) for secretName, spans in self.secrets.items()}, "rateLimits": rateLimits}
+    # Add the metrics from another process
+    # Arg:
+    #   snapshot [dict] - metrics from snapshot
+    #   prefix [str] *opt - added to secret names and rate limiter families so they stay apart (e.g. project id) (default=None)
+    def merge(self, snapshot, prefix=None):
+        name = lambda value: f"{prefix}/{value}" if prefix else value
+        with self.lock:
+            for operation, count in snapshot["calls"].items():
+                self.calls[operation] = self.calls.get(operation, 0) + count
+                self.latencies.setdefault(operation, []).extend(snapshot["latencies"][operation])
+            for operation, count in snapshot["errors"].items():
+                self.errors[operation] = self.errors.get(operation, 0) + count
+            for phase, samples in snapshot["phases"].items():
+                self.phases.setdefault(phase, []).extend(samples)
+            for secretName, spans in snapshot["secrets"].items():
+                self.secrets[name(secretName)] = spans
+            for family, state in snapshot["rateLimits"].items():
+                self.mergedLimits[name(family)] = state
+    # Get a quantile from a list of samples (nearest rank)
+    @staticmethod
+    def quantile(samples, q):
+        samples = sorted(samples)
+        return samples[min(len(samples) - 1, max(0, math.ceil(q * len(samples)) - 1))] if samples else 0
+    # Summarise a list of durations
+    def describe(self, samples):
+        summary = {f"p{int(q * 100)}": round(self.quantile(samples, q), 6) for q in self.quantiles}
+        summary.update({"count": len(samples), "sum": round(sum(samples), 6), "max": round(max(samples, default=0), 6)})
+        return summary
+    # Returns:
+    #   summary [dict] - calls, errors and latency quantiles per operation, phase totals, per-secret spans and rate limiter state
+    def summary(self):
+        rateLimits = {family: limiter.state() for family, limiter in self.limiters.items()}
+        with self.lock:
+            rateLimits = dict(sorted(dict(rateLimits, **self.mergedLimits).items()))
+            return {
+                "durationSeconds": round(time.monotonic() - self.startTime, 6),
+                "operations": {operation: dict(self.describe(self.latencies[operation]), errors=self.errors.get(operation, 0)) for operation in sorted(self.calls)},
+                "phases": {phase: self.describe(samples) for phase, samples in sorted(self.phases.items())},
+                "secrets": {secretName: {phase: round(seconds, 6) for phase, seconds in spans.items()} for secretName, spans in sorted(self.secrets.items())},
+                "rateLimits": rateLimits,
+            }
+    # Write a file atomically (so a textfile collector never reads a partial file)
+    @staticmethod
+    def write_atomic(fileName, text):
+        tmpName = f"{fileName}.tmp"
+        with open(tmpName, "w") as file:
+            file.write(text)
+        os.replace(tmpName, fileName)
+    # Write the summary as JSON
+    # Arg:
+    #   fileName [str] - output file name
+    def export_json(self, fileName):
+        self.write_atomic(fileName, json.dumps(self.summary(), indent=2))
+    # Write the metrics in the Prometheus textfile format
+    # Per-secret spans are left out to keep the number of series small
+    # Arg:
+    #   fileName [str] - output file name
+    def export_prometheus(self, fileName):
+        summary = self.summary()
+        lines = [
+            "# HELP credman_run_duration_seconds Duration of the run.",
+            "# TYPE credman_run_duration_seconds gauge",
+            f"credman_run_duration_seconds {summary['durationSeconds']}",
+            "# HELP credman_backend_calls_total Backend calls by operation.",
+            "# TYPE credman_backend_calls_total counter",
+        ]
+        lines += [f'credman_backend_calls_total{{operation="{op}"}} {stats["count"]}' for op, stats in summary["operations"].items()]
+        lines += ["# HELP credman_backend_errors_total Failed backend calls by operation.", "# TYPE credman_backend_errors_total counter"]
+        lines += [f'credman_backend_errors_total{{operation="{op}"}} {stats["errors"]}' for op, stats in summary["operations"].items()]
+        for name, label, groups in [("credman_backend_latency_seconds", "operation", summary["operations"]), ("credman_phase_seconds", "phase", summary["phases"])]:
+            lines += [f"# HELP {name} Latency by {label}.", f"# TYPE {name} summary"]
+            for value, stats in groups.items():
+                lines += [f'{name}{{{label}="{value}",quantile="{q}"}} {stats[f"p{int(q * 100)}"]}' for q in self.quantiles]
+                lines += [f'{name}_sum{{{label}="{value}"}} {stats["sum"]}', f'{name}_count{{{label}="{value}"}} {stats["count"]}']
+        for field, name, kind, help in [("rate", "credman_rate_limit_per_second", "gauge", "Current calls per second allowed"),
+                                        ("retries", "credman_rate_limit_retries_total", "counter", "Retried calls"),
+                                        ("throttles", "credman_rate_limit_throttles_total", "counter", "Calls that hit a quota"),
+                                        ("failures", "credman_rate_limit_failures_total", "counter", "Calls that still failed after retrying"),
+                                        ("waitSeconds", "credman_rate_limit_wait_seconds_total", "counter", "Seconds spent waiting for the rate limit")]:
+            lines += [f"# HELP {name} {help} by api family.", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{family="{family}"}} {state[field]}' for family, state in summary["rateLimits"].items()]
+        self.write_atomic(fileName, "\n".join(lines) + "\n")
+
+# Metrics for the current run
+METRICS = Metrics(LIMITERS)
+
+# Yield the items of a JSON array as they are read from a stream
+# Only the unread part of the stream is buffered, so memory doesn't grow with the size of the array
+# Arg:
+#   stream [obj] - file-like object with a JSON array of objects
+#   chunkSize [int] *opt - number of characters to read at a time (default=65536)
+def iter_json_array(stream, chunkSize=65536):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    while True:
+        # Skip the separators between items
+        while pos < len(buffer) and buffer[pos] in " \t\r\n[,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        if pos < len(buffer):
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+                yield item
+                continue
+            # The item hasn't been fully read yet
+            except json.JSONDecodeError:
+                if eof:
+                    return
+        elif eof:
+            return
+        chunk = stream.read(chunkSize)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+# Run a call for each item on a thread pool, handing back the results in the same order as the items
+# Unlike executor.map, which submits every item before it hands back the first result, at most window calls are in
+# flight at once and the next item is only taken once the oldest call has been handed back, so a paging generator is
+# read as the results are used (and memory stays bounded by the window and the page size)
+# Arg:
+#   executor [obj] - thread pool to run the calls on
+#   func [function] - call to make for each item
+#   items [iterable] - items to call func with
+#   window [int] - max number of calls submitted but not yet handed back (e.g. 2*maxWorkers)
+# Returns:
+#   generator of results (in item order)
+def bounded_map(executor, func, items, window):
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+# Class to run gcloud processes without a shell
+# Commands are argument vectors, so names, filters and payloads are never parsed by a shell, and payloads are
+# passed on stdin. The processes are started with asyncio on a loop in a background thread, and up to maxProcesses
+# of them run at once, however many threads are calling (streamed listings hold a slot for as long as they run).
+# Every process shares one gcloud config directory
+# (CLOUDSDK_CONFIG, or gcloud's default) whose access token is refreshed once up front (and again before it
+# expires), so the processes don't each refresh it.
+class GcloudExecutor:
+    tokenLifetime = timedelta(minutes=50)
+    # Settings for every gcloud process (no prompts, and no check for component updates on each start)
+    settings = {"CLOUDSDK_CORE_DISABLE_PROMPTS": "1", "CLOUDSDK_COMPONENT_MANAGER_DISABLE_UPDATE_CHECK": "true"}
+    # Init Arg:
+    #   maxProcesses [int] *opt - max number of gcloud processes running at once (default=8)
+    def __init__(self, maxProcesses=8):
+        self.maxProcesses = maxProcesses
+        self.loop = None
+        self.slots = None
+        self.lock = threading.Lock()
+        self.warmUntil = None
+        # Threads holding a slot for a streamed listing (thread id -> number of listings open)
+        self.streams = {}
+        self.streamLock = threading.Lock()
+    # Get the environment for a gcloud process
+    # Returns:
+    #   env [dict] - environment variables
+    def environment(self):
+        return dict(os.environ, **self.settings)
+    # Start the event loop the processes are run on (the first time it is needed)
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.slots = asyncio.Semaphore(self.maxProcesses)
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+    # Run a gcloud process once a slot is free
+    # Arg:
+    #   args [list of str] - command and arguments
+    #   stdin [str] *opt - input for the process (default=None)
+    #   shared [bool] *opt - set to True if the caller already holds a slot (default=False)
+    # Returns:
+    #   output [str] - standard output (raises GCPError if the process failed)
+    async def run_async(self, args, stdin=None, shared=False):
+        async with (nullcontext() if shared else self.slots):
+            try:
+                process = await asyncio.create_subprocess_exec(*args, stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                                                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.environment())
+            except FileNotFoundError:
+                raise GCPError(f"{args[0]} was not found (check that it is installed and on the PATH)")
+            stdout, stderr = await process.communicate(stdin.encode() if stdin is not None else None)
+        if process.returncode:
+            raise GCPError.from_gcloud(stderr.decode(), process.returncode)
+        return stdout.decode()
+    # Run a gcloud process and wait for it (safe to call from any thread)
+    # (see run_async for args/returns)
+    def run(self, args, stdin=None):
+        if self.loop is None:
+            self.start()
+        shared = threading.get_ident() in self.streams
+        return asyncio.run_coroutine_threadsafe(self.run_async(args, stdin, shared), self.loop).result()
+    # Hold a slot for a process started outside run (a streamed listing) until it has exited
+    # The thread reading the listing often makes other gcloud calls (or opens another listing) before it has
+    # finished, so those calls share its slot rather than wait for one that it may be holding itself
+    @contextmanager
+    def slot(self):
+        if self.loop is None:
+            self.start()
+        thread = threading.get_ident()
+        with self.streamLock:
+            shared = thread in self.streams
+        if not shared:
+            asyncio.run_coroutine_threadsafe(self.slots.acquire(), self.loop).result()
+        with self.streamLock:
+            self.streams[thread] = self.streams.get(thread, 0) + 1
+        try:
+            yield
+        finally:
+            with self.streamLock:
+                self.streams[thread] -= 1
+                if not self.streams[thread]:
+                    del self.streams[thread]
+            if not shared:
+                self.loop.call_soon_threadsafe(self.slots.release)
+    # Refresh the shared access token if it is about to expire (other calls wait until it has been refreshed)
+    # Arg:
+    #   force [bool] *opt - set to True to refresh it now, e.g. after activating an account (default=False)
+    def warm(self, force=False):
+        self.start()
+        with self.lock:
+            if not force and self.warmUntil and datetime.now(timezone.utc) < self.warmUntil:
+                return
+            self.warmUntil = datetime.now(timezone.utc) + self.tokenLifetime
+            # A failure here shows up again (with its error) on the call that needed the token
+            try:
+                self.run(["gcloud", "auth", "print-access-token"])
+            except GCPError:
+                self.warmUntil = None
+
+# gcloud process runner shared by the whole run (GCLOUD_MAX_PROCESSES sets how many processes can run at once)
+GCLOUD = GcloudExecutor(int(os.environ.get("GCLOUD_MAX_PROCESSES", 8)))
+
 # Class to execute gcloud commands
+# Backends expose the same operations (list_secrets, describe_secret, list_versions, ...) so that
+# SecretManager and KeyManager can run on either the gcloud CLI (GCP) or the REST APIs (GCPRest)
 class GCP:
     # Init Arg:
     #   projectId [str] - name of GCP project
@@ -25,34 +569,1071 @@ class GCP:
     def __init__(self, projectId, debug=False):
         self.projectId = projectId
         self.debugger = Logger(debug)
-    # Execute gcloud command in format f"gcloud {command} --format='{format}' --project={self.projectId}"
+    # Execute gcloud command as ["gcloud", *args, f"--format={format}", f"--project={self.projectId}"]
     # Arg:
-    #   command [str] - command for gcloud
+    #   args [list of str] - command and flags for gcloud
     #   format [bool] *opt - output format for gcloud response (default=json)
+    #   stdin [str] *opt - input for gcloud, e.g. a secret payload (default=None)
     # Returns:
     #   gcloud api response
-    def exec(self, command, format="json"):
+    def exec(self, args, format="json", stdin=None):
         # Set up the gcloud command
-        cmd = f"gcloud {command} --format='{format}' --project={self.projectId}"
-        self.debugger.print(cmd)
+        cmd = ["gcloud", *args, f"--format={format}", f"--project={self.projectId}"]
+        return self.custom_exec(cmd, stdin)
+    # Execute custom gcloud command
+    # Arg:
+    #   command [list of str] - custom command to be executed
+    #   stdin [str] *opt - input for gcloud (default=None)
+    # Returns:
+    #   gcloud api response (None if gcloud printed nothing)
+    def custom_exec(self, command, stdin=None):
+        # Never print the input (it can be a key string)
+        self.debugger.print(shlex.join(command))
+        response = LIMITERS[self.api_family(command)].call(lambda: self.run(command, stdin))
+        if not response.strip():
+            return None
         try:
-            # Try to execute the command
-            response = os.popen(cmd).read()
             return json.loads(response)
-        except:
+        except ValueError:
+            raise GCPError(f"Unexpected gcloud output: {response[:200]}")
+    # Run a gcloud command once
+    # Arg:
+    #   command [list of str] - command to run
+    #   stdin [str] *opt - input for gcloud (default=None)
+    # Returns:
+    #   output [str] - gcloud output (raises GCPError if gcloud failed)
+    def run(self, command, stdin=None):
+        GCLOUD.warm()
+        return GCLOUD.run(command, stdin)
+    # Get the api family of a gcloud command (for rate limiting)
+    # Arg:
+    #   command [list of str] - gcloud command
+    # Returns:
+    #   family [str] - key in LIMITERS
+    @staticmethod
+    def api_family(command):
+        command = " ".join(command)
+        if "gcloud pubsub " in command:
+            return "pubsub"
+        if "services api-keys" in command or "services operations" in command:
+            return "api-keys"
+        if re.search(r"secrets (versions )?(list|describe)\b", command):
+            return "secrets.read"
+        return "secrets.write"
+    # Get secrets in the project
+    # Arg:
+    #   limit [int] *opt - limit on how many secrets are returned (default=None)
+    #   createdAfter [str] *opt - only return secrets created after this RFC 3339 time (default=None)
+    # Returns:
+    #   list of secrets (newest first)
+    def list_secrets(self, limit=None, createdAfter=None):
+        cmd = ["secrets", "list", "--sort-by=~createTime"]
+        if limit:
+            cmd.append(f"--limit={limit}")
+        if createdAfter:
+            cmd.append(f'--filter=createTime>"{createdAfter}"')
+        return self.exec(cmd)
+    # Execute gcloud list command and yield items as gcloud prints them
+    # The listing streams for as long as the caller reads, and holds one of GCLOUD's slots until gcloud has exited
+    # Arg:
+    #   command [list of str] - list command and flags for gcloud (without sorting, which makes gcloud wait for every page)
+    # Returns:
+    #   generator of listed items
+    def exec_iter(self, command):
+        cmd = ["gcloud", *command, "--format=json", f"--project={self.projectId}"]
+        self.debugger.print(shlex.join(cmd))
+        GCLOUD.warm()
+        # Start the listing (it is only retried if it fails before the first item arrives)
+        # stderr goes to a temporary file that is only read if gcloud fails, so gcloud never blocks on a full pipe
+        def start():
+            errors = tempfile.TemporaryFile("w+")
+            try:
+                process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=errors, text=True, env=GCLOUD.environment())
+            except FileNotFoundError:
+                errors.close()
+                raise GCPError(f"{cmd[0]} was not found (check that it is installed and on the PATH)")
+            items = iter_json_array(process.stdout)
+            first = next(items, None)
+            if first is None:
+                self.finish(process, errors)
+            return process, errors, items, first
+        with GCLOUD.slot():
+            process, errors, items, first = LIMITERS[self.api_family(cmd)].call(start)
+            try:
+                if first is None:
+                    return
+                yield first
+                yield from items
+                self.finish(process, errors)
+            finally:
+                # Stop gcloud if the caller stopped reading early
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+                errors.close()
+    # Wait for a streamed gcloud command to exit
+    # Arg:
+    #   process [obj] - gcloud process (raises GCPError if gcloud failed)
+    #   errors [file] - file gcloud's stderr was written to
+    @staticmethod
+    def finish(process, errors):
+        returnCode = process.wait()
+        process.stdout.close()
+        if returnCode:
+            errors.seek(0)
+            stderr = errors.read()
+            errors.close()
+            raise GCPError.from_gcloud(stderr, returnCode)
+        errors.close()
+    # Get secrets in the project page by page
+    # Arg:
+    #   pageSize [int] *opt - number of secrets fetched per page (default=None)
+    #   createdAfter [str] *opt - only return secrets created after this RFC 3339 time (default=None)
+    # Returns:
+    #   generator of secrets (in api order)
+    def iter_secrets(self, pageSize=None, createdAfter=None):
+        cmd = ["secrets", "list"]
+        if pageSize:
+            cmd.append(f"--page-size={pageSize}")
+        if createdAfter:
+            cmd.append(f'--filter=createTime>"{createdAfter}"')
+        return self.exec_iter(cmd)
+    # Get details for a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    # Returns:
+    #   secret details
+    def describe_secret(self, secretName):
+        return self.exec(["secrets", "describe", secretName])
+    # Get versions for a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    #   limit [int] *opt - limit on how many versions are returned (default=None)
+    #   enabled [bool] *opt - only return enabled versions (default=False)
+    # Returns:
+    #   list of versions (newest first)
+    def list_versions(self, secretName, limit=None, enabled=False):
+        cmd = ["secrets", "versions", "list", secretName, "--sort-by=~createTime"]
+        if limit:
+            cmd.append(f"--limit={limit}")
+        if enabled:
+            cmd.append("--filter=state:ENABLED")
+        return self.exec(cmd)
+    # Get versions for a secret page by page
+    # Arg:
+    #   secretName [str] - name of secret
+    #   pageSize [int] *opt - number of versions fetched per page (default=None)
+    #   enabled [bool] *opt - only return enabled versions (default=False)
+    # Returns:
+    #   generator of versions (newest first, which is the api order)
+    def iter_versions(self, secretName, pageSize=None, enabled=False):
+        cmd = ["secrets", "versions", "list", secretName]
+        if pageSize:
+            cmd.append(f"--page-size={pageSize}")
+        if enabled:
+            cmd.append("--filter=state:ENABLED")
+        return self.exec_iter(cmd)
+    # Enable a secret version
+    # Arg:
+    #   secretName [str] - name of secret
+    #   version [int] - secret version
+    def enable_version(self, secretName, version):
+        return self.exec(["secrets", "versions", "enable", str(version), f"--secret={secretName}"])
+    # Disable a secret version
+    # Arg:
+    #   secretName [str] - name of secret
+    #   version [int] - secret version
+    def disable_version(self, secretName, version):
+        return self.exec(["secrets", "versions", "disable", str(version), f"--secret={secretName}"])
+    # Destroy a secret version (its payload can't be recovered)
+    # Arg:
+    #   secretName [str] - name of secret
+    #   version [int] - secret version
+    def destroy_version(self, secretName, version):
+        return self.exec(["secrets", "versions", "destroy", str(version), f"--secret={secretName}", "--quiet"])
+    # Set the annotations of a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    #   annotations [dict] - full set of annotations for the secret
+    def update_annotations(self, secretName, annotations):
+        annotationStr = ",".join([key+"="+value for key, value in annotations.items()])
+        return self.exec(["secrets", "update", secretName, f"--update-annotations={annotationStr}"])
+    # Remove annotations from a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    #   annotations [dict] - current annotations of the secret (gcloud only needs the names)
+    #   names [list of str] - annotations to remove
+    #   etag [str] *opt - etag the secret must still have, so a change made since it was read isn't lost (default=None)
+    def remove_annotations(self, secretName, annotations, names, etag=None):
+        cmd = ["secrets", "update", secretName, f"--remove-annotations={','.join(names)}"]
+        if etag:
+            cmd.append(f"--etag={etag}")
+        return self.exec(cmd)
+    # Add a version to a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    #   payload [str] - secret value
+    # Returns:
+    #   details for the new version
+    def add_version(self, secretName, payload):
+        # The payload goes to gcloud on stdin, so it never appears in a command line
+        return self.exec(["secrets", "versions", "add", secretName, "--data-file=-"], stdin=payload)
+    # Get keys in the project
+    # Arg:
+    #   limit [int] *opt - limit on how many keys are returned (default=None)
+    # Returns:
+    #   list of keys (newest first)
+    def list_keys(self, limit=None):
+        cmd = ["services", "api-keys", "list", "--sort-by=~createTime"]
+        if limit:
+            cmd.append(f"--limit={limit}")
+        return self.exec(cmd)
+    # Get the config for a key
+    # Arg:
+    #   keyId [str] - key uid
+    # Returns:
+    #   key configuration
+    def describe_key(self, keyId):
+        return self.exec(["services", "api-keys", "describe", keyId])
+    # Get the string value for a key
+    # Arg:
+    #   keyId [str] - key uid
+    # Returns:
+    #   key string response ({"keyString": ...})
+    def get_key_string(self, keyId):
+        return self.exec(["services", "api-keys", "get-key-string", keyId])
+    # Build the command to create a key
+    # Arg:
+    #   keyName [str] - key display name
+    #   apiTargets [list of str] *opt - api targets in "service=..." form (default=None)
+    #   allowedIps [str] *opt - comma separated ip restrictions (default=None)
+    # Returns:
+    #   cmd [list of str] - command and flags for gcloud
+    def create_key_command(self, keyName, apiTargets=None, allowedIps=None):
+        # Initial command to create key
+        cmd = ["services", "api-keys", "create", f"--display-name={keyName}"]
+        flags = []
+        # If there are api targets, then add api-target flag(s) to add api targets
+        if apiTargets:
+            flags += [f"--api-target={target}" for target in apiTargets]
+        # If there are allowed ips, then add allowed-ips flag to add allowed ips
+        if allowedIps:
+            flags.append(f"--allowed-ips={allowedIps}")
+        self.debugger.print(flags)
+        # Add flags to command
+        return cmd + flags
+    # Create a key and wait for it to be ready
+    # Arg:
+    #   keyName [str] - key display name
+    #   apiTargets [list of str] *opt - api targets in "service=..." form (default=None)
+    #   allowedIps [str] *opt - comma separated ip restrictions (default=None)
+    # Returns:
+    #   details for the new key
+    def create_key(self, keyName, apiTargets=None, allowedIps=None):
+        # The finished operation (with the new key) is printed as json on stdout, and gcloud's progress messages on stderr
+        operation = self.exec(self.create_key_command(keyName, apiTargets, allowedIps))
+        return operation.get("response") if operation else None
+    # Start creating a key without waiting for it
+    # Arg:
+    #   keyName [str] - key display name
+    #   apiTargets [list of str] *opt - api targets in "service=..." form (default=None)
+    #   allowedIps [str] *opt - comma separated ip restrictions (default=None)
+    # Returns:
+    #   long running operation for the key creation
+    def create_key_async(self, keyName, apiTargets=None, allowedIps=None):
+        return self.exec(self.create_key_command(keyName, apiTargets, allowedIps) + ["--async"])
+    # Get the state of a long running api keys operation
+    # Arg:
+    #   operationName [str] - name of the operation
+    # Returns:
+    #   operation details
+    def get_operation(self, operationName):
+        return self.exec(["services", "operations", "describe", operationName])
+    # Delete a key
+    # Arg:
+    #   keyId [str] - key uid
+    def delete_key(self, keyId):
+        return self.exec(["services", "api-keys", "delete", keyId])
+    # Pull messages from a Pub/Sub subscription (they are redelivered unless they are acknowledged)
+    # Arg:
+    #   subscription [str] - subscription id (or full subscription name)
+    #   maxMessages [int] *opt - max number of messages returned (default=100)
+    # Returns:
+    #   list of received messages ({"ackId": ..., "message": {"data": ..., "attributes": ..., "publishTime": ...}})
+    def pull_messages(self, subscription, maxMessages=100):
+        return self.exec(["pubsub", "subscriptions", "pull", subscription, f"--limit={maxMessages}"]) or []
+    # Acknowledge messages pulled from a Pub/Sub subscription
+    # Arg:
+    #   subscription [str] - subscription id (or full subscription name)
+    #   ackIds [list of str] - ack ids of the received messages
+    def ack_messages(self, subscription, ackIds):
+        return self.exec(["pubsub", "subscriptions", "ack", subscription, f"--ack-ids={','.join(ackIds)}"])
+
+# Class to call the Secret Manager and API Keys REST APIs directly
+# All requests share one pooled keep-alive session, so there is no gcloud start-up cost per call.
+# An access token is taken from gcloud once and refreshed shortly before it expires.
+class GCPRest:
+    # The endpoints can be pointed somewhere else (e.g. the local stand-in in benchmarks/fake_cloud.py)
+    secretsUrl = os.environ.get("SECRET_MANAGER_ENDPOINT", "https://secretmanager.googleapis.com") + "/v1"
+    keysUrl = os.environ.get("API_KEYS_ENDPOINT", "https://apikeys.googleapis.com") + "/v2"
+    pubsubUrl = os.environ.get("PUBSUB_ENDPOINT", "https://pubsub.googleapis.com") + "/v1"
+    tokenLifetime = timedelta(minutes=50)
+    # Init Arg:
+    #   projectId [str] - name of GCP project
+    #   debug [bool] *opt - set to True to print debugging statements (default=False)
+    #   poolSize [int] *opt - max number of keep-alive connections per host (default=10)
+    def __init__(self, projectId, debug=False, poolSize=10):
+        self.projectId = projectId
+        self.debugger = Logger(debug)
+        self.http = urllib3.PoolManager(maxsize=poolSize, block=True, retries=False)
+        self.token = None
+        self.tokenExpiry = None
+        self.tokenLock = threading.Lock()
+    # Get an access token for the active gcloud account
+    # Returns:
+    #   token [str] - oauth2 access token
+    def access_token(self):
+        with self.tokenLock:
+            if not self.token or datetime.now(timezone.utc) >= self.tokenExpiry:
+                self.token = GCLOUD.run(["gcloud", "auth", "print-access-token"]).strip()
+                self.tokenExpiry = datetime.now(timezone.utc) + self.tokenLifetime
+            return self.token
+    # Send a request to a REST endpoint
+    # Arg:
+    #   method [str] - http method
+    #   url [str] - full url for the request
+    #   params [dict] *opt - query parameters (default=None)
+    #   body [dict] *opt - json body (default=None)
+    # Returns:
+    #   api response (raises GCPError if the request failed)
+    def request(self, method, url, params=None, body=None):
+        self.debugger.print(f"{method} {url} {params or ''}")
+        # Rate limit by api family (any GET to secret manager is a read)
+        if url.startswith(self.keysUrl):
+            family = "api-keys"
+        elif url.startswith(self.pubsubUrl) and "/subscriptions/" in url:
+            family = "pubsub"
+        else:
+            family = "secrets.read" if method == "GET" else "secrets.write"
+        return LIMITERS[family].call(lambda: self.send(method, url, params, body))
+    # Send a request once (see request for args)
+    def send(self, method, url, params=None, body=None):
+        headers = {"Authorization": f"Bearer {self.access_token()}", "x-goog-user-project": self.projectId}
+        try:
+            if body is not None:
+                headers["Content-Type"] = "application/json"
+                url += "?" + urlencode(params) if params else ""
+                res = self.http.request(method, url, body=json.dumps(body), headers=headers)
+            else:
+                res = self.http.request(method, url, fields=params, headers=headers)
+        except urllib3.exceptions.HTTPError as e:
+            raise GCPError(str(e), "UNAVAILABLE")
+        if res.status >= 400:
+            self.debugger.print(f"{res.status}: {res.data.decode()}")
+            try:
+                message = json.loads(res.data).get("error", {}).get("message")
+            except ValueError:
+                message = None
+            retryAfter = res.headers.get("Retry-After")
+            raise GCPError(message or res.data.decode()[:200], res.status, float(retryAfter) if retryAfter and retryAfter.isdigit() else None)
+        return json.loads(res.data) if res.data else {}
+    # Get every item from a paginated list endpoint
+    # Arg:
+    #   url [str] - list url
+    #   field [str] - response field that holds the items
+    #   params [dict] *opt - query parameters (default=None)
+    #   limit [int] *opt - limit on how many items are returned (default=None)
+    # Returns:
+    #   items [list of dict] - listed items
+    def list_all(self, url, field, params=None, limit=None):
+        params = dict(params or {})
+        items = []
+        while True:
+            if limit:
+                params["pageSize"] = min(limit - len(items), 1000)
+            page = self.request("GET", url, params)
+            items += page.get(field, [])
+            pageToken = page.get("nextPageToken")
+            if not pageToken or (limit and len(items) >= limit):
+                return items[:limit] if limit else items
+            params["pageToken"] = pageToken
+    # Yield items from a paginated list endpoint one page at a time
+    # Arg:
+    #   url [str] - list url
+    #   field [str] - response field that holds the items
+    #   params [dict] *opt - query parameters (default=None)
+    #   pageSize [int] *opt - number of items fetched per page (default=None)
+    # Returns:
+    #   generator of listed items
+    def iter_all(self, url, field, params=None, pageSize=None):
+        params = dict(params or {})
+        if pageSize:
+            params["pageSize"] = pageSize
+        while True:
+            page = self.request("GET", url, params)
+            yield from page.get(field, [])
+            pageToken = page.get("nextPageToken")
+            if not pageToken:
+                return
+            params["pageToken"] = pageToken
+    # Wait for a long running api keys operation to finish
+    # Arg:
+    #   operation [dict] - operation returned by the api
+    #   timeout [int] *opt - seconds to wait before giving up (default=120)
+    # Returns:
+    #   operation [dict] - finished operation (raises GCPError if it failed or timed out)
+    def wait_operation(self, operation, timeout=120):
+        deadline = time.monotonic() + timeout
+        delay = 0.25
+        while not operation.get("done"):
+            if time.monotonic() > deadline:
+                raise GCPError(f"Operation {operation.get('name')} did not finish in {timeout}s", "DEADLINE_EXCEEDED")
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+            operation = self.get_operation(operation.get("name"))
+        if operation.get("error"):
+            error = operation.get("error")
+            raise GCPError(error.get("message"), error.get("status") or error.get("code"))
+        return operation
+    def secret_url(self, secretName=""):
+        return f"{self.secretsUrl}/projects/{self.projectId}/secrets" + (f"/{secretName}" if secretName else "")
+    def key_url(self, keyId=""):
+        return f"{self.keysUrl}/projects/{self.projectId}/locations/global/keys" + (f"/{keyId}" if keyId else "")
+    # Same operations as GCP (see above for args/returns)
+    def list_secrets(self, limit=None, createdAfter=None):
+        params = {"filter": f'create_time>"{createdAfter}"'} if createdAfter else None
+        secrets = self.list_all(self.secret_url(), "secrets", params, limit)
+        # Match gcloud's --sort-by=~createTime
+        return sorted(secrets, key=lambda secret: secret.get("createTime", ""), reverse=True) if secrets else secrets
+    def iter_secrets(self, pageSize=None, createdAfter=None):
+        params = {"filter": f'create_time>"{createdAfter}"'} if createdAfter else None
+        return self.iter_all(self.secret_url(), "secrets", params, pageSize)
+    def describe_secret(self, secretName):
+        return self.request("GET", self.secret_url(secretName))
+    def list_versions(self, secretName, limit=None, enabled=False):
+        # Versions are returned newest first
+        params = {"filter": "state:ENABLED"} if enabled else None
+        return self.list_all(f"{self.secret_url(secretName)}/versions", "versions", params, limit)
+    def iter_versions(self, secretName, pageSize=None, enabled=False):
+        params = {"filter": "state:ENABLED"} if enabled else None
+        return self.iter_all(f"{self.secret_url(secretName)}/versions", "versions", params, pageSize)
+    def enable_version(self, secretName, version):
+        return self.request("POST", f"{self.secret_url(secretName)}/versions/{version}:enable", body={})
+    def disable_version(self, secretName, version):
+        return self.request("POST", f"{self.secret_url(secretName)}/versions/{version}:disable", body={})
+    def destroy_version(self, secretName, version):
+        return self.request("POST", f"{self.secret_url(secretName)}/versions/{version}:destroy", body={})
+    def update_annotations(self, secretName, annotations):
+        return self.request("PATCH", self.secret_url(secretName), {"updateMask": "annotations"}, {"annotations": annotations})
+    # The annotations are replaced as a whole, so the kept ones are sent back (with the etag, if given)
+    def remove_annotations(self, secretName, annotations, names, etag=None):
+        body = {"annotations": {name: value for name, value in annotations.items() if name not in names}}
+        if etag:
+            body["etag"] = etag
+        return self.request("PATCH", self.secret_url(secretName), {"updateMask": "annotations"}, body)
+    def add_version(self, secretName, payload):
+        data = base64.b64encode(payload.encode()).decode()
+        return self.request("POST", f"{self.secret_url(secretName)}:addVersion", body={"payload": {"data": data}})
+    def list_keys(self, limit=None):
+        keys = self.list_all(self.key_url(), "keys", limit=limit)
+        return sorted(keys, key=lambda key: key.get("createTime", ""), reverse=True) if keys else keys
+    def describe_key(self, keyId):
+        return self.request("GET", self.key_url(keyId))
+    def get_key_string(self, keyId):
+        return self.request("GET", f"{self.key_url(keyId)}/keyString")
+    # Build the request body to create a key
+    def key_body(self, keyName, apiTargets=None, allowedIps=None):
+        restrictions = {}
+        # Convert gcloud style "service=..." targets back into api targets
+        if apiTargets:
+            restrictions["apiTargets"] = []
+            for target in apiTargets:
+                key, value = target.split("=", 1)
+                if key == "service" or not restrictions["apiTargets"]:
+                    restrictions["apiTargets"].append({})
+                # Methods come through as a list string (e.g. "['GET', 'POST']")
+                if key == "methods":
+                    value = [method.strip(" '\"") for method in value.strip("[]").split(",") if method.strip()]
+                restrictions["apiTargets"][-1][key] = value
+        if allowedIps:
+            restrictions["serverKeyRestrictions"] = {"allowedIps": allowedIps.split(",")}
+        body = {"displayName": keyName}
+        if restrictions:
+            body["restrictions"] = restrictions
+        return body
+    def create_key(self, keyName, apiTargets=None, allowedIps=None):
+        operation = self.wait_operation(self.create_key_async(keyName, apiTargets, allowedIps))
+        return operation.get("response") if operation else None
+    def create_key_async(self, keyName, apiTargets=None, allowedIps=None):
+        return self.request("POST", self.key_url(), body=self.key_body(keyName, apiTargets, allowedIps))
+    def get_operation(self, operationName):
+        return self.request("GET", f"{self.keysUrl}/{operationName}")
+    def delete_key(self, keyId):
+        return self.wait_operation(self.request("DELETE", self.key_url(keyId)))
+    def subscription_url(self, subscription):
+        return f"{self.pubsubUrl}/" + (subscription if "/" in subscription else f"projects/{self.projectId}/subscriptions/{subscription}")
+    def pull_messages(self, subscription, maxMessages=100):
+        return self.request("POST", f"{self.subscription_url(subscription)}:pull", body={"maxMessages": maxMessages}).get("receivedMessages", [])
+    def ack_messages(self, subscription, ackIds):
+        return self.request("POST", f"{self.subscription_url(subscription)}:acknowledge", body={"ackIds": ackIds})
+
+# Available backends for gcloud/REST calls
+BACKENDS = {"gcloud": GCP, "rest": GCPRest}
+
+# Class to count and time every operation of a backend (other attributes are passed through)
+class InstrumentedBackend:
+    # Operation labels for backend methods
+    operations = {
+        "list_secrets": "secrets.list", "iter_secrets": "secrets.list", "describe_secret": "secrets.describe",
+        "update_annotations": "secrets.update", "remove_annotations": "secrets.update", "list_versions": "versions.list",
+        "iter_versions": "versions.list", "enable_version": "versions.enable", "disable_version": "versions.disable",
+        "destroy_version": "versions.destroy", "add_version": "versions.add",
+        "list_keys": "api-keys.list", "describe_key": "api-keys.describe", "get_key_string": "api-keys.get-key-string",
+        "create_key": "api-keys.create", "create_key_async": "api-keys.create", "delete_key": "api-keys.delete",
+        "get_operation": "operations.get", "pull_messages": "pubsub.pull", "ack_messages": "pubsub.ack",
+    }
+    # Init Arg:
+    #   backend [obj] - backend instance
+    #   metrics [obj] *opt - metrics instance (default=METRICS)
+    def __init__(self, backend, metrics=None):
+        self.backend = backend
+        self.metrics = metrics or METRICS
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        operation = self.operations.get(name)
+        if not operation:
+            return attr
+        # Streamed listings are timed while items are being waited for
+        if name.startswith("iter_"):
+            return lambda *args, **kwargs: self.metrics.timed_iter(attr(*args, **kwargs), operation)
+        def call(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                result = attr(*args, **kwargs)
+            except:
+                self.metrics.record(operation, time.monotonic() - start, error=True)
+                raise
+            self.metrics.record(operation, time.monotonic() - start)
+            return result
+        return call
+
+# Get a backend instance
+# Arg:
+#   projectId [str] - name of GCP project
+#   backend [str or obj] *opt - name of a backend in BACKENDS or an existing backend instance (default=gcloud)
+#   debug [bool] *opt - set to True to print debugging statements (default=False)
+# Returns:
+#   backend instance
+def get_backend(projectId, backend="gcloud", debug=False):
+    if isinstance(backend, str):
+        return InstrumentedBackend(BACKENDS[backend](projectId, debug=debug))
+    return backend
+
+# Class to cache secret details and versions for the length of a run (keyed by secret name)
+# Entries are copied on the way in and out so callers can't change what is cached
+class MetadataCache:
+    def __init__(self):
+        self.secrets = {}
+        # secretName -> {(limit, enabled): versions}
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    # Count a lookup and return a copy of the cached value (if there was one)
+    def lookup(self, value):
+        if value is None:
+            self.misses += 1
             return None
-    # Execute custom gcloud command
+        self.hits += 1
+        return copy.deepcopy(value)
+    # Get cached details for a secret
     # Arg:
-    #   command [str] - custom command to be executed
+    #   secretName [str] - name of secret
     # Returns:
-    #   gcloud api response
-    def custom_exec(self, command):
+    #   secret details (None if not cached)
+    def get_secret(self, secretName):
+        with self.lock:
+            return self.lookup(self.secrets.get(secretName))
+    # Cache details for a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    #   secretDetails [dict] - details for the secret
+    def put_secret(self, secretName, secretDetails):
+        with self.lock:
+            self.secrets[secretName] = copy.deepcopy(secretDetails)
+    # Get cached versions for a secret
+    # A full (unlimited) listing can answer any limited listing, and a full listing of all versions
+    # can also answer a listing of enabled versions
+    # Arg:
+    #   secretName [str] - name of secret
+    #   limit [int] *opt - limit on how many versions are returned (default=None)
+    #   enabled [bool] *opt - only return enabled versions (default=False)
+    # Returns:
+    #   list of versions (None if not cached)
+    def get_versions(self, secretName, limit=None, enabled=False):
+        with self.lock:
+            entries = self.versions.get(secretName, {})
+            versions = entries.get((limit, enabled))
+            if versions is None and (None, enabled) in entries:
+                versions = entries[(None, enabled)][:limit]
+            if versions is None and enabled and (None, False) in entries:
+                versions = [version for version in entries[(None, False)] if version.get("state") == "ENABLED"][:limit]
+            return self.lookup(versions)
+    # Cache versions for a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    #   limit [int] - limit used for the listing
+    #   enabled [bool] - whether the listing was for enabled versions only
+    #   versions [list of dict] - list of versions
+    def put_versions(self, secretName, limit, enabled, versions):
+        with self.lock:
+            self.versions.setdefault(secretName, {})[(limit, enabled)] = copy.deepcopy(versions)
+    # Drop cached versions for a secret (after its versions have changed)
+    # Arg:
+    #   secretName [str] - name of secret
+    def invalidate_versions(self, secretName):
+        with self.lock:
+            self.versions.pop(secretName, None)
+    # Drop cached details for a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    def invalidate_secret(self, secretName):
+        with self.lock:
+            self.secrets.pop(secretName, None)
+    # Returns:
+    #   stats [dict] - cache hit/miss counts
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+# Compact record for a secret in an inventory
+class SecretRecord:
+    __slots__ = ("name", "annotations", "type", "createTime", "etag", "versions")
+    # Init Arg:
+    #   secret [dict] - secret details (from list_secrets)
+    def __init__(self, secret):
+        self.name = secret.get("name").split("/")[-1]
+        self.annotations = secret.get("annotations") or {}
+        self.type = self.annotations.get("type")
+        self.createTime = secret.get("createTime")
+        self.etag = secret.get("etag")
+        # Filled in when the versions are first needed
+        self.versions = None
+
+# Class to hold the details of one rotation
+# Slotted (like SecretRecord) so a run that rotates thousands of keys keeps its results small
+class RotationRecord:
+    # Details in the order they are reported
+    fields = ("secretName", "oldVersion", "newVersion", "keyName", "oldKeyId", "newKeyId")
+    __slots__ = fields + ("projectId", "owner")
+    # Init Arg:
+    #   secretName [str] - name of secret
+    #   oldVersion [str] - version that was replaced
+    #   newVersion [str] - version with the new key
+    #   keyName [str] - display name of the key
+    #   oldKeyId [str] - uid of the deleted key
+    #   newKeyId [str] - uid of the new key
+    #   projectId [str] *opt - name of GCP project, set when several projects are reported together (default=None)
+    #   owner [str] *opt - owner to notify (default=None)
+    def __init__(self, secretName, oldVersion, newVersion, keyName, oldKeyId, newKeyId, projectId=None, owner=None):
+        self.secretName = secretName
+        self.oldVersion = oldVersion
+        self.newVersion = newVersion
+        self.keyName = keyName
+        self.oldKeyId = oldKeyId
+        self.newKeyId = newKeyId
+        self.projectId = projectId
+        self.owner = owner
+    # Returns:
+    #   details [dict] - details of the rotation (with the project last if it is set), e.g. for JSON
+    def to_dict(self):
+        details = {field: getattr(self, field) for field in self.fields}
+        if self.projectId:
+            details["projectId"] = self.projectId
+        return details
+    # Arg:
+    #   details [dict] - details of the rotation (from to_dict)
+    #   projectId [str] *opt - name of GCP project (default=the project in details)
+    #   owner [str] *opt - owner to notify (default=None)
+    # Returns:
+    #   rotatedSecret [obj] - rotation record
+    @classmethod
+    def from_dict(cls, details, projectId=None, owner=None):
+        return cls(*(details.get(field) for field in cls.fields), projectId or details.get("projectId"), owner)
+
+# Class to hold a snapshot of the secrets in a project (taken from a single list call)
+class SecretInventory:
+    # Init Arg:
+    #   sMan [obj] - secret manager instance (used to fill in versions)
+    #   records [iterable of obj] - secret records (e.g. from iter_records)
+    def __init__(self, sMan, records):
+        self.sMan = sMan
+        self.records = list(records)
+        self.byName = {record.name: record for record in self.records}
+    # Get a secret record
+    # Arg:
+    #   secretName [str] - name of secret
+    # Returns:
+    #   record [obj] - secret record (None if the secret isn't in the inventory)
+    def get(self, secretName):
+        return self.byName.get(secretName)
+    # Get the records for secrets of a type
+    # Arg:
+    #   secretType [str] *opt - value of the type annotation (default=api_key)
+    # Returns:
+    #   records [list of obj] - matching secret records
+    def of_type(self, secretType="api_key"):
+        return [record for record in self.records if record.type == secretType]
+    # Get the versions for a secret (listing them the first time they are needed)
+    # Arg:
+    #   record [obj] - secret record
+    # Returns:
+    #   versions [list of dict] - list of versions for the secret (newest first)
+    def get_versions(self, record):
+        if record.versions is None:
+            record.versions = self.sMan.list_versions(record.name) or []
+        return record.versions
+    # Find the secret whose annotations reference a key
+    # Arg:
+    #   keyId [str] - key uid
+    # Returns:
+    #   record [obj] - secret record (None if no secret references the key)
+    def find_key(self, keyId):
+        return next((record for record in self.records if keyId in record.annotations.values()), None)
+
+# Class to remember when each api key secret is next due, so a run only has to check the secrets that are due
+# The create time of each secret's latest version is kept in a SQLite file per project (next due = create time + expiryTime,
+# so changing expiryTime doesn't need a reconcile). A secret is checked again if it is due, if its etag in the listing
+# has changed (rotations and annotation changes update it) or if it hasn't been checked yet. Changes that don't touch
+# the secret itself (e.g. a version added by hand) are picked up by a full reconcile every reconcileDays.
+class RotationSchedule:
+    # Init Arg:
+    #   projectId [str] - name of GCP project
+    #   stateDir [str] *opt - directory for the schedule file (default=~/.cache/credential-manager)
+    #   reconcileDays [float] *opt - days between full reconciles, where every secret is checked (default=7)
+    def __init__(self, projectId, stateDir=None, reconcileDays=7):
+        stateDir = stateDir or os.path.join(os.path.expanduser("~"), ".cache", "credential-manager")
+        os.makedirs(stateDir, exist_ok=True)
+        self.path = os.path.join(stateDir, f"{projectId}-schedule.sqlite")
+        self.reconcileDays = reconcileDays
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS schedule (name TEXT PRIMARY KEY, etag TEXT, versionCreateTime TEXT);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+        """)
+        # Loaded up front so checks don't touch the database from worker threads
+        self.entries = {name: (etag, createTime) for name, etag, createTime in self.db.execute("SELECT * FROM schedule")}
+        row = self.db.execute("SELECT value FROM meta WHERE name='lastReconcile'").fetchone()
+        self.lastReconcile = datetime.fromisoformat(row[0]) if row else None
+    # Check if this run should be a full reconcile
+    # Returns:
+    #   reconcile [bool] - True if every secret should be checked
+    def reconcile_due(self):
+        return not self.lastReconcile or datetime.now(timezone.utc) - self.lastReconcile >= timedelta(days=self.reconcileDays)
+    # Check if a secret needs to be checked
+    # Arg:
+    #   secretName [str] - name of secret
+    #   etag [str] - etag of the secret in the listing
+    #   expiryTime [int] - limit for how old secrets can be (in days)
+    # Returns:
+    #   due [bool] - True if the secret should be checked
+    def is_due(self, secretName, etag, expiryTime):
+        entry = self.entries.get(secretName)
+        if not entry or not entry[1] or entry[0] != etag:
+            return True
+        createDate = datetime.strptime(entry[1], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - createDate > timedelta(days=expiryTime)
+    # Save what a run learned about the secrets it checked
+    # Arg:
+    #   entries [dict] - secret name -> (etag, latest version create time)
+    #   listedNames [set of str] *opt - every api key secret listed, to drop deleted secrets after a full reconcile (default=None)
+    def save(self, entries, listedNames=None):
+        self.db.executemany("INSERT OR REPLACE INTO schedule VALUES (?, ?, ?)", [(name, etag, createTime) for name, (etag, createTime) in entries.items()])
+        self.entries.update(entries)
+        if listedNames is not None:
+            removed = [name for name in self.entries if name not in listedNames]
+            self.db.executemany("DELETE FROM schedule WHERE name=?", [(name,) for name in removed])
+            for name in removed:
+                del self.entries[name]
+            self.lastReconcile = datetime.now(timezone.utc)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('lastReconcile', ?)", (self.lastReconcile.isoformat(),))
+        self.db.commit()
+
+# Raised when another worker already has a rotation journal open
+class JournalInUse(Exception):
+    pass
+
+# Class to keep a write-ahead journal of rotation steps, so an interrupted run can be resumed
+# Each step is appended to a JSON lines file per project before the run moves on. Records from several threads are
+# written and fsynced together (group commit): a thread waits for its record to be on disk, and whichever thread
+# gets to write next writes everything that has queued up since, so concurrent rotations share fsyncs.
+# Steps in order: key requested, key created, version added, old version disabled, annotation added, old key deleted
+class RotationJournal:
+    steps = ("key requested", "key created", "version added", "old version disabled", "annotation added", "old key deleted")
+    # Init Arg:
+    #   projectId [str] - name of GCP project
+    #   journalDir [str] *opt - directory for the journal file (default=~/.cache/credential-manager)
+    def __init__(self, projectId, journalDir=None):
+        journalDir = journalDir or os.path.join(os.path.expanduser("~"), ".cache", "credential-manager")
+        os.makedirs(journalDir, exist_ok=True)
+        self.path = os.path.join(journalDir, f"{projectId}-journal.jsonl")
+        # Only one worker can use a journal at a time (the lock goes away with the process, even if it is killed)
+        self.lockFile = open(f"{self.path}.lock", "w")
         try:
-            # Try to execute the command
-            response = os.popen(command).read()
-            return json.loads(response)
-        except:
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lockFile.close()
+            raise JournalInUse(f"journal {self.path} is in use by another worker")
+        # secretName -> state of a rotation that hasn't finished
+        self.rotations = self.load()
+        self.compact()
+        self.file = open(self.path, "a")
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.pending = []
+        self.appended = 0
+        self.durable = 0
+    # Read the journal, keeping the rotations that didn't finish
+    # Returns:
+    #   rotations [dict] - secret name -> rotation state
+    def load(self):
+        rotations = {}
+        if not os.path.exists(self.path):
+            return rotations
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                # The last line might have been cut off when the run stopped
+                except ValueError:
+                    continue
+                self.apply(rotations, entry)
+        return rotations
+    # Update the rotation states with a journal entry
+    # Arg:
+    #   rotations [dict] - secret name -> rotation state
+    #   entry [dict] - journal entry
+    @staticmethod
+    def apply(rotations, entry):
+        entry = dict(entry)
+        secretName = entry.pop("secretName")
+        step = entry.pop("step")
+        requestTime = entry.pop("time", None)
+        if step == "key requested":
+            rotations[secretName] = {"secretName": secretName, "steps": [], "requestTime": requestTime}
+        if secretName not in rotations:
+            return
+        if step in ("old key deleted", "abandoned"):
+            del rotations[secretName]
+            return
+        rotations[secretName].update(entry)
+        rotations[secretName]["steps"].append(step)
+    # Rewrite the journal with only the rotations that haven't finished (so it doesn't keep growing)
+    def compact(self):
+        tmpName = f"{self.path}.tmp"
+        with open(tmpName, "w") as file:
+            for rotation in self.rotations.values():
+                for step in rotation["steps"]:
+                    entry = {"secretName": rotation["secretName"], "step": step}
+                    if step == "key requested":
+                        entry.update(time=rotation["requestTime"], oldVersion=rotation.get("oldVersion"), oldKeyId=rotation.get("oldKeyId"), keyName=rotation.get("keyName"))
+                    elif step == "key created":
+                        entry["newKeyId"] = rotation.get("newKeyId")
+                    elif step == "version added":
+                        entry["newVersion"] = rotation.get("newVersion")
+                    file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmpName, self.path)
+    # Get the rotations that haven't finished (in the order they were started)
+    # Returns:
+    #   rotations [list of dict] - rotation states
+    def incomplete(self):
+        with self.lock:
+            return [dict(rotation, steps=list(rotation["steps"])) for rotation in self.rotations.values()]
+    # Check if a secret has a rotation that hasn't finished
+    def is_incomplete(self, secretName):
+        with self.lock:
+            return secretName in self.rotations
+    # Record a step and wait until it is on disk
+    # Arg:
+    #   secretName [str] - name of secret
+    #   step [str] - step that was done (one of steps, or "abandoned")
+    #   data [dict] - details for the step (e.g. newKeyId); key strings are never journaled
+    def record(self, secretName, step, **data):
+        entry = dict({"secretName": secretName, "step": step, "time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")}, **data)
+        line = json.dumps(entry)
+        with self.lock:
+            self.apply(self.rotations, entry)
+            self.pending.append(line)
+            self.appended += 1
+            sequence = self.appended
+        # Whoever gets the flush lock writes everything queued so far
+        with self.flushLock:
+            if self.durable >= sequence:
+                return
+            with self.lock:
+                lines = self.pending
+                self.pending = []
+                upTo = self.appended
+            with METRICS.timer("journal.fsync"):
+                self.file.write("".join(line + "\n" for line in lines))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.durable = upTo
+    def close(self):
+        self.file.close()
+        self.lockFile.close()
+
+# Get the shard a secret belongs to
+# The hash is stable across processes and machines (unlike hash()), so every worker agrees on the partition
+# Arg:
+#   secretName [str] - name of secret
+#   shardCount [int] - number of shards
+# Returns:
+#   shardIndex [int] - shard number (0 to shardCount-1)
+def shard_of(secretName, shardCount):
+    return int(hashlib.sha256(secretName.encode()).hexdigest()[:8], 16) % shardCount
+
+# Class to stop two workers from rotating the same secret at the same time
+# Each lease is a small file (created with O_EXCL) in a directory that every worker can see, e.g. a shared EFS mount.
+# Held leases are renewed in the background, so a worker that dies only blocks its secrets until its leases expire.
+class LeaseStore:
+    # Init Arg:
+    #   projectId [str] - name of GCP project
+    #   leaseDir [str] *opt - directory for the lease files (default=~/.cache/credential-manager/leases)
+    #   leaseSeconds [float] *opt - how long a lease lasts without being renewed (default=120)
+    #   owner [str] *opt - name of this worker (default=host:pid)
+    def __init__(self, projectId, leaseDir=None, leaseSeconds=120, owner=None):
+        leaseDir = leaseDir or os.path.join(os.path.expanduser("~"), ".cache", "credential-manager", "leases")
+        self.dir = os.path.join(leaseDir, projectId)
+        os.makedirs(self.dir, exist_ok=True)
+        self.leaseSeconds = leaseSeconds
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+    def path(self, secretName):
+        return os.path.join(self.dir, f"{secretName}.lease")
+    # Read a lease file
+    # Returns:
+    #   lease [dict] - owner and expiry time (None if there isn't a readable lease)
+    def read(self, path):
+        try:
+            with open(path) as file:
+                return json.loads(file.read())
+        except (OSError, ValueError):
             return None
+    # Check if a lease file has expired
+    # A file that can't be parsed (e.g. left empty by a worker that crashed between creating and writing it) expires
+    # leaseSeconds after it was last written
+    # Arg:
+    #   path [str] - lease file
+    #   lease [dict] - lease read from the file (None if it couldn't be parsed)
+    # Returns:
+    #   expired [bool] - True if the lease can be taken over (False if the file is gone)
+    def expired(self, path, lease):
+        if lease is not None:
+            return lease.get("expires", 0) <= time.time()
+        try:
+            return os.path.getmtime(path) + self.leaseSeconds <= time.time()
+        except OSError:
+            return False
+    # Write a lease that this worker owns
+    # Arg:
+    #   path [str] - lease file
+    #   exclusive [bool] *opt - set to True to fail if the file already exists (default=False)
+    def write(self, path, exclusive=False):
+        lease = json.dumps({"owner": self.owner, "expires": time.time() + self.leaseSeconds})
+        if exclusive:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, "w") as file:
+                file.write(lease)
+            return
+        # Renewals replace the file in one step, so readers never see a partial lease
+        tmpPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmpPath, "w") as file:
+            file.write(lease)
+        os.replace(tmpPath, path)
+    # Try to take the lease for a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    # Returns:
+    #   acquired [bool] - True if this worker now holds the lease
+    def acquire(self, secretName):
+        path = self.path(secretName)
+        try:
+            self.write(path, exclusive=True)
+        except FileExistsError:
+            # A lease that is still live (or is still being written) belongs to someone else
+            if not self.expired(path, self.read(path)):
+                return False
+            # Move the expired lease aside (only one worker's rename can succeed), then try again
+            stalePath = f"{path}.{self.owner.replace(':', '-')}.stale"
+            try:
+                os.rename(path, stalePath)
+            except FileNotFoundError:
+                return False
+            # Another worker might have renewed or replaced it between the read and the rename, so put a live lease back
+            if not self.expired(stalePath, self.read(stalePath)):
+                try:
+                    os.link(stalePath, path)
+                except FileExistsError:
+                    pass
+                os.remove(stalePath)
+                return False
+            os.remove(stalePath)
+            try:
+                self.write(path, exclusive=True)
+            except FileExistsError:
+                return False
+        with self.lock:
+            self.held.add(secretName)
+        return True
+    # Give up the lease for a secret
+    # Arg:
+    #   secretName [str] - name of secret
+    def release(self, secretName):
+        with self.lock:
+            self.held.discard(secretName)
+        path = self.path(secretName)
+        lease = self.read(path)
+        if lease and lease.get("owner") == self.owner:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    # Renew every lease this worker holds (leases taken over by another worker are dropped)
+    def renew(self):
+        with self.lock:
+            held = list(self.held)
+        for secretName in held:
+            path = self.path(secretName)
+            lease = self.read(path)
+            if lease and lease.get("owner") == self.owner:
+                self.write(path)
+            else:
+                print(f"Error: lost the lease for {secretName}")
+                with self.lock:
+                    self.held.discard(secretName)
+    # Renew the held leases in the background until close is called
+    def start(self):
+        def beat():
+            while not self.stopped.wait(self.leaseSeconds / 3):
+                self.renew()
+        self.heartbeat = threading.Thread(target=beat, daemon=True)
+        self.heartbeat.start()
+        return self
+    # Stop renewing and release every held lease
+    def close(self):
+        self.stopped.set()
+        if self.heartbeat:
+            self.heartbeat.join()
+        with self.lock:
+            held = list(self.held)
+        for secretName in held:
+            self.release(secretName)
 
 # Class to manage secrets in GCP
 class SecretManager:
@@ -61,36 +1642,71 @@ class SecretManager:
     #   credMan [obj] - credential manager object to rotate credentials
     #   debug [bool] *opt - set to True to print debugging statements (default=False)
     #   test [bool] *opt - set to True to testing mode (default=False)
-    def __init__(self, projectId, credMan, debug=False, test=False):
+    #   backend [str or obj] *opt - backend name in BACKENDS or backend instance (default=gcloud)
+    def __init__(self, projectId, credMan, debug=False, test=False, backend="gcloud"):
         self.projectId = projectId
-        self.GCP = GCP(self.projectId, debug=debug)
+        self.GCP = get_backend(self.projectId, backend, debug)
         self.credMan = credMan
         self.debugger = Logger(debug)
         self.test = test
+        self.cache = MetadataCache()
         self.rotatedSecrets = []
+        # secretName -> create time of the latest version, for the secrets checked this run
+        self.checkedVersions = {}
+        # secretName -> notification annotation, for the api key secrets checked this run
+        self.owners = {}
+        # Report that each rotation is written to as it finishes (see open_report)
+        self.report = None
     # Get secrets in the project
     # Arg:
     #   limit [int] *opt - limit on how many secrets are returned (default=None)
+    #   createdAfter [str] *opt - only return secrets created after this RFC 3339 time (default=None)
     # Returns:
     #   secretsList [list of dict] - list of secrets
-    def list_secrets(self, limit=None):
-        # Initial command to list secrets
-        cmd = "secrets list --sort-by=~createTime"
-        # If limit flag is set, then add limit flag to limit returned versions
-        if limit:
-            cmd += f" --limit={limit}"
+    def list_secrets(self, limit=None, createdAfter=None):
         # Get details for secret(s)
-        secretsList = self.GCP.exec(cmd)
+        secretsList = self.GCP.list_secrets(limit, createdAfter)
         self.debugger.print(secretsList)
         return secretsList
+    # Get secrets in the project page by page
+    # Arg:
+    #   pageSize [int] *opt - number of secrets fetched per page (default=None)
+    #   createdAfter [str] *opt - only return secrets created after this RFC 3339 time (default=None)
+    # Returns:
+    #   generator of secrets (in api order)
+    def iter_secrets(self, pageSize=None, createdAfter=None):
+        return self.GCP.iter_secrets(pageSize, createdAfter)
+    # Get records for the secrets in the project page by page
+    # The listing has the same details as describe_secret, so api_key secrets are also added to the cache
+    # Arg:
+    #   pageSize [int] *opt - number of secrets fetched per page (default=None)
+    # Returns:
+    #   generator of secret records (in api order)
+    def iter_records(self, pageSize=None):
+        for secret in self.iter_secrets(pageSize):
+            record = SecretRecord(secret)
+            if record.type == "api_key":
+                self.cache.put_secret(record.name, secret)
+            yield record
+    # Get an inventory of the secrets in the project
+    # Arg:
+    #   pageSize [int] *opt - number of secrets fetched per page (default=None)
+    # Returns:
+    #   inventory [obj] - secret inventory
+    def inventory(self, pageSize=None):
+        return SecretInventory(self, self.iter_records(pageSize))
     # Get details for a secret
     # Arg:
     #   secretName [str] - name of secret 
     # Returns:
     #   secretDetails [dict] - details for the secret
     def describe_secret(self, secretName):
-        # Get details for the secret
-        secretDetails = self.GCP.exec(f"secrets describe {secretName}")
+        # Get details for the secret (from the cache if it was already fetched)
+        secretDetails = self.cache.get_secret(secretName)
+        if secretDetails is None:
+            secretDetails = self.GCP.describe_secret(secretName)
+            if secretDetails is not None:
+                self.cache.put_secret(secretName, secretDetails)
         self.debugger.print(secretDetails)
         return secretDetails
     # Get versions for a secret
@@ -101,21 +1717,26 @@ class SecretManager:
     # Returns:
     #   versions [list of dict] - list of versions for the secret
     def list_versions(self, secretName, limit=None, enabled=False):
-        # Initial command to list secrets
+        # Get versions for the secret (from the cache if they were already fetched)
         # Sorted by creation time so newest are first
-        cmd = f"secrets versions list {secretName} --sort-by=~createTime"
-        # If limit flag is set, then add limit flag to limit returned versions
-        if limit:
-            cmd += f" --limit={limit}"
-        # If enabled flag is set, then add enabled flag to list enabled versions only
-        if enabled:
-            cmd += f" --filter='state:ENABLED'"
-        # Get versions for the secret
-        versions = self.GCP.exec(cmd)
+        versions = self.cache.get_versions(secretName, limit, enabled)
+        if versions is None:
+            versions = self.GCP.list_versions(secretName, limit, enabled)
+            if versions is not None:
+                self.cache.put_versions(secretName, limit, enabled, versions)
         if not versions:
             print("No versions available (check that there is at least 1 enabled version)")
         self.debugger.print(versions)
         return versions
+    # Get versions for a secret page by page (skips the cache)
+    # Arg:
+    #   secretName [str] - name of secret
+    #   pageSize [int] *opt - number of versions fetched per page (default=None)
+    #   enabled [bool] *opt - only return enabled versions (default=False)
+    # Returns:
+    #   generator of versions (newest first)
+    def iter_versions(self, secretName, pageSize=None, enabled=False):
+        return self.GCP.iter_versions(secretName, pageSize, enabled)
     # Get annotations for a secret
     # Arg:
     #   secretName [str] - name of secret
@@ -182,7 +1803,8 @@ class SecretManager:
                 print(f"'Enabled' version {version} for {secretName}")
         # otherwise, execute the enable command
         else:
-            self.GCP.exec(f"secrets versions enable {version} --secret={secretName}")
+            self.GCP.enable_version(secretName, version)
+            self.cache.invalidate_versions(secretName)
     # Disable a secret version
     # Arg:
     #   secretName [str] - name of secret
@@ -193,7 +1815,38 @@ class SecretManager:
                 print(f"'Disabled' version {version} for {secretName}")
         # otherwise, execute the disable command
         else:
-            self.GCP.exec(f"secrets versions disable {version} --secret={secretName}")
+            self.GCP.disable_version(secretName, version)
+            self.cache.invalidate_versions(secretName)
+    # Destroy a secret version
+    # Arg:
+    #   secretName [str] - name of secret
+    #   version [int] - secret version
+    def destroy_version(self, secretName, version):
+        # if in test mode, print action
+        if self.test:
+            print(f"'Destroyed' version {version} for {secretName}")
+        # otherwise, execute the destroy command
+        else:
+            self.GCP.destroy_version(secretName, version)
+            self.cache.invalidate_versions(secretName)
+    # Remove annotations from a secret
+    # The secret's etag is sent along, so the removal fails (rather than dropping a new annotation) if the secret changed
+    # Arg:
+    #   secretName [str] - name of secret
+    #   names [list of str] - annotations to remove
+    def remove_annotations(self, secretName, names):
+        secretDetails = self.describe_secret(secretName)
+        # if in test mode, print action
+        if self.test:
+            print(f"'Removing' annotation(s) {', '.join(names)} from {secretName}")
+        # otherwise, execute the update annotations command
+        else:
+            secretDetails = self.GCP.remove_annotations(secretName, secretDetails.get("annotations", {}), names, secretDetails.get("etag"))
+            # Update the cached details with the response (or drop them if there wasn't one)
+            if secretDetails:
+                self.cache.put_secret(secretName, secretDetails)
+            else:
+                self.cache.invalidate_secret(secretName)
     # Add an annotation to a secret
     # Arg:
     #   secretName [str] - name of secret
@@ -203,14 +1856,18 @@ class SecretManager:
         # Get annotations and add the new one
         annotations = self.list_annotations(secretName)
         annotations[f"{version}"] = credId
-        annotationStr = ",".join([key+"="+value for key, value in annotations.items()])
-        self.debugger.print(annotationStr)
+        self.debugger.print(annotations)
         # if in test mode, print action
         if self.test:
             print(f"'Adding' annotation '{version}: {credId}' to {secretName}")
         # otherwise, execute the update annotations command
         else:
-            self.GCP.exec(f"secrets update {secretName} --update-annotations='{annotationStr}'")
+            secretDetails = self.GCP.update_annotations(secretName, annotations)
+            # Update the cached details with the response (or drop them if there wasn't one)
+            if secretDetails:
+                self.cache.put_secret(secretName, secretDetails)
+            else:
+                self.cache.invalidate_secret(secretName)
     # Add a version to a secret
     # Arg:
     #   secretName [str] - name of secret
@@ -218,71 +1875,442 @@ class SecretManager:
     # Return:
     #   newVersionNum (int) - version number for the added version
     def add_version(self, secretName, credValue):
-        # Custom command
-        cmd = (
-            f"echo -n {credValue} | gcloud secrets versions add {secretName} "
-            f"--data-file=- --project={self.projectId} --format=json"
-        )
         # If in test mode, print action,
         if self.test:
             print(f"'Adding' new credential '{credValue}' to {secretName}")
             newVersionNum = "NewVersion#"
-        # Otherwise, execute custom command
+        # Otherwise, add the version
         else:
-            newVersionDetails = self.GCP.custom_exec(cmd)
+            newVersionDetails = self.GCP.add_version(secretName, credValue)
+            self.cache.invalidate_versions(secretName)
             newVersionNum = newVersionDetails.get("name").split("/")[-1]
         return newVersionNum
-    # Rotate secrets that are older than a specified number of days
+    # Check whether a secret is due for rotation
     # Arg:
+    #   secretName [str] - name of secret
     #   expiryTime [int] - limit for how old secrets can be (in days)
-    def rotate_secrets(self, expiryTime):
-        # Get all secrets
-        secrets = self.list_secrets()
-        # There might not be any secrets in the project
-        if not secrets:
-            print("Error: There are no secrets in this project")
-        for secret in secrets:
-            secretName = secret.get("name").split("/")[-1]
-            print(f"-----\nSecret Name: {secretName}")
+    # Returns:
+    #   oldVersionNum [str] - latest version number (None if the secret isn't due)
+    #   oldKeyId [str] - key uid for the latest version (None if the secret isn't due)
+    def check_secret(self, secretName, expiryTime):
+        print(f"-----\nSecret Name: {secretName}")
+        with METRICS.span("check age", secretName):
             # Check that the secret is for an api key
             secretType = self.check_type(secretName)
             if not secretType=="api_key":
                 print(f"{secretName} is not an api_key")
-                continue
+                return None, None
+            # Keep the owner now so notifying them doesn't need the secret again
+            self.owners[secretName] = self.list_annotations(secretName).get("notification")
             # Check the latest version of the secret
             latestVersion = self.latest_version(secretName)
             if not latestVersion:
                 print(f"Error: {secretName} has no versions")
-                continue
+                return None, None
+            self.checkedVersions[secretName] = latestVersion.get("createTime")
             # Check the age of the secret
             print("Checking age of secret...")
             createDate = datetime.strptime(latestVersion.get("createTime"), "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
             print(f"Creation Time: {createDate}")
             print(f" Current Time: {datetime.now(timezone.utc)}")
-            # If the secret is older than the desired number of days
-            if datetime.now(timezone.utc) - createDate > timedelta(days=expiryTime):
-                # Get the latest annotation (which contains the associated key uid)
-                latestAnnotation = self.latest_annotation(secretName)      
-                if not latestAnnotation:
-                    print(f"Error: {secretName} has no annotation corresponding to latest version")
-                    continue
-                print("Rotating key...")
-                for oldVersionNum, oldKeyId in latestAnnotation.items():
-                    # Rotate the key
-                    displayName, newKeyId, newKeyString = self.credMan.rotate_key(oldKeyId)
-                    print("Updating secret...")
-                    # Disable the old secret version
-                    self.disable_version(secretName, oldVersionNum)
-                # Add the new secret version
-                newVersionNum = self.add_version(secretName, newKeyString)
-                # Add the new annotation for the new version
-                self.add_annotation(secretName, newVersionNum, newKeyId)
-            # Otherwise, don't rotate the secret
-            else:
+            # If the secret isn't older than the desired number of days, don't rotate the secret
+            if not datetime.now(timezone.utc) - createDate > timedelta(days=expiryTime):
                 print(f"{secretName} is not older than {expiryTime} day(s)")
-                continue
-            # Log the changes
-            self.rotatedSecrets.append({"secretName": secretName, "oldVersion": oldVersionNum, "newVersion": newVersionNum, "keyName": displayName, "oldKeyId": oldKeyId, "newKeyId": newKeyId})
+                return None, None
+            # Get the latest annotation (which contains the associated key uid)
+            latestAnnotation = self.latest_annotation(secretName)
+            if not latestAnnotation:
+                print(f"Error: {secretName} has no annotation corresponding to latest version")
+                return None, None
+        return next(iter(latestAnnotation.items()))
+    # Do the steps of a rotation that haven't been done yet, journaling each one
+    # The new version is added before the old one is disabled and the old key is only deleted once the secret
+    # points at the new key, so a rotation that stops partway never leaves the secret without a working key
+    # Arg:
+    #   rotation [dict] - rotation state (secretName, oldVersion, oldKeyId, keyName, newKeyId and the steps done)
+    #   journal [obj] *opt - rotation journal (default=None)
+    # Returns:
+    #   rotatedSecret [obj] - rotation record
+    def complete_rotation(self, rotation, journal=None):
+        secretName = rotation["secretName"]
+        steps = rotation.setdefault("steps", [])
+        # Record a finished step
+        def done(step, **data):
+            rotation.update(data)
+            steps.append(step)
+            if journal:
+                journal.record(secretName, step, **data)
+        newKeyId = rotation["newKeyId"]
+        print("Updating secret...")
+        if "version added" not in steps:
+            # The key string is only kept in memory (it isn't journaled), so fetch it again if needed
+            newKeyString = rotation.pop("newKeyString", None)
+            if not newKeyString:
+                with METRICS.span("rotate key", secretName):
+                    newKeyString = self.credMan.get_key_string(newKeyId)
+            with METRICS.span("update secret", secretName):
+                newVersionNum = self.add_version(secretName, newKeyString)
+            done("version added", newVersion=newVersionNum)
+        if "old version disabled" not in steps:
+            with METRICS.span("update secret", secretName):
+                self.disable_version(secretName, rotation["oldVersion"])
+            done("old version disabled")
+        if "annotation added" not in steps:
+            with METRICS.span("update secret", secretName):
+                self.add_annotation(secretName, rotation["newVersion"], newKeyId)
+            done("annotation added")
+        if "old key deleted" not in steps:
+            with METRICS.span("rotate key", secretName):
+                try:
+                    self.credMan.delete_key(rotation["oldKeyId"])
+                except GCPError as e:
+                    # A resumed run might have deleted the key just before it stopped
+                    if not e.notFound:
+                        raise
+            done("old key deleted")
+        print(f"Rotated {secretName}")
+        return RotationRecord(secretName, rotation["oldVersion"], rotation["newVersion"], rotation["keyName"], rotation["oldKeyId"], newKeyId)
+    # Rotate a secret if it is older than a specified number of days
+    # Arg:
+    #   secretName [str] - name of secret
+    #   expiryTime [int] - limit for how old secrets can be (in days)
+    #   journal [obj] *opt - rotation journal (default=None)
+    # Returns:
+    #   rotatedSecret [obj] - rotation record (None if the secret wasn't rotated)
+    def rotate_secret(self, secretName, expiryTime, journal=None):
+        oldVersionNum, oldKeyId = self.check_secret(secretName, expiryTime)
+        if not oldKeyId:
+            return None
+        print("Rotating key...")
+        # Create the new key with the old key's configuration
+        with METRICS.span("rotate key", secretName):
+            displayName, apiTargets, allowedIps = self.credMan.key_config(oldKeyId)
+            if journal:
+                journal.record(secretName, "key requested", oldVersion=oldVersionNum, oldKeyId=oldKeyId, keyName=displayName)
+            newKeyId, newKeyString = self.credMan.create_key(displayName, apiTargets, allowedIps)
+        if journal:
+            journal.record(secretName, "key created", newKeyId=newKeyId)
+        rotation = {"secretName": secretName, "oldVersion": oldVersionNum, "oldKeyId": oldKeyId, "keyName": displayName, "newKeyId": newKeyId,
+                    "newKeyString": newKeyString, "steps": ["key requested", "key created"]}
+        return self.complete_rotation(rotation, journal)
+    # Check a secret and, if it is due, start creating its new key without waiting for it
+    # Arg:
+    #   secretName [str] - name of secret
+    #   expiryTime [int] - limit for how old secrets can be (in days)
+    #   journal [obj] *opt - rotation journal (default=None)
+    # Returns:
+    #   rotation [dict] - details of the started rotation (None if the secret isn't due or the key couldn't be started)
+    def start_rotation(self, secretName, expiryTime, journal=None):
+        try:
+            oldVersionNum, oldKeyId = self.check_secret(secretName, expiryTime)
+            if not oldKeyId:
+                return None
+            print("Creating key...")
+            with METRICS.span("rotate key", secretName):
+                displayName, apiTargets, allowedIps = self.credMan.key_config(oldKeyId)
+                if journal:
+                    journal.record(secretName, "key requested", oldVersion=oldVersionNum, oldKeyId=oldKeyId, keyName=displayName)
+                operation = self.credMan.start_key(displayName, apiTargets, allowedIps)
+        except Exception as e:
+            print(f"Error: failed to rotate {secretName}: {e}")
+            return None
+        if not operation:
+            print(f"Error: failed to rotate {secretName}: key creation could not be started")
+            return None
+        return {"secretName": secretName, "oldVersion": oldVersionNum, "keyName": displayName, "oldKeyId": oldKeyId, "operation": operation, "steps": ["key requested"]}
+    # Finish a started rotation once its new key is ready
+    # Arg:
+    #   rotation [dict] - details from start_rotation
+    #   newKeyId [str] - new key uid (None if the key creation failed)
+    #   journal [obj] *opt - rotation journal (default=None)
+    # Returns:
+    #   rotatedSecret [obj] - rotation record (None if it failed)
+    def finish_rotation(self, rotation, newKeyId, journal=None):
+        secretName = rotation["secretName"]
+        if not newKeyId:
+            print(f"Error: failed to rotate {secretName}: new key was not created")
+            return None
+        try:
+            if journal:
+                journal.record(secretName, "key created", newKeyId=newKeyId)
+            rotation = dict(rotation, newKeyId=newKeyId, steps=rotation["steps"] + ["key created"])
+            return self.complete_rotation(rotation, journal)
+        except Exception as e:
+            print(f"Error: failed to rotate {secretName}: {e}")
+            return None
+    # Resume a rotation that an earlier run didn't finish
+    # Arg:
+    #   rotation [dict] - rotation state from the journal
+    #   journal [obj] - rotation journal
+    # Returns:
+    #   rotatedSecret [obj] - rotation record (None if there was nothing to resume or it failed)
+    def resume_rotation(self, rotation, journal):
+        secretName = rotation["secretName"]
+        steps = rotation["steps"]
+        print(f"-----\nResuming {secretName} (last step: {steps[-1]})")
+        try:
+            # The key might have been created without the run recording it, so look for it by name
+            if "key created" not in steps:
+                newKeyId = self.credMan.find_new_key(rotation["keyName"], rotation["oldKeyId"], rotation["requestTime"])
+                if not newKeyId:
+                    print(f"No new key was created for {secretName}, so it will be checked again")
+                    journal.record(secretName, "abandoned")
+                    return None
+                journal.record(secretName, "key created", newKeyId=newKeyId)
+                rotation["newKeyId"] = newKeyId
+                steps.append("key created")
+            # A version added just before the run stopped might not have been recorded
+            if "version added" not in steps:
+                newVersionNum = self.unannotated_version(secretName, rotation["oldVersion"])
+                if newVersionNum:
+                    journal.record(secretName, "version added", newVersion=newVersionNum)
+                    rotation["newVersion"] = newVersionNum
+                    steps.append("version added")
+            return self.complete_rotation(rotation, journal)
+        except Exception as e:
+            print(f"Error: failed to resume {secretName}: {e}")
+            return None
+    # Find a version newer than the given one that doesn't have an annotation yet
+    # Arg:
+    #   secretName [str] - name of secret
+    #   oldVersionNum [str] - version number the rotation started from
+    # Returns:
+    #   newVersionNum [str] - newest version number (None if there isn't an unannotated newer version)
+    def unannotated_version(self, secretName, oldVersionNum):
+        latestVersion = self.latest_version(secretName, enabled=False)
+        if not latestVersion:
+            return None
+        latestVersionNum = latestVersion.get("name").split("/")[-1]
+        if int(latestVersionNum) > int(oldVersionNum) and latestVersionNum not in self.list_annotations(secretName):
+            return latestVersionNum
+        return None
+    # Resume the rotations that an earlier run didn't finish
+    # Arg:
+    #   journal [obj] - rotation journal
+    #   maxWorkers [int] *opt - max number of secrets to resume at the same time (default=1)
+    #   leases [obj] *opt - lease store, so a rotation isn't resumed by two workers at once (default=None)
+    # Returns:
+    #   results [list of obj] - rotation record for each resumed rotation (None if it wasn't rotated)
+    def resume_rotations(self, journal, maxWorkers=1, leases=None):
+        rotations = journal.incomplete()
+        if leases:
+            rotations = [rotation for rotation in rotations if leases.acquire(rotation["secretName"])]
+        if not rotations:
+            return []
+        print(f"Resuming {len(rotations)} interrupted rotation(s)...")
+        def resume(rotation):
+            try:
+                return self.resume_rotation(rotation, journal)
+            finally:
+                if leases:
+                    leases.release(rotation["secretName"])
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            return list(executor.map(resume, rotations))
+    # Rotate a secret, reporting (rather than raising) any errors so other secrets can still be rotated
+    # Arg:
+    #   secretName [str] - name of secret
+    #   expiryTime [int] - limit for how old secrets can be (in days)
+    #   journal [obj] *opt - rotation journal (default=None)
+    # Returns:
+    #   rotatedSecret [obj] - rotation record (None if the secret wasn't rotated)
+    def try_rotate_secret(self, secretName, expiryTime, journal=None):
+        try:
+            return self.rotate_secret(secretName, expiryTime, journal)
+        except Exception as e:
+            print(f"Error: failed to rotate {secretName}: {e}")
+            return None
+    # Get the owner to notify for a rotated secret
+    # Arg:
+    #   secretName [str] - name of secret
+    # Returns:
+    #   owner [str] - notification annotation (None if it doesn't have one)
+    def owner_of(self, secretName):
+        if secretName in self.owners:
+            return self.owners[secretName]
+        # Resumed rotations weren't checked this run, so their owners are looked up
+        try:
+            return self.list_annotations(secretName).get("notification")
+        except GCPError as e:
+            print(f"Error: could not get the owner of {secretName}: {e}")
+            return None
+    # Keep a finished rotation and write it to the report straight away (only called from the calling thread)
+    # Arg:
+    #   rotatedSecret [obj] - rotation record
+    def record_rotation(self, rotatedSecret):
+        rotatedSecret.owner = self.owner_of(rotatedSecret.secretName)
+        self.rotatedSecrets.append(rotatedSecret)
+        if self.report:
+            self.report.write(rotatedSecret)
+    # Rotate secrets, creating all the new keys up front so their creation times overlap
+    # Each secret is updated as soon as its key is ready
+    # Arg:
+    #   secretNames [iterable of str] - names of the secrets to check
+    #   expiryTime [int] - limit for how old secrets can be (in days)
+    #   maxWorkers [int] *opt - max number of secrets to check/update at the same time (default=1)
+    #   journal [obj] *opt - rotation journal (default=None)
+    # Returns:
+    #   generator of rotation records in the order the secrets were listed (None if it failed),
+    #   each handed back as soon as it and the ones before it have finished
+    def rotate_secrets_pipelined(self, secretNames, expiryTime, maxWorkers=1, journal=None):
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            # Check the secrets and submit a key creation for each one that is due
+            started = [rotation for rotation in executor.map(lambda secretName: self.start_rotation(secretName, expiryTime, journal), secretNames) if rotation]
+            print(f"-----\nWaiting for {len(started)} key(s) to be created...")
+            # Update each secret as soon as its key is ready (wait_keys hands back every index once)
+            futures = {}
+            nextIndex = 0
+            for index, newKeyId in self.credMan.wait_keys([rotation["operation"] for rotation in started], maxWorkers):
+                futures[index] = executor.submit(self.finish_rotation, started[index], newKeyId, journal)
+                while nextIndex in futures and futures[nextIndex].done():
+                    yield futures.pop(nextIndex).result()
+                    nextIndex += 1
+            for index in range(nextIndex, len(started)):
+                yield futures.pop(index).result()
+    # Rotate secrets that are older than a specified number of days
+    # Each secret's steps run in order, but separate secrets can be rotated in parallel
+    # Arg:
+    #   expiryTime [int] - limit for how old secrets can be (in days)
+    #   maxWorkers [int] *opt - max number of secrets to rotate at the same time (default=1)
+    #   pageSize [int] *opt - number of secrets fetched per page (default=None)
+    #   asyncKeys [bool] *opt - set to True to create all the new keys before waiting on any of them (default=False)
+    #   schedule [obj] *opt - rotation schedule, so only secrets that are due get checked (default=None)
+    #   journal [obj] *opt - rotation journal; rotations an earlier run didn't finish are resumed first (default=None)
+    #   resumeOnly [bool] *opt - set to True to only resume unfinished rotations, without listing the secrets (default=False)
+    #   shard [tuple of int] *opt - (shard index, shard count) to only rotate this worker's share of the secrets (default=None)
+    #   leases [obj] *opt - lease store, so a secret is never rotated by two workers at once (default=None)
+    def rotate_secrets(self, expiryTime, maxWorkers=1, pageSize=None, asyncKeys=False, schedule=None, journal=None, resumeOnly=False, shard=None, leases=None):
+        # Finish what an earlier run started
+        if journal:
+            for result in self.resume_rotations(journal, maxWorkers, leases):
+                if result:
+                    self.record_rotation(result)
+            if resumeOnly:
+                return
+        counts = {"secrets": 0, "api_key": 0, "skipped": 0, "otherShards": 0, "leased": 0}
+        reconcile = schedule is None or schedule.reconcile_due()
+        # secretName -> etag for the listed api key secrets
+        listed = {}
+        # secretName -> annotations for the listed api key secrets (kept when every secret is checked)
+        annotations = {}
+        # Get secrets as each page is listed
+        # Only api key secrets need to be checked (the type comes from the listing)
+        def api_key_secrets():
+            for record in METRICS.timed_iter(self.iter_records(pageSize), phase="discover"):
+                counts["secrets"] += 1
+                if record.type == "api_key":
+                    # Leave the secrets in other shards to their workers
+                    if shard and shard_of(record.name, shard[1]) != shard[0]:
+                        counts["otherShards"] += 1
+                        continue
+                    counts["api_key"] += 1
+                    listed[record.name] = record.etag
+                    if reconcile:
+                        annotations[record.name] = record.annotations
+                    # Skip secrets the schedule knows aren't due yet
+                    if not reconcile and not schedule.is_due(record.name, record.etag, expiryTime):
+                        counts["skipped"] += 1
+                        continue
+                    # A rotation that couldn't be resumed is left for the next run to repair (rather than starting a new one)
+                    if journal and journal.is_incomplete(record.name):
+                        print(f"Skipping {record.name}: it has an unfinished rotation")
+                        continue
+                    # Another worker might already be rotating the secret
+                    if leases and not leases.acquire(record.name):
+                        print(f"Skipping {record.name}: another worker holds its lease")
+                        counts["leased"] += 1
+                        continue
+                    yield record.name
+        # Rotate a secret, giving up its lease as soon as it is done
+        def rotate(secretName):
+            try:
+                return self.try_rotate_secret(secretName, expiryTime, journal)
+            finally:
+                if leases:
+                    leases.release(secretName)
+        # Only the calling thread records the results, as each one finishes
+        # (with asyncKeys the leases are held until the run ends)
+        if asyncKeys:
+            for result in self.rotate_secrets_pipelined(api_key_secrets(), expiryTime, maxWorkers, journal):
+                if result:
+                    self.record_rotation(result)
+        elif maxWorkers > 1:
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                # Secrets are listed (and leased) only as the rotations ahead of them finish, and the results come back in
+                # the same order as the secrets, so the report order doesn't depend on timing
+                for result in bounded_map(executor, rotate, api_key_secrets(), 2 * maxWorkers):
+                    if result:
+                        self.record_rotation(result)
+        else:
+            for secretName in api_key_secrets():
+                result = rotate(secretName)
+                if result:
+                    self.record_rotation(result)
+        # There might not be any secrets in the project
+        if not counts["secrets"]:
+            print("Error: There are no secrets in this project")
+            return
+        print(f"{counts['api_key']} of {counts['secrets']} secret(s) are api_key secrets" + (f" in shard {shard[0]}/{shard[1]}" if shard else ""))
+        if shard:
+            print(f"Left {counts['otherShards']} api_key secret(s) to other shards and skipped {counts['leased']} leased by other workers")
+        if schedule:
+            print("Full reconcile: checked every api_key secret" if reconcile else f"Skipped {counts['skipped']} api_key secret(s) that aren't due")
+        if schedule:
+            schedule.save(self.schedule_entries(listed), set(listed) if reconcile else None)
+        # Match the keys against the annotations once every api key secret has been seen (a shard only sees its own)
+        if reconcile and annotations and not shard:
+            self.report_unmatched_keys(annotations)
+    # Find keys that no api key secret references, and current annotations that point to keys that no longer exist
+    # Older versions' annotations are skipped (their keys are deleted when the secret is rotated)
+    # Arg:
+    #   annotations [dict] - secret name -> annotations (from the listing)
+    # Returns:
+    #   orphanedKeys [list of dict] - keys that aren't referenced by any annotation
+    #   danglingAnnotations [list of tuple] - (secret name, version, key uid) for current keys that don't exist
+    def unmatched_keys(self, annotations):
+        keys = self.credMan.key_inventory()
+        referenced = set()
+        # secretName -> (version, key uid) for the latest annotated version
+        currentKeys = {}
+        for secretName, secretAnnotations in annotations.items():
+            versions = {version: keyId for version, keyId in secretAnnotations.items() if version.isdigit()}
+            referenced.update(versions.values())
+            if versions:
+                currentKeys[secretName] = max(versions.items(), key=lambda item: int(item[0]))
+        # The listing was taken before this run's rotations, and their new keys aren't in the inventory
+        newKeys = set()
+        for rotatedSecret in self.rotatedSecrets:
+            newKeys.add(rotatedSecret.newKeyId)
+            currentKeys[rotatedSecret.secretName] = (rotatedSecret.newVersion, rotatedSecret.newKeyId)
+        orphanedKeys = [key for keyId, key in keys.items() if keyId not in referenced and keyId not in newKeys]
+        danglingAnnotations = [(secretName, version, keyId) for secretName, (version, keyId) in sorted(currentKeys.items())
+                               if keyId not in keys and keyId not in newKeys]
+        return orphanedKeys, danglingAnnotations
+    # Print the keys and annotations that don't match up
+    # Arg:
+    #   annotations [dict] - secret name -> annotations (from the listing)
+    def report_unmatched_keys(self, annotations):
+        orphanedKeys, danglingAnnotations = self.unmatched_keys(annotations)
+        print(f"{len(orphanedKeys)} key(s) aren't referenced by any api_key secret")
+        for key in orphanedKeys:
+            print(f"  Orphaned key: {key.get('uid')} ({key.get('displayName')})")
+        print(f"{len(danglingAnnotations)} api_key secret(s) point to keys that no longer exist")
+        for secretName, version, keyId in danglingAnnotations:
+            print(f"  Dangling annotation: {secretName} version {version} -> {keyId}")
+    # Get the schedule entries for the secrets checked this run
+    # Arg:
+    #   listed [dict] - secret name -> etag from the listing
+    # Returns:
+    #   entries [dict] - secret name -> (etag, latest version create time)
+    def schedule_entries(self, listed):
+        entries = {name: (listed.get(name), createTime) for name, createTime in self.checkedVersions.items()}
+        # In test mode nothing was really rotated, so the checked versions are still the latest ones
+        if not self.test:
+            now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            for rotatedSecret in self.rotatedSecrets:
+                # The annotation update gave the secret a new etag (cached from the update response)
+                secretDetails = self.cache.get_secret(rotatedSecret.secretName) or {}
+                entries[rotatedSecret.secretName] = (secretDetails.get("etag"), now)
+        return entries
 
 # Class to manage keys in GCP
 class KeyManager:
@@ -290,24 +2318,23 @@ class KeyManager:
     #   projectId [str] - name of GCP project
     #   debug [bool] *opt - set to True to print debugging statements (default=False)
     #   test [bool] *opt - set to True to testing mode (default=False)
-    def __init__(self, projectId, debug=False, test=False):
+    #   backend [str or obj] *opt - backend name in BACKENDS or backend instance (default=gcloud)
+    def __init__(self, projectId, debug=False, test=False, backend="gcloud"):
         self.projectId = projectId
-        self.GCP = GCP(self.projectId, debug=debug)
+        self.GCP = get_backend(self.projectId, backend, debug)
         self.debugger = Logger(debug)
         self.test = test
+        # uid -> key config for every key in the project (listed on first use)
+        self.keyIndex = None
+        self.keyIndexLock = threading.Lock()
     # Get keys in the project
     # Arg:
     #   limit [int] *opt - limit on how many secrets are returned (default=None)
     # Returns:
     #   keys [list of dict] - list of keys
     def list_keys(self, limit=None):
-        # Initial command to list keys
-        cmd = "services api-keys list --sort-by=~createTime"
-        # If limit flag is set, then add limit flag to limit returned keys
-        if limit:
-            cmd += f"--limit={limit}"
         # Get details for key(s)
-        keys = self.GCP.exec(cmd)
+        keys = self.GCP.list_keys(limit)
         self.debugger.print(keys)
         return keys
     # Get the string value for a key
@@ -316,17 +2343,31 @@ class KeyManager:
     # Return:
     #   keyString [str] - key string value
     def get_key_string(self, keyId):
+        # if in test mode, return dummy key string
+        if self.test:
+            return "KeyStringFromKeyMan"
         # Get the key string value
-        keyString = self.GCP.exec(f"services api-keys get-key-string {keyId}").get("keyString")
+        keyString = self.GCP.get_key_string(keyId).get("keyString")
         return keyString
+    # Get every key in the project indexed by uid
+    # The keys are listed once (on first use) so each rotation doesn't need its own describe call
+    # Returns:
+    #   keyIndex [dict] - key uid -> key configuration
+    def key_inventory(self):
+        with self.keyIndexLock:
+            if self.keyIndex is None:
+                self.keyIndex = {key.get("uid"): key for key in self.list_keys() or []}
+            return self.keyIndex
     # Get the config for a key
     # Arg:
     #   keyId [str] - key uid
     # Return:
     #   keyConfig [dict] - key configuration
     def get_key_config(self, keyId):
-        # Get the key config
-        keyConfig = self.GCP.exec(f"services api-keys describe {keyId}")
+        # Get the key config from the inventory (keys created since it was listed are described instead)
+        keyConfig = self.key_inventory().get(keyId)
+        if keyConfig is None:
+            keyConfig = self.GCP.describe_key(keyId)
         self.debugger.print(keyConfig)
         return keyConfig
     # Create a key
@@ -338,20 +2379,6 @@ class KeyManager:
     #   keyId [str] - key uId
     #   keyString [str] - key string value
     def create_key(self, keyName, apiTargets=None, allowedIps=None):
-        # Initial command to create key
-        cmd = f"gcloud services api-keys create --display-name='{keyName}' --format=json --project={self.projectId}"
-        flags = []
-        # If there are api targets, then add api-target flag(s) to add api targets
-        if apiTargets:
-            flags += [f"--api-target='{target}'" for target in apiTargets]
-        # If there are allowed ips, then add allowed-ips flag to add allowed ips
-        if allowedIps:
-            flags.append(f"--allowed-ips='{allowedIps}'")
-        self.debugger.print(flags)
-        # Add flags to command
-        cmd += " ".join(flags)
-        # Move std.error to std.output (which has key string)
-        cmd += " 2>1"
         # if in test mode, print action and return dummy key id and string
         if self.test:
             print(f"'Creating' new key with\n  apiTargets:{apiTargets}\n  allowedIps: {allowedIps}")
@@ -359,7 +2386,7 @@ class KeyManager:
             keyString = "KeyStringFromKeyMan"
         # otherwise, execute key creation command
         else:
-            keyId = self.GCP.custom_exec(cmd).get("response").get("uid")
+            keyId = self.GCP.create_key(keyName, apiTargets, allowedIps).get("uid")
             keyString = self.get_key_string(keyId)
         self.debugger.print(keyId)
         return keyId, keyString
@@ -372,18 +2399,99 @@ class KeyManager:
             print(f"'Deleting' key '{keyId}'")
         # otherwise, execute key deletion command
         else:
-            self.GCP.exec(f"services api-keys delete {keyId}")
+            self.GCP.delete_key(keyId)
+            with self.keyIndexLock:
+                if self.keyIndex is not None:
+                    self.keyIndex.pop(keyId, None)
 
-    # Rotate a key
+    # Start creating a key without waiting for it to be ready
+    # Arg:
+    #   keyName [str] - key display name
+    #   apiTargets *opt - api target restrictions (default=None)
+    #   allowedIps *opt - ip restrictions (default=None)
+    # Return:
+    #   operation [dict] - long running operation for the key creation (None if it couldn't be started)
+    def start_key(self, keyName, apiTargets=None, allowedIps=None):
+        # if in test mode, print action and return a finished dummy operation
+        if self.test:
+            print(f"'Creating' new key with\n  apiTargets:{apiTargets}\n  allowedIps: {allowedIps}")
+            return {"name": "operations/OperationFromKeyMan", "done": True, "response": {"uid": "KeyIdFromKeyMan"}}
+        # otherwise, submit the key creation
+        operation = self.GCP.create_key_async(keyName, apiTargets, allowedIps)
+        self.debugger.print(operation)
+        return operation
+    # Wait for key creations to finish, polling the unfinished operations together in rounds
     # Arg:
+    #   operations [list of dict] - operations from start_key
+    #   maxWorkers [int] *opt - max number of operations to poll at the same time (default=1)
+    #   timeout [int] *opt - seconds to wait before giving up on the remaining operations (default=120)
+    # Returns:
+    #   generator of (index, keyId) as each operation finishes (keyId is None if the creation failed)
+    def wait_keys(self, operations, maxWorkers=1, timeout=120):
+        pending = dict(enumerate(operations))
+        deadline = time.monotonic() + timeout
+        delay = 0.25
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            while pending:
+                # Hand back every operation that has finished
+                finished = [index for index, operation in pending.items() if operation.get("done")]
+                for index in finished:
+                    operation = pending.pop(index)
+                    if operation.get("error"):
+                        print(f"Error: key creation {operation.get('name')} failed: {operation.get('error').get('message')}")
+                        yield index, None
+                    else:
+                        yield index, operation.get("response", {}).get("uid")
+                if not pending:
+                    return
+                if time.monotonic() > deadline:
+                    for index, operation in pending.items():
+                        print(f"Error: key creation {operation.get('name')} did not finish in {timeout}s")
+                        yield index, None
+                    return
+                # Back off while nothing is finishing
+                delay = 0.25 if finished else min(delay * 2, 2)
+                time.sleep(delay)
+                # Poll the rest (keeping the last known state if a poll fails)
+                indexes = list(pending)
+                polled = executor.map(lambda index: self.poll_key(pending[index]), indexes)
+                for index, operation in zip(indexes, polled):
+                    pending[index] = operation or pending[index]
+    # Get the latest state of a key creation
+    # Arg:
+    #   operation [dict] - operation from start_key
+    # Returns:
+    #   operation [dict] - latest state of the operation (None if it couldn't be fetched)
+    def poll_key(self, operation):
+        try:
+            return self.GCP.get_operation(operation.get("name"))
+        except GCPError as e:
+            print(f"Error: could not check key creation {operation.get('name')}: {e}")
+            return None
+    # Find a key created for a rotation that didn't record it (e.g. the run stopped while the key was being created)
+    # Arg:
+    #   keyName [str] - display name of the old (and new) key
     #   oldKeyId [str] - old key uid
+    #   requestTime [str] - when the key was requested (RFC 3339)
+    # Returns:
+    #   keyId [str] - uid of the newest matching key (None if there isn't one)
+    def find_new_key(self, keyName, oldKeyId, requestTime):
+        # Allow for the local clock being a little ahead of GCP
+        since = datetime.fromisoformat(requestTime.replace("Z", "+00:00")) - timedelta(minutes=5)
+        candidates = [key for key in self.list_keys() or [] if key.get("displayName") == keyName and key.get("uid") != oldKeyId
+                      and key.get("createTime") and datetime.fromisoformat(key.get("createTime").replace("Z", "+00:00")) >= since]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda key: key.get("createTime")).get("uid")
+    # Get the config needed to recreate a key
+    # Arg:
+    #   keyId [str] - key uid
     # Returns:
     #   name - key display name
-    #   newKeyId [str] - new key uid
-    #   newKeyString [str] - new key string
-    def rotate_key(self, oldKeyId):
-        # Get old key configuration info
-        keyInfo = self.get_key_config(oldKeyId)
+    #   apiTargets [list of str] - api target restrictions
+    #   allowedIps [str] - ip restrictions
+    def key_config(self, keyId):
+        keyInfo = self.get_key_config(keyId)
         name = keyInfo.get("displayName")
         restrictions = keyInfo.get("restrictions", {})
         targets = restrictions.get("apiTargets", None)
@@ -392,6 +2500,17 @@ class KeyManager:
         self.debugger.print(apiTargets)
         allowedIps = ",".join(ips) if ips else None
         self.debugger.print(allowedIps)
+        return name, apiTargets, allowedIps
+    # Rotate a key
+    # Arg:
+    #   oldKeyId [str] - old key uid
+    # Returns:
+    #   name - key display name
+    #   newKeyId [str] - new key uid
+    #   newKeyString [str] - new key string
+    def rotate_key(self, oldKeyId):
+        # Get old key configuration info
+        name, apiTargets, allowedIps = self.key_config(oldKeyId)
         # Create the new key
         newKeyId, newKeyString = self.create_key(name, apiTargets, allowedIps)
         # Delete the old key
@@ -399,89 +2518,416 @@ class KeyManager:
         return name, newKeyId, newKeyString
 
 # Send email notification with changed resources using AWS SES
+# Sends go through the ses.send rate limiter, so throttled sends are slowed down and retried
 # Arg:
 #   sesClient [obj] - boto3 ses client instance
 #   sender [str] - SES sender
 #   recipients [list of str] - recipient email(s)
 #   subject [str] - email subject
 #   body [str] - email body
+# Returns:
+#   sent [bool] - True if SES accepted the email
 def send_email(sesClient, sender, recipients, subject, body):
+    charset = "UTF-8"
+    # Make one send (SES errors are raised as SESError so the rate limiter knows which ones to retry)
+    def send():
+        try:
+            return sesClient.send_email(Destination={ "ToAddresses": recipients },
+                                        Message={ "Body": { "Text": { "Charset": charset, "Data": body } },
+                                                  "Subject": { "Charset": charset, "Data": subject } },
+                                        Source=sender)
+        except Exception as e:
+            raise SESError.from_ses(e) from e
     try:
         print("sending notification to: {}".format(recipients))
-        charset = "UTF-8"
-        res = sesClient.send_email(Destination={ "ToAddresses": recipients },
-                                    Message={ "Body": { "Text": { "Charset": charset, "Data": body } },
-                                              "Subject": { "Charset": charset, "Data": subject } },
-                                    Source=sender)
+        with METRICS.timer("ses.send"):
+            res = LIMITERS["ses.send"].call(send)
         if "MessageId" in res:
             print("Notification sent successfully: {}".format(res["MessageId"]))
-        else:
-            print("Notification may not have been sent: {}".format(res))
+            return True
+        print("Notification may not have been sent: {}".format(res))
     except Exception as e:
         print("Failed to send email: {}".format(e))
+    return False
+
+# Class to write the report as CSV, one row as each rotation finishes
+# The file is opened once and buffered. It is flushed when the report is closed (or asked to, e.g. after a batch), and the
+# report is closed even if the run stops partway, so the rows written so far are kept
+class CsvReport:
+    # Init Arg:
+    #   fileName [str] - output file name
+    #   withProject [bool] *opt - set to True to add a project column (for runs over several projects) (default=False)
+    def __init__(self, fileName, withProject=False):
+        self.withProject = withProject
+        self.rows = 0
+        self.failures = []
+        self.file = open(fileName, "w")
+        # Begin the file and write the headers
+        self.file.write(("Project, " if withProject else "") + "Secret Name, Old Secret Version, New Secret Version, Key Name, Old Key Id, New Key Id\n")
+    # Arg:
+    #   rotatedSecret [obj] - rotation record
+    def write(self, rotatedSecret):
+        row = f"{rotatedSecret.projectId}, " if self.withProject else ""
+        row += ", ".join(f"{getattr(rotatedSecret, field)}" for field in RotationRecord.fields)
+        self.file.write(row + "\n")
+        self.rows += 1
+    # Arg:
+    #   failure [dict] - failed rotation (secretName, stage, error and unstoredKeyId), listed after the rotated secrets
+    def fail(self, failure):
+        self.failures.append(failure)
+    def flush(self):
+        self.file.flush()
+    def close(self):
+        # if no resources have been changed, report that
+        if not self.rows:
+            self.file.write("No resources have been changed")
+        if self.failures:
+            self.file.write(("\n" if not self.rows else "") + "\nFailed Rotations\nSecret Name, Failed Stage, Unstored Key Id, Error\n")
+            for failure in self.failures:
+                error = " ".join(failure["error"].split())
+                self.file.write(f"{failure['secretName']}, {failure['stage']}, {failure['unstoredKeyId'] or ''}, {error}\n")
+        self.file.close()
 
-# Write changed resources to a file
+# Class to write the report as JSON lines (one object per rotated secret, with its owner) as each rotation finishes
+# (buffered like CsvReport)
+class JsonlReport:
+    # Init Arg:
+    #   fileName [str] - output file name
+    def __init__(self, fileName):
+        self.file = open(fileName, "w")
+    # Arg:
+    #   rotatedSecret [obj] - rotation record
+    def write(self, rotatedSecret):
+        self.file.write(json.dumps(dict(rotatedSecret.to_dict(), owner=rotatedSecret.owner)) + "\n")
+    # Arg:
+    #   failure [dict] - failed rotation (secretName, stage, error and unstoredKeyId)
+    def fail(self, failure):
+        self.file.write(json.dumps({"secretName": failure["secretName"], "failedStage": failure["stage"], "unstoredKeyId": failure["unstoredKeyId"],
+                                    "error": failure["error"]}) + "\n")
+    def flush(self):
+        self.file.flush()
+    def close(self):
+        self.file.close()
+
+# Class to collect the rotated secrets for the emails, which are sent when the report is closed
+class EmailReport:
+    # Init Arg:
+    #   session [obj] - boto3 session
+    #   outputType [dict] - specifies sender/recipient(s) emails
+    #   test [bool] - set to True if in testing mode
+    def __init__(self, session, outputType, test):
+        self.session = session
+        self.outputType = outputType
+        self.test = test
+        self.rotatedSecrets = []
+    # Arg:
+    #   rotatedSecret [obj] - rotation record
+    def write(self, rotatedSecret):
+        self.rotatedSecrets.append(rotatedSecret)
+    def close(self):
+        notify_owners(self.rotatedSecrets, self.session, self.outputType, self.test)
+
+# Class to export the metrics while the run goes on (at most every interval seconds) and once more at the end
+# so a long run can be watched through the metrics files
+class MetricsReport:
+    # Init Arg:
+    #   outputType [dict] - specifies metrics file names
+    #   interval [float] *opt - min seconds between exports during the run (default=30)
+    def __init__(self, outputType, interval=30):
+        self.metricsFile = outputType.get("metricsFile")
+        self.promFile = outputType.get("promFile")
+        self.interval = interval
+        self.lastExport = time.monotonic()
+    # Arg:
+    #   rotatedSecret [obj] - rotation record
+    def write(self, rotatedSecret):
+        if time.monotonic() - self.lastExport >= self.interval:
+            self.export()
+    def export(self):
+        if self.metricsFile:
+            METRICS.export_json(self.metricsFile)
+        if self.promFile:
+            METRICS.export_prometheus(self.promFile)
+        self.lastExport = time.monotonic()
+    def close(self):
+        self.export()
+
+# Class to pass each rotated secret to every report sink as it finishes
+class RotationReport:
+    # Init Arg:
+    #   sinks [list of obj] - report sinks (each with write and close), closed in order
+    def __init__(self, sinks):
+        self.sinks = sinks
+    # Arg:
+    #   rotatedSecret [obj] - rotation record
+    def write(self, rotatedSecret):
+        for sink in self.sinks:
+            sink.write(rotatedSecret)
+    # Pass a failed rotation to the sinks that list failures (the file reports)
+    # Arg:
+    #   failure [dict] - failed rotation (secretName, stage, error and unstoredKeyId)
+    def fail(self, failure):
+        for sink in self.sinks:
+            if hasattr(sink, "fail"):
+                sink.fail(failure)
+    # Write out what the file reports have buffered so far (e.g. when a batch finishes)
+    def flush(self):
+        for sink in self.sinks:
+            if hasattr(sink, "flush"):
+                sink.flush()
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+# Open the report sinks for a run
 # Arg:
-#   sMan [obj] - secret manager instance
-#   fileName [str] - output file name
-def write_file(sMan, fileName):
-    # Begin the file and write the headers
-    with open(fileName, "w") as file:
-        file.write("Secret Name, Old Secret Version, New Secret Version, Key Name, Old Key Id, New Key Id\n")
-    # if no resources have been changed, report that
-    if not sMan.rotatedSecrets:
-        with open(fileName, "a") as file:
-            file.write("No resources have been changed")
-    # otherwise, report changed resources
-    else:
-        for secretInfo in sMan.rotatedSecrets:
-            with open(fileName, "a") as file:
-                file.write(f"{secretInfo['secretName']}")
-                file.write(f", {secretInfo['oldVersion']}")
-                file.write(f", {secretInfo['newVersion']}")
-                file.write(f", {secretInfo['keyName']}")
-                file.write(f", {secretInfo['oldKeyId']}")
-                file.write(f", {secretInfo['newKeyId']}\n")
+#   outputType [dict] - specifies output file name (.csv or .jsonl), sender/recipient(s) emails and metrics file names
+#   session [obj] - boto3 session (only used if there is a sender)
+#   test [bool] - set to True if in testing mode
+#   withProject [bool] *opt - set to True to add a project column to the CSV report (default=False)
+# Returns:
+#   report [obj] - report to write each rotated secret to (close it at the end of the run)
+def open_report(outputType, session, test, withProject=False):
+    sinks = []
+    fileName = outputType.get("fileName")
+    if fileName:
+        sinks.append(JsonlReport(fileName) if fileName.endswith(".jsonl") else CsvReport(fileName, withProject))
+    if outputType.get("sender"):
+        sinks.append(EmailReport(session, outputType, test))
+    if outputType.get("metricsFile") or outputType.get("promFile"):
+        sinks.append(MetricsReport(outputType))
+    return RotationReport(sinks)
+
+# Authenticate gcloud with a service account key stored in AWS Secrets Manager
+# Arg:
+#   session [obj] - boto3 session
+#   secretName [str] - secret that contains service account key file
+#   keyFile [str] *opt - where the key file is written while gcloud reads it (default=tmp.json)
+def authenticate(session, secretName, keyFile="tmp.json"):
+    smClient = session.client("secretsmanager")
+    with METRICS.timer("secretsmanager.get"):
+        response = smClient.get_secret_value(SecretId=secretName)["SecretString"]
+    # Write secret to a file
+    with open(keyFile, "w") as f:
+        f.write(response)
+    # Authenticate with gcloud service account (the key file is removed even if gcloud fails)
+    try:
+        GCLOUD.run(["gcloud", "auth", "activate-service-account", f"--key-file={keyFile}", "--project=ix-sandbox"])
+    finally:
+        os.remove(keyFile)
+    # Get a token for the new account now, before any parallel calls need it
+    GCLOUD.warm(force=True)
+
+# Write the report, send the notifications and export the metrics for rotations that have already finished
+# (e.g. ones merged from several processes)
+# Arg:
+#   rotatedSecrets [list of obj] - rotation records
+#   session [obj] - boto3 session
+#   outputType [dict] - specifies output file name, sender/recipient(s) emails and metrics file names
+#   test [bool] - set to True if in testing mode
+#   withProject [bool] *opt - set to True to add a project column to the report (default=False)
+def finish_run(rotatedSecrets, session, outputType, test, withProject=False):
+    report = open_report(outputType, session, test, withProject)
+    for rotatedSecret in rotatedSecrets:
+        report.write(rotatedSecret)
+    report.close()
 
 # Arg:
 #   projectId [str] - name of GCP project
 #   expiryTime [int] - limit for how old secrets can be (in days)
-#   outputType [dict] - specifies output file name and sender/recipient(s) emails
+#   outputType [dict] - specifies output file name, sender/recipient(s) emails and metrics file names
 #   profileName [str] - boto3 profile to send email (default=None)
 #   regionName [str] - aws region to access secret (default=us-east-1)
 #   secretName [str] - secret that contains service account key file (default=None)
 #   debug [bool] *opt - set to True to print debugging statements (default=False)
 #   test [bool] *opt - set to True to testing mode (default=False)
-def main(projectId, expiryTime, outputType, profileName=None, regionName="us-east-1", secretName=None, debug=False, test=False):
-    # Initialize the key and secret manager instances
-    kMan = KeyManager(projectId, debug, test)
-    sMan = SecretManager(projectId, kMan, debug, test)
+#   backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#   maxWorkers [int] *opt - max number of secrets to rotate at the same time (default=1)
+#   pageSize [int] *opt - number of secrets fetched per page (default=None)
+#   asyncKeys [bool] *opt - set to True to create all the new keys before waiting on any of them (default=False)
+#   rateLimits [dict] *opt - api family -> starting calls per second (default=None)
+#   schedule [bool] *opt - set to True to only check secrets that are due, using a saved rotation schedule (default=False)
+#   scheduleDir [str] *opt - directory for the rotation schedule (default=~/.cache/credential-manager)
+#   reconcileDays [float] *opt - days between full reconciles of the rotation schedule (default=7)
+#   journal [bool] *opt - set to True to journal rotation steps and resume rotations an earlier run didn't finish (default=False)
+#   journalDir [str] *opt - directory for the rotation journal (default=~/.cache/credential-manager)
+#   resumeOnly [bool] *opt - set to True to only resume unfinished rotations (default=False)
+#   shard [tuple of int] *opt - (shard index, shard count) to only rotate this worker's share of the secrets (default=None)
+#   leaseDir [str] *opt - directory shared by the workers for the secret leases (default=~/.cache/credential-manager/leases)
+#   leaseSeconds [float] *opt - how long a lease lasts without being renewed (default=120)
+#   partialReport [str] *opt - write this worker's results to this JSON file for merge_reports.py, instead of reporting and notifying (default=None)
+#   inventory [str] *opt - inventory file (from secret_events.py) to read the secrets from instead of listing the project (default=None)
+def main(projectId, expiryTime, outputType, profileName=None, regionName="us-east-1", secretName=None, debug=False, test=False, backend="gcloud", maxWorkers=1, pageSize=None, asyncKeys=False, rateLimits=None, schedule=False, scheduleDir=None, reconcileDays=7, journal=False, journalDir=None, resumeOnly=False, shard=None, leaseDir=None, leaseSeconds=120, partialReport=None, inventory=None):
+    # Set the starting rates for the api families
+    if rateLimits:
+        set_rate_limits(rateLimits)
+    # Initialize the key and secret manager instances (sharing one backend)
+    gcp = get_backend(projectId, backend, debug)
+    # Read the secrets from an inventory kept current by secret_events.py instead of listing the project
+    # (imported here since secret_events imports this module)
+    if inventory:
+        from secret_events import inventory_backend
+        try:
+            gcp = inventory_backend(inventory, gcp)
+        except (OSError, ValueError) as e:
+            print(f"Error: could not read inventory {inventory}: {e}")
+            return
+    kMan = KeyManager(projectId, debug, test, gcp)
+    sMan = SecretManager(projectId, kMan, debug, test, gcp)
     # Access secret for GCP service account for running in EC2 or ECS
+    # boto3 is imported here (it is slow to import) so importing this module stays cheap, e.g. for a Lambda cold start
+    import boto3
     if profileName:
         session = boto3.Session(profile_name=profileName, region_name=regionName)
     else:
         session = boto3.Session(region_name=regionName)
     if secretName:
-        smClient = session.client("secretsmanager")
-        response = smClient.get_secret_value(SecretId=secretName)["SecretString"]
-        # Write secret to a file
-        fileName = "tmp.json"
-        with open(fileName, "w") as f:
-            f.write(response)
-        # Authenticate with gcloud service account
-        _ = os.popen(f"gcloud auth activate-service-account --key-file={fileName} --project 'ix-sandbox'; rm {fileName}").read()
-    # Rotate any secrets that are older than the desired expiry time
-    sMan.rotate_secrets(expiryTime)
+        authenticate(session, secretName)
+    # Each shard keeps its own schedule and journal, while the leases are shared by every worker on the project
+    stateName = f"{projectId}-shard{shard[0]}of{shard[1]}" if shard else projectId
+    # Rotate any secrets that are older than the desired expiry time (nothing changes in test mode, so there is nothing to journal or lease)
+    try:
+        rotationJournal = RotationJournal(stateName, journalDir) if (journal or resumeOnly) and not test else None
+    except JournalInUse as e:
+        print(f"Error: {e}")
+        return
+    # Rotations that are being resumed read their secrets live (the inventory might not have their last steps yet)
+    if inventory and rotationJournal:
+        gcp.bypass(rotation["secretName"] for rotation in rotationJournal.incomplete())
+    leases = LeaseStore(projectId, leaseDir, leaseSeconds).start() if (shard or leaseDir) and not test else None
+    # Each rotation is written to the report as it finishes (the report and notifications are left to the merge step for a partial report)
+    sMan.report = open_report(outputType, session, test) if not partialReport else None
+    try:
+        sMan.rotate_secrets(expiryTime, maxWorkers, pageSize, asyncKeys, RotationSchedule(stateName, scheduleDir, reconcileDays) if schedule else None, rotationJournal, resumeOnly, shard, leases)
+    finally:
+        if leases:
+            leases.close()
+        # Finish the report, notify and export metrics, even if the run stopped partway (the keys that were rotated have changed)
+        if sMan.report:
+            sMan.report.close()
+        if rotationJournal:
+            rotationJournal.close()
+    sMan.debugger.print(f"Metadata cache: {sMan.cache.stats()}")
     """
     # Revoke GCP credentials
     _ = os.popen(f"gcloud auth revoke").read()
     """
-    # Write results to output file
-    if outputType.get("fileName"):
-        write_file(sMan, fileName)
-    # Send email(s)
-    if outputType.get("sender"):
-        # set up ses client
+    if partialReport:
+        write_partial_report(partialReport, projectId, shard, sMan.rotatedSecrets)
+
+# Write one worker's results so merge_reports.py can combine them into one report and one set of notifications
+# Arg:
+#   fileName [str] - partial report file (JSON)
+#   projectId [str] - name of GCP project
+#   shard [tuple of int] - (shard index, shard count) of the worker (None if it wasn't sharded)
+#   rotatedSecrets [list of obj] - rotation records
+def write_partial_report(fileName, projectId, shard, rotatedSecrets):
+    report = {"projectId": projectId, "shard": list(shard) if shard else None, "rotatedSecrets": [rotatedSecret.to_dict() for rotatedSecret in rotatedSecrets],
+              "owners": [rotatedSecret.owner for rotatedSecret in rotatedSecrets], "metrics": METRICS.snapshot()}
+    # Written in one step, so the merge never reads half a report
+    tmpName = f"{fileName}.tmp"
+    with open(tmpName, "w") as file:
+        json.dump(report, file, indent=2)
+    os.replace(tmpName, fileName)
+    print(f"Wrote partial report for {len(rotatedSecrets)} rotated secret(s) to {fileName}")
+
+# Parse a shard given as index/count, e.g. 0/4
+# Arg:
+#   value [str] - shard index and count
+# Returns:
+#   shard [tuple of int] - (shard index, shard count)
+def parse_shard(value):
+    try:
+        shardIndex, shardCount = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard should look like 0/4, not {value}")
+    if shardCount < 1 or not 0 <= shardIndex < shardCount:
+        raise argparse.ArgumentTypeError(f"shard index should be from 0 to {shardCount - 1}")
+    return shardIndex, shardCount
+
+# Rotate the secrets in one project (run in its own worker process by main_projects)
+# Each process has its own rate limiters, which matches quotas being per project
+# Arg:
+#   projectId [str] - name of GCP project
+#   (see main for the other args)
+# Returns:
+#   result [dict] - rotation records (tagged with the project) and the metrics for the project
+def rotate_project(projectId, expiryTime, debug=False, test=False, backend="gcloud", maxWorkers=1, pageSize=None, asyncKeys=False, rateLimits=None, schedule=False, scheduleDir=None, reconcileDays=7, journal=False, journalDir=None, resumeOnly=False):
+    if rateLimits:
+        set_rate_limits(rateLimits)
+    gcp = get_backend(projectId, backend, debug)
+    kMan = KeyManager(projectId, debug, test, gcp)
+    sMan = SecretManager(projectId, kMan, debug, test, gcp)
+    print(f"=====\nProject: {projectId}")
+    try:
+        rotationJournal = RotationJournal(projectId, journalDir) if (journal or resumeOnly) and not test else None
+    except JournalInUse as e:
+        print(f"Error: {e}")
+        return {"rotatedSecrets": [], "metrics": METRICS.snapshot(), "error": str(e)}
+    try:
+        sMan.rotate_secrets(expiryTime, maxWorkers, pageSize, asyncKeys, RotationSchedule(projectId, scheduleDir, reconcileDays) if schedule else None, rotationJournal, resumeOnly)
+    finally:
+        if rotationJournal:
+            rotationJournal.close()
+    for rotatedSecret in sMan.rotatedSecrets:
+        rotatedSecret.projectId = projectId
+    return {"rotatedSecrets": sMan.rotatedSecrets, "metrics": METRICS.snapshot()}
+
+# Rotate secrets across several projects with one authentication, one merged report and one set of notifications
+# Projects are rotated in parallel worker processes; maxWorkers still limits the secrets rotated at once within each project
+# Arg:
+#   projectIds [list of str] - names of GCP projects
+#   maxProjects [int] *opt - max number of projects to rotate at the same time (default=4)
+#   (see main for the other args)
+def main_projects(projectIds, expiryTime, outputType, profileName=None, regionName="us-east-1", secretName=None, debug=False, test=False, backend="gcloud", maxWorkers=1, pageSize=None, asyncKeys=False, rateLimits=None, schedule=False, scheduleDir=None, reconcileDays=7, journal=False, journalDir=None, resumeOnly=False, maxProjects=4):
+    # Access secret for GCP service account once (the worker processes share the gcloud credentials)
+    import boto3
+    if profileName:
+        session = boto3.Session(profile_name=profileName, region_name=regionName)
+    else:
+        session = boto3.Session(region_name=regionName)
+    if secretName:
+        authenticate(session, secretName)
+    rotatedSecrets = 0
+    failedProjects = []
+    # One merged report (written as each project's results come back), one set of notifications and one set of metrics
+    report = open_report(outputType, session, test, withProject=True)
+    # A fresh process per project, so rate limiters and metrics start clean for each one
+    with ProcessPoolExecutor(max_workers=maxProjects, max_tasks_per_child=1) as executor:
+        futures = [executor.submit(rotate_project, projectId, expiryTime, debug, test, backend, maxWorkers, pageSize, asyncKeys, rateLimits, schedule, scheduleDir, reconcileDays, journal, journalDir, resumeOnly) for projectId in projectIds]
+        # Results are merged in the order the projects were given
+        for projectId, future in zip(projectIds, futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error: failed to rotate project {projectId}: {e}")
+                failedProjects.append(projectId)
+                continue
+            # The project wasn't rotated (e.g. another worker is using its journal)
+            if result.get("error"):
+                failedProjects.append(projectId)
+                continue
+            METRICS.merge(result["metrics"], projectId)
+            for rotatedSecret in result["rotatedSecrets"]:
+                report.write(rotatedSecret)
+            rotatedSecrets += len(result["rotatedSecrets"])
+    print(f"=====\nRotated {rotatedSecrets} secret(s) across {len(projectIds) - len(failedProjects)} of {len(projectIds)} project(s)")
+    if failedProjects:
+        print(f"Error: failed project(s): {', '.join(failedProjects)}")
+    # Notify and export metrics
+    report.close()
+
+# Send the general email notification and one digest to each owner
+# Owners with several rotated keys get a single email listing all of them, and the digests are sent in parallel
+# Arg:
+#   rotatedSecrets [list of obj] - rotation records (with their owners)
+#   session [obj] - boto3 session
+#   outputType [dict] - specifies sender/recipient(s) emails
+#   test [bool] - set to True if in testing mode
+#   maxWorkers [int] *opt - max number of emails to send at the same time (default=4)
+def notify_owners(rotatedSecrets, session, outputType, test, maxWorkers=4):
+    with METRICS.span("notify"):
+        # set up ses client (shared by every send)
         sesClient = session.client("ses")
         # get sender and recipient(s)
         sender = outputType.get("sender")
@@ -489,26 +2935,54 @@ def main(projectId, expiryTime, outputType, profileName=None, regionName="us-eas
             recipients = outputType.get("recipients")
             # format subject and body of general email notification
             genSubject = "Rotated Secret and Key Information"
-            genBody = json.dumps(sMan.rotatedSecrets, indent=2)
+            genBody = json.dumps([rotatedSecret.to_dict() for rotatedSecret in rotatedSecrets], indent=2)
             # Send email notification through SES
             send_email(sesClient, sender, recipients, genSubject, genBody)
-        # send individual email notifications to key owners
+        # send one digest to each key owner
         if not test:
-            for rotatedSecret in sMan.rotatedSecrets:
-                annotations = sMan.list_annotations(rotatedSecret["secretName"])
-                notify = annotations.get("notification")
-                if notify:
-                    indSubject = "Your Key has been Rotated"
-                    indBody = json.dumps(rotatedSecret, indent=2)
-                    # Send email notification through SES
-                    send_email(sesClient, sender, [notify], indSubject, indBody)
+            digests = owner_digests(rotatedSecrets)
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                sent = list(executor.map(lambda digest: send_email(sesClient, sender, [digest[0]], *digest[1:]), digests))
+            if digests:
+                print(f"Sent {sum(sent)} of {len(digests)} owner notification(s) for {sum(rotatedSecret.owner is not None for rotatedSecret in rotatedSecrets)} rotated secret(s)")
+
+# Group the rotated secrets by owner
+# Arg:
+#   rotatedSecrets [list of obj] - rotation records (with their owners)
+# Returns:
+#   digests [list of tuple] - (owner, subject, body) for each owner, in the order they were first seen
+def owner_digests(rotatedSecrets):
+    byOwner = {}
+    for rotatedSecret in rotatedSecrets:
+        if rotatedSecret.owner:
+            byOwner.setdefault(rotatedSecret.owner, []).append(rotatedSecret.to_dict())
+    digests = []
+    for notify, secrets in byOwner.items():
+        # A single rotation keeps the original email
+        if len(secrets) == 1:
+            digests.append((notify, "Your Key has been Rotated", json.dumps(secrets[0], indent=2)))
+        else:
+            digests.append((notify, f"{len(secrets)} of your Keys have been Rotated", json.dumps(secrets, indent=2)))
+    return digests
+
+# Read project ids from a file (one per line, blank lines and lines starting with # are skipped)
+# Arg:
+#   fileName [str] - file of project ids
+# Returns:
+#   projectIds [list of str] - project ids
+def read_projects(fileName):
+    with open(fileName) as file:
+        return [line.strip() for line in file if line.strip() and not line.strip().startswith("#")]
 
 if __name__ == "__main__":
     # Create an ArgumentParser object
     parser = argparse.ArgumentParser(description="Use this script to rotate keys associated with old secrets")
     # Create arguments
-    parser.add_argument("projectId", type=str, help="Google Cloud Project Id")
+    parser.add_argument("projectId", type=str, nargs="?", help="Google Cloud Project Id (or use --projects/--projectsFile)")
     parser.add_argument("expiryTime", type=int, help="Time in days after which secrets should be rotated")
+    parser.add_argument("--projects", dest="projects", type=str, nargs="+", default=[], help="Google Cloud Project Ids to rotate in one run (give expiryTime before this option, since it takes every value that follows it)")
+    parser.add_argument("--projectsFile", dest="projectsFile", type=str, help="File with one Google Cloud Project Id per line to rotate in one run")
+    parser.add_argument("--maxProjects", dest="maxProjects", type=int, default=4, help="Max number of projects to rotate at the same time (default=4)")
     parser.add_argument("--fileName", dest="fileName", type=str, help="Name of your file (include .csv extension)")
     parser.add_argument("--profileName", dest="profileName", type=str, help="Profile to use for boto3")
     parser.add_argument("--regionName", dest="regionName", type=str, default='us-east-1', help="aws region to access secret (default='us-east-1')")
@@ -517,9 +2991,31 @@ if __name__ == "__main__":
     parser.add_argument("--recipients", dest="recipients", type=str, nargs='+', help="Recipient(s) to receive notification (e.g. 'abc@gmail.com' 'xyz@yahoo.com'")
     parser.add_argument("--debug", dest="debug", action="store_true", help="Enable debug mode")
     parser.add_argument("--test", dest="test", action="store_true", help="Enable dry-run testing mode")
+    parser.add_argument("--backend", dest="backend", type=str, default="gcloud", choices=BACKENDS, help="Backend for GCP calls (default='gcloud')")
+    parser.add_argument("--maxWorkers", dest="maxWorkers", type=int, default=1, help="Max number of secrets to rotate at the same time (default=1)")
+    parser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets fetched per page")
+    parser.add_argument("--rateLimits", dest="rateLimits", type=str, nargs="+", help=f"Starting calls per second per api family, e.g. secrets.read=10 (families: {', '.join(LIMITERS)})")
+    parser.add_argument("--asyncKeys", dest="asyncKeys", action="store_true", help="Create the new keys for every due secret before waiting on any of them")
+    parser.add_argument("--schedule", dest="schedule", action="store_true", help="Only check secrets that are due, using a saved rotation schedule")
+    parser.add_argument("--scheduleDir", dest="scheduleDir", type=str, help="Directory for the rotation schedule (default=~/.cache/credential-manager)")
+    parser.add_argument("--reconcileDays", dest="reconcileDays", type=float, default=7, help="Days between full reconciles of the rotation schedule (default=7)")
+    parser.add_argument("--journal", dest="journal", action="store_true", help="Journal rotation steps so a run that stops partway can be resumed by the next run")
+    parser.add_argument("--journalDir", dest="journalDir", type=str, help="Directory for the rotation journal (default=~/.cache/credential-manager)")
+    parser.add_argument("--resume", dest="resumeOnly", action="store_true", help="Only resume rotations that an earlier run didn't finish (no listing)")
+    parser.add_argument("--metricsFile", dest="metricsFile", type=str, help="Write call/phase metrics for the run to this JSON file")
+    parser.add_argument("--promFile", dest="promFile", type=str, help="Write call/phase metrics for the run to this Prometheus textfile (.prom)")
+    parser.add_argument("--shard", dest="shard", type=parse_shard, help="Only rotate this worker's share of the secrets, given as index/count (e.g. 0/4)")
+    parser.add_argument("--leaseDir", dest="leaseDir", type=str, help="Directory shared by the workers for secret leases (default=~/.cache/credential-manager/leases)")
+    parser.add_argument("--leaseSeconds", dest="leaseSeconds", type=float, default=120, help="Seconds a lease lasts without being renewed (default=120)")
+    parser.add_argument("--partialReport", dest="partialReport", type=str, help="Write this worker's results to a JSON file for merge_reports.py instead of reporting and notifying")
+    parser.add_argument("--inventory", dest="inventory", type=str, help="Read the secrets from this inventory (kept current by secret_events.py) instead of listing the project")
     # Parse the command-line arguments
     args = parser.parse_args(sys.argv[1:])
-    projectId = args.projectId
+    projectIds = ([args.projectId] if args.projectId else []) + args.projects + (read_projects(args.projectsFile) if args.projectsFile else [])
+    if not projectIds:
+        parser.error("a projectId, --projects or --projectsFile is required")
+    if len(projectIds) > 1 and (args.shard or args.leaseDir or args.partialReport or args.inventory):
+        parser.error("--shard, --leaseDir, --partialReport and --inventory work on a single project")
     expiryTime = args.expiryTime
     fileName = args.fileName
     profileName = args.profileName
@@ -529,7 +3025,29 @@ if __name__ == "__main__":
     recipients = args.recipients
     debug = args.debug
     test = args.test
+    backend = args.backend
+    maxWorkers = args.maxWorkers
+    pageSize = args.pageSize
+    asyncKeys = args.asyncKeys
+    rateLimits = {family: float(rate) for family, rate in (item.split("=", 1) for item in args.rateLimits)} if args.rateLimits else None
+    metricsFile = args.metricsFile
+    promFile = args.promFile
+    maxProjects = args.maxProjects
+    schedule = args.schedule
+    scheduleDir = args.scheduleDir
+    reconcileDays = args.reconcileDays
+    journal = args.journal
+    journalDir = args.journalDir
+    resumeOnly = args.resumeOnly
+    shard = args.shard
+    leaseDir = args.leaseDir
+    leaseSeconds = args.leaseSeconds
+    partialReport = args.partialReport
+    inventory = args.inventory
     # Set up output types
-    outputType = {"fileName": fileName, "sender": sender, "recipients": recipients}
-    # Pass arguments to the main function
-    main(projectId, expiryTime, outputType, profileName, regionName, secretName, debug, test)
\ No newline at end of file
+    outputType = {"fileName": fileName, "sender": sender, "recipients": recipients, "metricsFile": metricsFile, "promFile": promFile}
+    # Pass arguments to the main function (or fan out if there are several projects)
+    if len(projectIds) == 1:
+        main(projectIds[0], expiryTime, outputType, profileName, regionName, secretName, debug, test, backend, maxWorkers, pageSize, asyncKeys, rateLimits, schedule, scheduleDir, reconcileDays, journal, journalDir, resumeOnly, shard, leaseDir, leaseSeconds, partialReport, inventory)
+    else:
+        main_projects(projectIds, expiryTime, outputType, profileName, regionName, secretName, debug, test, backend, maxWorkers, pageSize, asyncKeys, rateLimits, schedule, scheduleDir, reconcileDays, journal, journalDir, resumeOnly, maxProjects)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import sys
+import os
+import io
+import json
+import time
+import socket
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+import contextlib
+import importlib
+import urllib.request
+
+# Benchmarks for rotation, the config check and key lookup against the local stand-in (fake_cloud.py)
+# Each scenario runs on a freshly seeded synthetic project and reports wall time, api calls and peak memory.
+# The run fails if api calls per secret go above the checked-in baseline (baseline.json).
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+# Find a free local port
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Class to run the fake server in its own process (so it doesn't count towards the measured memory)
+class FakeServer:
+    # Init Arg:
+    #   latency [float] *opt - average seconds added to each request (default=0)
+    #   failureRate [float] *opt - fraction of requests that fail with a 429 (default=0)
+    def __init__(self, latency=0, failureRate=0):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_cloud.py"), "--port", str(self.port),
+                                         "--latency", str(latency), "--failureRate", str(failureRate)], stdout=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                self.call("/_stats")
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("Fake server did not start")
+    def call(self, path):
+        with urllib.request.urlopen(f"{self.url}{path}") as res:
+            return json.loads(res.read())
+    def seed(self, projectId, count):
+        self.call(f"/_seed?project={projectId}&count={count}")
+        self.call("/_reset")
+    def stats(self):
+        return self.call("/_stats")
+    # Get some key uids referenced by secret annotations
+    def sample_keys(self, projectId, count=3):
+        secrets = self.call(f"/v1/projects/{projectId}/secrets?pageSize=50").get("secrets", [])
+        keyIds = [value for secret in secrets for name, value in secret.get("annotations", {}).items() if name.isdigit()]
+        return keyIds[-count:]
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+# Point both backends at the fake server (must happen before api_key_rotation is imported)
+def use_fake_server(url):
+    os.environ["SECRET_MANAGER_ENDPOINT"] = url
+    os.environ["API_KEYS_ENDPOINT"] = url
+    os.environ["PUBSUB_ENDPOINT"] = url
+    os.environ["FAKE_GCP_URL"] = url
+    os.environ["PATH"] = os.path.join(BENCH_DIR, "bin") + os.pathsep + os.environ["PATH"]
+    sys.path.insert(0, REPO_DIR)
+
+# Run a scenario, measuring wall time, peak memory and api calls
+# Arg:
+#   server [obj] - fake server
+#   func [function] - scenario to run
+# Returns:
+#   result [dict] - measurements
+def measure(server, func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = server.stats()
+    return {"seconds": round(seconds, 3), "calls": stats["total"], "failures": stats["failures"], "peakMemoryMB": round(peak / 2**20, 2), "callsByOperation": stats["calls"]}
+
+# Scenarios (each takes the project, backend, options and working directory)
+def run_rotation(projectId, backend, options, workDir, scheduled=False):
+    from api_key_rotation import KeyManager, SecretManager, RotationSchedule, get_backend, open_report
+    from fake_cloud import FakeSession
+    gcp = get_backend(projectId, backend)
+    kMan = KeyManager(projectId, backend=gcp)
+    sMan = SecretManager(projectId, kMan, backend=gcp)
+    schedule = RotationSchedule(projectId, workDir) if scheduled else None
+    outputType = {"fileName": os.path.join(workDir, "rotated.csv"), "sender": "rotation@example.com", "recipients": ["secops@example.com"]}
+    sMan.report = open_report(outputType, FakeSession(os.environ["FAKE_GCP_URL"]), False)
+    sMan.rotate_secrets(options.expiryTime, options.maxWorkers, options.pageSize, options.asyncKeys, schedule)
+    sMan.report.close()
+def run_audit(projectId, backend, options, workDir, snapshot=None):
+    import secret_config_check
+    secret_config_check.main(projectId, os.path.join(workDir, "secrets-config.csv"), backend, options.pageSize, snapshot, options.maxWorkers)
+def run_lookup(projectId, backend, options, workDir, keyIds=None):
+    import secret_lookup
+    secret_lookup.main(projectId, keyIds or ["missing-key"], backend, cacheDir=workDir, pageSize=options.pageSize)
+
+# Lambda invocation settings (test mode, so a warm invocation does the same work as the cold one)
+def lambda_event(projectId, backend, options):
+    rateLimits = {family: float(rate) for family, rate in (item.split("=", 1) for item in options.rateLimits or [])}
+    return {"projectId": projectId, "expiryTime": options.expiryTime, "backend": backend, "maxWorkers": options.maxWorkers,
+            "pageSize": options.pageSize, "asyncKeys": options.asyncKeys, "rateLimits": rateLimits, "test": True}
+# A cold invocation runs in a new process, so it includes starting Python and importing the handler
+def run_lambda_cold(projectId, backend, options, workDir):
+    code = f"import sys; sys.path.insert(0, {REPO_DIR!r}); import lambda_handler; lambda_handler.handler({lambda_event(projectId, backend, options)!r})"
+    subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+def run_lambda_warm(projectId, backend, options, workDir):
+    import lambda_handler
+    lambda_handler.handler(lambda_event(projectId, backend, options))
+
+SCENARIOS = ["rotate", "rotate-scheduled", "audit", "audit-snapshot", "lookup-cold", "lookup-warm", "lambda-cold", "lambda-warm"]
+
+# Run every scenario for each project size
+# Arg:
+#   options [obj] - parsed command-line options
+# Returns:
+#   results [list of dict] - measurements per size and scenario
+def run(options):
+    server = FakeServer(options.latency, options.failureRate)
+    use_fake_server(server.url)
+    sys.path.insert(0, BENCH_DIR)
+    # Import everything up front so imports don't count towards the first scenario
+    # (the scenarios import the other modules themselves, so those are only loaded here)
+    import api_key_rotation, secret_snapshot, lambda_handler
+    for moduleName in ("secret_config_check", "secret_lookup", "fake_cloud"):
+        importlib.import_module(moduleName)
+    if options.rateLimits:
+        api_key_rotation.set_rate_limits({family: float(rate) for family, rate in (item.split("=", 1) for item in options.rateLimits)})
+    results = []
+    try:
+        for size in options.sizes:
+            projectId = f"bench-{size}"
+            for scenario in options.scenarios:
+                tmpDir = tempfile.TemporaryDirectory(prefix="bench-")
+                workDir = tmpDir.name
+                cwd = os.getcwd()
+                # gcloud writes stray files (e.g. "1") to the working directory
+                os.chdir(workDir)
+                try:
+                    server.seed(projectId, size)
+                    if scenario == "rotate":
+                        func = lambda: run_rotation(projectId, options.backend, options, workDir)
+                    # A scheduled rotation runs the day after a run that filled in the schedule
+                    elif scenario == "rotate-scheduled":
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            run_rotation(projectId, options.backend, options, workDir, scheduled=True)
+                        server.call("/_reset")
+                        func = lambda: run_rotation(projectId, options.backend, options, workDir, scheduled=True)
+                    elif scenario == "audit":
+                        func = lambda: run_audit(projectId, options.backend, options, workDir)
+                    # An offline audit runs against a snapshot taken beforehand
+                    elif scenario == "audit-snapshot":
+                        snapshot = os.path.join(workDir, "snapshot.json.gz")
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            secret_snapshot.export(projectId, snapshot, options.backend, options.maxWorkers, options.pageSize)
+                        server.call("/_reset")
+                        func = lambda: run_audit(projectId, options.backend, options, workDir, snapshot)
+                    elif scenario == "lambda-cold":
+                        func = lambda: run_lambda_cold(projectId, options.backend, options, workDir)
+                    # A warm invocation runs after another invocation in the same process
+                    elif scenario == "lambda-warm":
+                        lambda_handler.STATE.managers.clear()
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            run_lambda_warm(projectId, options.backend, options, workDir)
+                        server.call("/_reset")
+                        func = lambda: run_lambda_warm(projectId, options.backend, options, workDir)
+                    else:
+                        keyIds = server.sample_keys(projectId)
+                        # A warm lookup runs against an index that has already been synced
+                        if scenario == "lookup-warm":
+                            with contextlib.redirect_stdout(io.StringIO()):
+                                run_lookup(projectId, options.backend, options, workDir, keyIds)
+                            server.call("/_reset")
+                        func = lambda: run_lookup(projectId, options.backend, options, workDir, keyIds)
+                    result = measure(server, func)
+                finally:
+                    os.chdir(cwd)
+                    tmpDir.cleanup()
+                result.update({"backend": options.backend, "scenario": scenario, "secrets": size, "callsPerSecret": round(result["calls"] / size, 3)})
+                results.append(result)
+                print(f"{scenario:>16} {size:>7} secrets: {result['seconds']:>9.3f}s {result['calls']:>8} calls "
+                      f"({result['callsPerSecret']:.3f}/secret) {result['peakMemoryMB']:>8.2f} MB peak")
+    finally:
+        server.stop()
+    return results
+
+# Name of a result in the baseline file
+def baseline_name(result):
+    return f"{result['backend']}/{result['scenario']}/{result['secrets']}"
+
+# Compare calls per secret against the baseline
+# Arg:
+#   results [list of dict] - measurements
+#   tolerance [float] - allowed fractional increase over the baseline
+# Returns:
+#   regressions [list of str] - descriptions of scenarios that regressed
+def check_baseline(results, tolerance):
+    if not os.path.exists(BASELINE):
+        return []
+    with open(BASELINE) as file:
+        baseline = json.load(file)
+    regressions = []
+    for result in results:
+        name = baseline_name(result)
+        limit = baseline.get(name)
+        if limit is not None and result["callsPerSecret"] > limit * (1 + tolerance):
+            regressions.append(f"{name}: {result['callsPerSecret']} calls/secret (baseline {limit})")
+    return regressions
+
+# Save the calls per secret for each backend, scenario and size as the new baseline
+def update_baseline(results):
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    for result in results:
+        baseline[baseline_name(result)] = result["callsPerSecret"]
+    with open(BASELINE, "w") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+if __name__ == "__main__":
+    # Create an ArgumentParser object
+    parser = argparse.ArgumentParser(description="Use this script to benchmark rotation, the config check and key lookup against a local stand-in")
+    # Create arguments
+    parser.add_argument("--sizes", dest="sizes", type=int, nargs="+", default=[10, 1000, 10000], help="Numbers of secrets in the synthetic projects (default=10 1000 10000)")
+    parser.add_argument("--scenarios", dest="scenarios", type=str, nargs="+", default=SCENARIOS, choices=SCENARIOS, help="Scenarios to run (default=all)")
+    parser.add_argument("--backend", dest="backend", type=str, default="rest", choices=["gcloud", "rest"], help="Backend to benchmark (default='rest')")
+    parser.add_argument("--expiryTime", dest="expiryTime", type=int, default=90, help="Rotation expiry in days (default=90)")
+    parser.add_argument("--maxWorkers", dest="maxWorkers", type=int, default=1, help="Max number of secrets to rotate at the same time (default=1)")
+    parser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets fetched per page")
+    parser.add_argument("--rateLimits", dest="rateLimits", type=str, nargs="+", help="Starting calls per second per api family, e.g. secrets.read=1000")
+    parser.add_argument("--asyncKeys", dest="asyncKeys", action="store_true", help="Create the new keys for every due secret before waiting on any of them")
+    parser.add_argument("--latency", dest="latency", type=float, default=0, help="Average seconds added to each fake api request (default=0)")
+    parser.add_argument("--failureRate", dest="failureRate", type=float, default=0, help="Fraction of fake api requests that fail with a 429 (default=0)")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.05, help="Allowed increase in calls per secret over the baseline (default=0.05)")
+    parser.add_argument("--output", dest="output", type=str, help="Write the results to this JSON file")
+    parser.add_argument("--updateBaseline", dest="updateBaseline", action="store_true", help="Save these results as the new calls-per-secret baseline")
+    # Parse the command-line arguments
+    options = parser.parse_args(sys.argv[1:])
+    results = run(options)
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if options.updateBaseline:
+        update_baseline(results)
+        print(f"Baseline updated: {BASELINE}")
+        sys.exit(0)
+    regressions = check_baseline(results, options.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    sys.exit(1 if regressions else 0)
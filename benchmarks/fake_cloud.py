@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+import sys
+import re
+import json
+import time
+import random
+import base64
+import threading
+import argparse
+from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the Secret Manager and API Keys REST APIs (and SES) used by api_key_rotation.py
+# Secret changes are also published as Secret Manager change events to one Pub/Sub subscription per project
+# The same server backs the REST backend (point SECRET_MANAGER_ENDPOINT/API_KEYS_ENDPOINT at it) and the
+# fake gcloud in benchmarks/bin (which reads FAKE_GCP_URL), so both backends see the same state
+
+# Format a time the way the apis do
+def timestamp(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+# Class to hold the secrets, versions and keys for fake projects
+class FakeCloud:
+    # Init Arg:
+    #   latency [float] *opt - average seconds added to each request (default=0)
+    #   failureRate [float] *opt - fraction of requests that fail with a retryable error (default=0)
+    def __init__(self, latency=0, failureRate=0):
+        self.latency = latency
+        self.failureRate = failureRate
+        self.lock = threading.Lock()
+        # projectId -> {secretName: {"secret": dict, "versions": [dict] (newest first), "payloads": {version: str}}}
+        self.secrets = {}
+        # projectId -> {uid: key}
+        self.keys = {}
+        self.keyStrings = {}
+        # operation name -> operation
+        self.operations = {}
+        # projectId -> change events waiting to be acknowledged ({"ackId": str, "message": dict, "deliverAfter": float})
+        self.events = {}
+        self.calls = {}
+        self.failures = 0
+        self.counter = 0
+    # Get a new unique id
+    def next_id(self):
+        self.counter += 1
+        return f"{self.counter:08d}"
+    # Add a key to a project
+    def add_key(self, projectId, displayName, restrictions=None, createTime=None):
+        uid = f"key-{self.next_id()}"
+        key = {"name": f"projects/{projectId}/locations/global/keys/{uid}", "uid": uid, "displayName": displayName,
+               "createTime": timestamp(createTime or datetime.now(timezone.utc))}
+        if restrictions:
+            key["restrictions"] = restrictions
+        self.keys.setdefault(projectId, {})[uid] = key
+        self.keyStrings[uid] = f"AIza{uid}"
+        return key
+    # Add a version to a secret
+    def add_version(self, projectId, secretName, payload, createTime=None):
+        entry = self.secrets[projectId][secretName]
+        number = len(entry["versions"]) + 1
+        version = {"name": f"{entry['secret']['name']}/versions/{number}", "createTime": timestamp(createTime or datetime.now(timezone.utc)), "state": "ENABLED"}
+        entry["versions"].insert(0, version)
+        entry["payloads"][str(number)] = payload
+        return version
+    # Publish a change event for a secret or version (the data is the resource after the change)
+    def publish(self, projectId, eventType, secretName, data, version=None):
+        secretId = f"projects/{projectId}/secrets/{secretName}"
+        attributes = {"eventType": eventType, "secretId": secretId, "dataFormat": "JSON_API_V1"}
+        if version:
+            attributes["versionId"] = f"{secretId}/versions/{version}"
+        messageId = self.next_id()
+        message = {"data": base64.b64encode(json.dumps(data).encode()).decode(), "attributes": attributes, "messageId": messageId,
+                   "publishTime": timestamp(datetime.now(timezone.utc))}
+        self.events.setdefault(projectId, []).append({"ackId": f"ack-{messageId}", "message": message, "deliverAfter": 0})
+    # Fill a project with synthetic secrets
+    # Arg:
+    #   projectId [str] - name of project
+    #   count [int] - number of secrets
+    #   apiKeyRatio [float] *opt - fraction of secrets that hold api keys (default=0.5)
+    #   versions [int] *opt - versions per api key secret (default=3)
+    #   maxAgeDays [int] *opt - latest versions are up to this many days old (default=120)
+    #   seed [int] *opt - random seed (default=0)
+    def seed(self, projectId, count, apiKeyRatio=0.5, versions=3, maxAgeDays=120, seed=0):
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            self.secrets[projectId] = {}
+            self.keys[projectId] = {}
+            self.events[projectId] = []
+            for i in range(count):
+                secretName = f"secret-{i:06d}"
+                created = now - timedelta(days=maxAgeDays + versions * 30, seconds=i)
+                secret = {"name": f"projects/{projectId}/secrets/{secretName}", "createTime": timestamp(created), "etag": '"1"',
+                          "replication": {"automatic": {}}, "annotations": {}}
+                self.secrets[projectId][secretName] = {"secret": secret, "versions": [], "payloads": {}}
+                if rng.random() >= apiKeyRatio:
+                    self.add_version(projectId, secretName, "not-a-key", created)
+                    continue
+                secret["annotations"] = {"type": "api_key", "notification": f"owner{i % 50}@example.com"}
+                latestAge = timedelta(days=rng.uniform(0, maxAgeDays))
+                for v in range(versions):
+                    versionTime = now - latestAge - timedelta(days=30 * (versions - 1 - v))
+                    key = self.add_key(projectId, f"{secretName}-key", {"apiTargets": [{"service": "maps.googleapis.com"}]}, versionTime)
+                    self.add_version(projectId, secretName, self.keyStrings[key["uid"]], versionTime)
+                    secret["annotations"][str(v + 1)] = key["uid"]
+                # Only the latest version is enabled (and only its key still exists)
+                for version in self.secrets[projectId][secretName]["versions"][1:]:
+                    version["state"] = "DISABLED"
+                for uid in list(secret["annotations"].values())[2:-1]:
+                    self.keys[projectId].pop(uid, None)
+    # Returns:
+    #   stats [dict] - request counts per operation and number of injected failures
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "total": sum(self.calls.values()), "failures": self.failures}
+    # Clear the request counts
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.failures = 0
+
+# Routes: (method, pattern, handler name, operation label)
+ROUTES = [
+    ("GET", r"/v1/projects/([^/]+)/secrets", "list_secrets", "secrets.list"),
+    ("GET", r"/v1/projects/([^/]+)/secrets/([^/:]+)", "get_secret", "secrets.describe"),
+    ("PATCH", r"/v1/projects/([^/]+)/secrets/([^/:]+)", "patch_secret", "secrets.update"),
+    ("GET", r"/v1/projects/([^/]+)/secrets/([^/:]+)/versions", "list_versions", "versions.list"),
+    ("POST", r"/v1/projects/([^/]+)/secrets/([^/:]+)/versions/([^/:]+):(enable|disable|destroy)", "set_version_state", "versions.state"),
+    ("POST", r"/v1/projects/([^/]+)/secrets/([^/:]+):addVersion", "add_version", "versions.add"),
+    ("GET", r"/v2/projects/([^/]+)/locations/global/keys", "list_keys", "api-keys.list"),
+    ("GET", r"/v2/projects/([^/]+)/locations/global/keys/([^/]+)", "get_key", "api-keys.describe"),
+    ("GET", r"/v2/projects/([^/]+)/locations/global/keys/([^/]+)/keyString", "get_key_string", "api-keys.get-key-string"),
+    ("POST", r"/v2/projects/([^/]+)/locations/global/keys", "create_key", "api-keys.create"),
+    ("DELETE", r"/v2/projects/([^/]+)/locations/global/keys/([^/]+)", "delete_key", "api-keys.delete"),
+    ("GET", r"/v2/(operations/[^/]+)", "get_operation", "operations.get"),
+    ("POST", r"/v1/projects/([^/]+)/subscriptions/([^/:]+):pull", "pull_messages", "pubsub.pull"),
+    ("POST", r"/v1/projects/([^/]+)/subscriptions/([^/:]+):acknowledge", "ack_messages", "pubsub.ack"),
+    ("POST", r"/ses/send", "send_email", "ses.send"),
+]
+
+# Request handler for the fake apis
+class FakeCloudHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, so Nagle's algorithm would add a delay to every response
+    disable_nagle_algorithm = True
+    cloud = None
+    def log_message(self, format, *args):
+        pass
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    def error(self, status, message, reason="NOT_FOUND"):
+        return status, {"error": {"code": status, "message": message, "status": reason}}
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        cloud = self.cloud
+        # Control endpoints for the benchmarks
+        if url.path == "/_stats":
+            return self.reply(200, cloud.stats())
+        if url.path == "/_reset":
+            cloud.reset_stats()
+            return self.reply(200, {})
+        if url.path == "/_seed":
+            cloud.seed(query["project"], int(query["count"]), float(query.get("apiKeyRatio", 0.5)), int(query.get("versions", 3)))
+            return self.reply(200, {})
+        for routeMethod, pattern, handler, operation in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if routeMethod == method and match:
+                break
+        else:
+            return self.reply(*self.error(404, f"No route for {method} {url.path}"))
+        with cloud.lock:
+            cloud.calls[operation] = cloud.calls.get(operation, 0) + 1
+        if cloud.latency:
+            time.sleep(cloud.latency * random.uniform(0.5, 1.5))
+        if cloud.failureRate and random.random() < cloud.failureRate:
+            with cloud.lock:
+                cloud.failures += 1
+            return self.reply(*self.error(429, "Quota exceeded (injected failure)", "RESOURCE_EXHAUSTED"))
+        with cloud.lock:
+            status, response = getattr(self, handler)(*match.groups(), query=query, body=body)
+        self.reply(status, response)
+    def do_GET(self):
+        self.handle_request("GET")
+    def do_POST(self):
+        self.handle_request("POST")
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+    # Return a page of items
+    def page(self, items, field, query):
+        start = int(query.get("pageToken") or 0)
+        size = int(query.get("pageSize") or 25000)
+        page = {field: items[start:start + size]}
+        if start + size < len(items):
+            page["nextPageToken"] = str(start + size)
+        return 200, page
+    def find_secret(self, projectId, secretName):
+        return self.cloud.secrets.get(projectId, {}).get(secretName)
+    def list_secrets(self, projectId, query, body):
+        secrets = [entry["secret"] for entry in self.cloud.secrets.get(projectId, {}).values()]
+        match = re.fullmatch(r'create_time>"?([^"]*)"?', query.get("filter", ""))
+        if match:
+            secrets = [secret for secret in secrets if secret["createTime"] > match.group(1)]
+        return self.page(secrets, "secrets", query)
+    def get_secret(self, projectId, secretName, query, body):
+        entry = self.find_secret(projectId, secretName)
+        return (200, entry["secret"]) if entry else self.error(404, f"Secret [{secretName}] not found")
+    def patch_secret(self, projectId, secretName, query, body):
+        entry = self.find_secret(projectId, secretName)
+        if not entry:
+            return self.error(404, f"Secret [{secretName}] not found")
+        # Like Secret Manager, an update with an etag only goes through if the secret hasn't changed since
+        if body.get("etag") and body["etag"] != entry["secret"]["etag"]:
+            return self.error(400, f"The etag provided does not match the etag of [{secretName}]", "FAILED_PRECONDITION")
+        entry["secret"]["annotations"] = body.get("annotations", {})
+        entry["secret"]["etag"] = f'"{int(entry["secret"]["etag"].strip(chr(34))) + 1}"'
+        self.cloud.publish(projectId, "SECRET_UPDATE", secretName, entry["secret"])
+        return 200, entry["secret"]
+    def list_versions(self, projectId, secretName, query, body):
+        entry = self.find_secret(projectId, secretName)
+        if not entry:
+            return self.error(404, f"Secret [{secretName}] not found")
+        versions = entry["versions"]
+        if query.get("filter") == "state:ENABLED":
+            versions = [version for version in versions if version["state"] == "ENABLED"]
+        return self.page(versions, "versions", query)
+    def set_version_state(self, projectId, secretName, number, action, query, body):
+        entry = self.find_secret(projectId, secretName)
+        version = next((version for version in entry["versions"] if version["name"].endswith(f"/{number}")), None) if entry else None
+        if not version:
+            return self.error(404, f"Version [{number}] of [{secretName}] not found")
+        version["state"] = {"enable": "ENABLED", "disable": "DISABLED", "destroy": "DESTROYED"}[action]
+        self.cloud.publish(projectId, f"SECRET_VERSION_{action.upper()}", secretName, version, number)
+        return 200, version
+    def add_version(self, projectId, secretName, query, body):
+        if not self.find_secret(projectId, secretName):
+            return self.error(404, f"Secret [{secretName}] not found")
+        payload = base64.b64decode(body.get("payload", {}).get("data", "")).decode()
+        version = self.cloud.add_version(projectId, secretName, payload)
+        self.cloud.publish(projectId, "SECRET_VERSION_ADD", secretName, version, version["name"].split("/")[-1])
+        return 200, version
+    def list_keys(self, projectId, query, body):
+        return self.page(list(self.cloud.keys.get(projectId, {}).values()), "keys", query)
+    def get_key(self, projectId, uid, query, body):
+        key = self.cloud.keys.get(projectId, {}).get(uid)
+        return (200, key) if key else self.error(404, f"Key [{uid}] not found")
+    def get_key_string(self, projectId, uid, query, body):
+        if uid not in self.cloud.keys.get(projectId, {}):
+            return self.error(404, f"Key [{uid}] not found")
+        return 200, {"keyString": self.cloud.keyStrings[uid]}
+    # Key creation is a long running operation that finishes on the first poll
+    def create_key(self, projectId, query, body):
+        key = self.cloud.add_key(projectId, body.get("displayName"), body.get("restrictions"))
+        name = f"operations/akmf.{self.cloud.next_id()}"
+        self.cloud.operations[name] = {"name": name, "done": True, "response": key}
+        return 200, {"name": name}
+    def delete_key(self, projectId, uid, query, body):
+        key = self.cloud.keys.get(projectId, {}).pop(uid, None)
+        if not key:
+            return self.error(404, f"Key [{uid}] not found")
+        return 200, {"name": f"operations/akmf.{self.cloud.next_id()}", "done": True, "response": key}
+    def get_operation(self, name, query, body):
+        operation = self.cloud.operations.get(name)
+        return (200, operation) if operation else self.error(404, f"Operation [{name}] not found")
+    # Every subscription of a project gets the project's events; a pulled event is redelivered after 10s unless it is acknowledged
+    def pull_messages(self, projectId, subscription, query, body):
+        now = time.monotonic()
+        received = []
+        for event in self.cloud.events.get(projectId, []):
+            if len(received) == body.get("maxMessages", 100):
+                break
+            if event["deliverAfter"] <= now:
+                event["deliverAfter"] = now + 10
+                received.append({"ackId": event["ackId"], "message": event["message"]})
+        return 200, {"receivedMessages": received} if received else {}
+    def ack_messages(self, projectId, subscription, query, body):
+        ackIds = set(body.get("ackIds", []))
+        self.cloud.events[projectId] = [event for event in self.cloud.events.get(projectId, []) if event["ackId"] not in ackIds]
+        return 200, {}
+    def send_email(self, query, body):
+        return 200, {"MessageId": f"fake-{self.cloud.next_id()}"}
+
+# Stand-in for a boto3 SES client (sends through the fake server so calls are counted there)
+class FakeSES:
+    # Init Arg:
+    #   url [str] - base url of the fake server
+    def __init__(self, url):
+        import urllib3
+        self.url = url
+        self.http = urllib3.PoolManager()
+    def send_email(self, Destination, Message, Source):
+        res = self.http.request("POST", f"{self.url}/ses/send", body=json.dumps({"to": Destination["ToAddresses"]}), headers={"Content-Type": "application/json"})
+        body = json.loads(res.data)
+        if res.status >= 400:
+            raise FakeClientError("Throttling" if res.status == 429 else "InternalFailure", body.get("error", {}).get("message"))
+        return body
+
+# Error shaped like botocore's ClientError (the error code is in response["Error"]["Code"])
+class FakeClientError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"An error occurred ({code}) when calling the SendEmail operation: {message}")
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+# Stand-in for a boto3 session that only hands out fake SES clients
+class FakeSession:
+    def __init__(self, url):
+        self.url = url
+    def client(self, service):
+        return FakeSES(self.url)
+
+# Start the fake server in a background thread
+# Arg:
+#   port [int] *opt - port to listen on, 0 picks a free port (default=0)
+#   latency [float] *opt - average seconds added to each request (default=0)
+#   failureRate [float] *opt - fraction of requests that fail with a retryable error (default=0)
+# Returns:
+#   server [obj] - running server (server.url is its base url, server.cloud its state)
+def start_server(port=0, latency=0, failureRate=0):
+    handler = type("Handler", (FakeCloudHandler,), {"cloud": FakeCloud(latency, failureRate)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.cloud = handler.cloud
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    # Create an ArgumentParser object
+    parser = argparse.ArgumentParser(description="Use this script to run a local stand-in for Secret Manager, API Keys and SES")
+    # Create arguments
+    parser.add_argument("--port", dest="port", type=int, default=8085, help="Port to listen on (default=8085)")
+    parser.add_argument("--latency", dest="latency", type=float, default=0, help="Average seconds added to each request (default=0)")
+    parser.add_argument("--failureRate", dest="failureRate", type=float, default=0, help="Fraction of requests that fail with a 429 (default=0)")
+    parser.add_argument("--project", dest="project", type=str, help="Project to fill with synthetic secrets")
+    parser.add_argument("--secrets", dest="secrets", type=int, default=0, help="Number of synthetic secrets (default=0)")
+    # Parse the command-line arguments
+    args = parser.parse_args(sys.argv[1:])
+    server = start_server(args.port, args.latency, args.failureRate)
+    if args.project:
+        server.cloud.seed(args.project, args.secrets)
+    print(f"Fake cloud listening on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import os
+import time
+
+# AWS Lambda entry point for api key rotation (handler: lambda_handler.handler)
+# Anything that doesn't change between invocations is kept at module scope, so a warm invocation skips the setup:
+# the rotation module, the boto3 session and clients, the activated GCP service account and the backends
+# (with their metadata caches and key inventory). api_key_rotation and boto3 are only imported when first needed.
+
+# Seconds after which the GCP service account key is fetched and activated again
+CREDENTIAL_TTL = float(os.environ.get("CREDENTIAL_TTL", 3600))
+# Seconds for which secret/version metadata and the key inventory are reused by later invocations
+# (changes made outside this tool within that time may not be seen, 0 turns the reuse off)
+INVENTORY_TTL = float(os.environ.get("INVENTORY_TTL", 300))
+# gcloud reads the service account key from a file, and only /tmp is writable on Lambda
+KEY_FILE = "/tmp/gcp-service-account.json"
+# gcloud keeps its credentials and cached access token in its config directory, which has to be writable too
+# (every gcloud process shares it, so warm invocations reuse the token)
+os.environ.setdefault("CLOUDSDK_CONFIG", "/tmp/gcloud")
+
+# Class to hand out one boto3 client per service (boto3 clients are thread-safe and reusable)
+class CachedSession:
+    # Init Arg:
+    #   session [obj] - boto3 session
+    def __init__(self, session):
+        self.session = session
+        self.clients = {}
+    def client(self, service):
+        if service not in self.clients:
+            self.clients[service] = self.session.client(service)
+        return self.clients[service]
+
+# Class to hold what is kept between warm invocations
+class WarmState:
+    def __init__(self):
+        self.rotation = None
+        # regionName -> cached session
+        self.sessions = {}
+        # secretName -> time (monotonic) after which the service account is activated again
+        self.credentials = {}
+        # (projectId, backend, test) -> (key manager, secret manager, time after which they are rebuilt)
+        self.managers = {}
+        self.invocations = 0
+
+STATE = WarmState()
+
+# Get the rotation module (imported on the first invocation)
+def rotation_module():
+    if STATE.rotation is None:
+        import api_key_rotation
+        STATE.rotation = api_key_rotation
+    return STATE.rotation
+
+# Get the session for a region (boto3 is only imported if a session is needed)
+# Arg:
+#   regionName [str] - AWS region
+# Returns:
+#   session [obj] - cached session
+def get_session(regionName):
+    if regionName not in STATE.sessions:
+        import boto3
+        STATE.sessions[regionName] = CachedSession(boto3.Session(region_name=regionName))
+    return STATE.sessions[regionName]
+
+# Activate the GCP service account unless it was activated recently
+# Arg:
+#   session [obj] - cached session
+#   secretName [str] - secret that contains service account key file
+# Returns:
+#   activated [bool] - True if the service account was (re)activated
+def ensure_credentials(session, secretName):
+    if time.monotonic() < STATE.credentials.get(secretName, 0):
+        return False
+    rotation_module().authenticate(session, secretName, KEY_FILE)
+    STATE.credentials[secretName] = time.monotonic() + CREDENTIAL_TTL
+    return True
+
+# Get the key and secret managers for a project, reusing them (and their caches) until INVENTORY_TTL runs out
+# Arg:
+#   projectId [str] - name of GCP project
+#   backend [str] - backend for GCP calls, "gcloud" or "rest"
+#   debug [bool] - set to True to print debugging statements
+#   test [bool] - set to True to testing mode
+# Returns:
+#   kMan [obj] - key manager instance
+#   sMan [obj] - secret manager instance
+def get_managers(projectId, backend, debug, test):
+    rotation = rotation_module()
+    name = (projectId, backend, test)
+    kMan, sMan, expiry = STATE.managers.get(name, (None, None, 0))
+    if time.monotonic() >= expiry:
+        gcp = rotation.get_backend(projectId, backend, debug)
+        kMan = rotation.KeyManager(projectId, debug, test, gcp)
+        sMan = rotation.SecretManager(projectId, kMan, debug, test, gcp)
+        STATE.managers[name] = (kMan, sMan, time.monotonic() + INVENTORY_TTL)
+    # Only the caches carry over, not the results of the last invocation
+    sMan.rotatedSecrets = []
+    sMan.checkedVersions = {}
+    sMan.owners = {}
+    return kMan, sMan
+
+# Arg:
+#   event [dict] - rotation settings:
+#     projectId [str] - name of GCP project
+#     expiryTime [int] - time in days after which secrets should be rotated
+#     secretName [str] *opt - secret in AWS Secrets Manager with the GCP service account key (default=None)
+#     sender [str] *opt - SES sender (default=None, no emails)
+#     recipients [list of str] *opt - recipients of the general email (default=None)
+#     regionName [str] *opt - AWS region (default=us-east-1)
+#     backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#     maxWorkers [int] *opt - max number of secrets to rotate at the same time (default=1)
+#     pageSize [int] *opt - number of secrets fetched per page (default=None)
+#     asyncKeys [bool] *opt - create the keys for every due secret before waiting on any of them (default=False)
+#     rateLimits [dict] *opt - api family -> starting calls per second (default=None)
+#     fileName/metricsFile/promFile [str] *opt - report and metrics files, e.g. under /tmp (default=None)
+#     debug [bool] *opt - set to True to print debugging statements (default=False)
+#     test [bool] *opt - set to True to testing mode (default=False)
+#   context [obj] - Lambda context (not used)
+# Returns:
+#   result [dict] - rotated secrets, whether the invocation was warm and how long the setup took
+def handler(event, context=None):
+    start = time.perf_counter()
+    warm = STATE.invocations > 0
+    STATE.invocations += 1
+    rotation = rotation_module()
+    debug = event.get("debug", False)
+    test = event.get("test", False)
+    # Metrics cover this invocation only
+    rotation.METRICS.reset()
+    if event.get("rateLimits"):
+        rotation.set_rate_limits(event["rateLimits"])
+    session = None
+    if event.get("secretName") or event.get("sender"):
+        session = get_session(event.get("regionName", "us-east-1"))
+    if event.get("secretName"):
+        ensure_credentials(session, event["secretName"])
+    kMan, sMan = get_managers(event["projectId"], event.get("backend", "gcloud"), debug, test)
+    setupSeconds = time.perf_counter() - start
+    # Rotate any secrets that are older than the desired expiry time, writing each one to the report as it finishes
+    outputType = {name: event.get(name) for name in ("fileName", "sender", "recipients", "metricsFile", "promFile")}
+    sMan.report = rotation.open_report(outputType, session, test)
+    try:
+        sMan.rotate_secrets(event["expiryTime"], event.get("maxWorkers", 1), event.get("pageSize"), event.get("asyncKeys", False))
+    finally:
+        # Notify and export metrics
+        sMan.report.close()
+        sMan.report = None
+    # The key inventory doesn't have the keys created by this invocation, so it is listed again next time
+    if sMan.rotatedSecrets and not test:
+        kMan.keyIndex = None
+    return {"rotatedSecrets": [rotatedSecret.to_dict() for rotatedSecret in sMan.rotatedSecrets], "warm": warm, "setupSeconds": round(setupSeconds, 6),
+            "seconds": round(time.perf_counter() - start, 6)}
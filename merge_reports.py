@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import sys
+import json
+import argparse
+from api_key_rotation import METRICS, RotationRecord, finish_run
+
+# Combine the partial reports written by sharded rotation workers (api_key_rotation.py --shard I/N --partialReport FILE)
+# into one report file, one general email, one digest per owner and one set of metrics
+
+# Read the partial reports
+# Arg:
+#   fileNames [list of str] - partial report files
+# Returns:
+#   reports [list of dict] - partial reports, ordered by project and shard
+def read_reports(fileNames):
+    reports = []
+    for fileName in fileNames:
+        try:
+            with open(fileName) as file:
+                reports.append(json.load(file))
+        except (OSError, ValueError) as e:
+            print(f"Error: could not read partial report {fileName}: {e}")
+    return sorted(reports, key=lambda report: (report["projectId"], report["shard"] or [0, 1]))
+
+# Check that every shard of each project has a report
+# Arg:
+#   reports [list of dict] - partial reports
+# Returns:
+#   missing [list of str] - project/shard for each shard without a report
+def missing_shards(reports):
+    seen = {}
+    for report in reports:
+        shardIndex, shardCount = report["shard"] or (0, 1)
+        seen.setdefault((report["projectId"], shardCount), set()).add(shardIndex)
+    return [f"{projectId} {shardIndex}/{shardCount}" for (projectId, shardCount), shards in sorted(seen.items())
+            for shardIndex in range(shardCount) if shardIndex not in shards]
+
+# Merge the partial reports
+# A secret rotated by two workers (e.g. after a lease was lost) is listed once per rotation, and a worker that
+# ran twice for the same shard only counts once for each rotation it reported
+# Arg:
+#   reports [list of dict] - partial reports
+# Returns:
+#   rotatedSecrets [list of obj] - rotation records (tagged with the project and owner)
+def merge_reports(reports):
+    rotatedSecrets = []
+    seen = set()
+    for report in reports:
+        for rotatedSecret, owner in zip(report["rotatedSecrets"], report["owners"]):
+            rotation = (report["projectId"], rotatedSecret["secretName"], rotatedSecret["newVersion"])
+            if rotation in seen:
+                continue
+            seen.add(rotation)
+            rotatedSecrets.append(RotationRecord.from_dict(rotatedSecret, report["projectId"], owner))
+        shardName = f"shard{report['shard'][0]}" if report["shard"] else None
+        METRICS.merge(report["metrics"], "/".join(name for name in (report["projectId"], shardName) if name))
+    return rotatedSecrets
+
+# Arg:
+#   fileNames [list of str] - partial report files
+#   outputType [dict] - specifies output file name, sender/recipient(s) emails and metrics file names
+#   profileName [str] - boto3 profile to send email (default=None)
+#   regionName [str] - aws region to send email (default=us-east-1)
+#   test [bool] *opt - set to True to testing mode (default=False)
+def main(fileNames, outputType, profileName=None, regionName="us-east-1", test=False):
+    reports = read_reports(fileNames)
+    missing = missing_shards(reports)
+    if missing:
+        print(f"Error: no partial report for shard(s): {', '.join(missing)}")
+    rotatedSecrets = merge_reports(reports)
+    projectIds = {report["projectId"] for report in reports}
+    print(f"Merged {len(reports)} partial report(s): rotated {len(rotatedSecrets)} secret(s) in {len(projectIds)} project(s)")
+    # boto3 is only needed to send emails
+    session = None
+    if outputType.get("sender"):
+        import boto3
+        if profileName:
+            session = boto3.Session(profile_name=profileName, region_name=regionName)
+        else:
+            session = boto3.Session(region_name=regionName)
+    # Write the merged report, notify and export metrics
+    finish_run(rotatedSecrets, session, outputType, test, withProject=len(projectIds) > 1)
+
+if __name__ == "__main__":
+    # Create an ArgumentParser object
+    parser = argparse.ArgumentParser(description="Use this script to merge the partial reports of sharded rotation workers")
+    # Create arguments
+    parser.add_argument("reports", type=str, nargs="+", help="Partial report files written with --partialReport")
+    parser.add_argument("--fileName", dest="fileName", type=str, help="Name of your file (include .csv extension)")
+    parser.add_argument("--profileName", dest="profileName", type=str, help="Profile to use for boto3")
+    parser.add_argument("--regionName", dest="regionName", type=str, default='us-east-1', help="aws region to send notification (default='us-east-1')")
+    parser.add_argument("--sender", dest="sender", type=str, help="SES sender to send notification")
+    parser.add_argument("--recipients", dest="recipients", type=str, nargs='+', help="Recipient(s) to receive notification (e.g. 'abc@gmail.com' 'xyz@yahoo.com'")
+    parser.add_argument("--test", dest="test", action="store_true", help="Enable dry-run testing mode (no owner notifications)")
+    parser.add_argument("--metricsFile", dest="metricsFile", type=str, help="Write the merged call/phase metrics to this JSON file")
+    parser.add_argument("--promFile", dest="promFile", type=str, help="Write the merged call/phase metrics to this Prometheus textfile (.prom)")
+    # Parse the command-line arguments
+    args = parser.parse_args(sys.argv[1:])
+    fileNames = args.reports
+    profileName = args.profileName
+    regionName = args.regionName
+    test = args.test
+    # Set up output types
+    outputType = {"fileName": args.fileName, "sender": args.sender, "recipients": args.recipients, "metricsFile": args.metricsFile, "promFile": args.promFile}
+    # Pass arguments to the main function
+    main(fileNames, outputType, profileName, regionName, test)
@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import math
+import time
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+from api_key_rotation import (SecretManager, KeyManager, RotationRecord, RotationJournal, JournalInUse, GCPError, METRICS, LIMITERS, BACKENDS,
+                              get_backend, set_rate_limits, open_report, authenticate, bounded_map)
+
+# Split a rotation into a plan phase and an apply phase
+# The plan is worked out from one read of the project's metadata (or from a saved snapshot/inventory, without any calls)
+# and saved to a file with the predicted api calls and runtime, so a large rotation can be reviewed before anything changes.
+# Applying a plan runs each step for a batch of secrets at the same time, stage by stage in the order a rotation needs them
+# (the new version is added before the old one is disabled and the old key is only deleted once the secret points at the new key).
+
+# Stages of an apply: (stage, operation, api family)
+STAGES = (
+    ("create keys", "api-keys.create", "api-keys"),
+    ("wait for keys", "operations.get", "api-keys"),
+    ("get key strings", "api-keys.get-key-string", "api-keys"),
+    ("add versions", "versions.add", "secrets.write"),
+    ("disable old versions", "versions.disable", "secrets.write"),
+    ("write annotations", "secrets.update", "secrets.write"),
+    ("delete old keys", "api-keys.delete", "api-keys"),
+)
+
+# Class to hold a rotation plan
+class RotationPlan:
+    formatName = "credential-manager-rotation-plan"
+    formatVersion = 1
+    # Init Arg:
+    #   projectId [str] - name of GCP project
+    #   expiryTime [int] - limit for how old secrets can be (in days)
+    #   rotations [list of dict] - secrets due for rotation (secretName, etag, owner, oldVersion, versionCreateTime, oldKeyId, keyName, apiTargets, allowedIps)
+    #   skipped [list of dict] - api key secrets that can't be rotated (secretName, reason)
+    #   secretCount [int] - number of secrets in the project
+    #   apiKeyCount [int] - number of api key secrets in the project
+    #   source [str] *opt - where the metadata was read from (default=live)
+    #   createTime [str] *opt - when the plan was made (default=now)
+    def __init__(self, projectId, expiryTime, rotations, skipped, secretCount, apiKeyCount, source="live", createTime=None):
+        self.projectId = projectId
+        self.expiryTime = expiryTime
+        self.rotations = rotations
+        self.skipped = skipped
+        self.secretCount = secretCount
+        self.apiKeyCount = apiKeyCount
+        self.source = source
+        self.createTime = createTime or datetime.now(timezone.utc).isoformat()
+        self.estimate = None
+    # Get the number of changes of each kind the plan makes
+    # Returns:
+    #   actions [dict] - action -> count
+    def actions(self):
+        count = len(self.rotations)
+        return {"create key": count, "add version": count, "disable version": count, "write annotation": count, "delete key": count}
+    # Predict the api calls and runtime of applying the plan
+    # Each stage of a batch takes as long as its slowest limit: the api family's rate, or the calls each worker makes one after another
+    # Arg:
+    #   maxWorkers [int] - max number of calls made at the same time
+    #   batchSize [int] - number of secrets that go through the stages together
+    #   callSeconds [float] - expected seconds per call
+    #   rates [dict] - api family -> starting calls per second
+    #   pageSize [int] *opt - number of secrets fetched per page when the plan is checked (default=None)
+    # Returns:
+    #   estimate [dict] - maxWorkers, batchSize, callSeconds, total calls and seconds, and the calls and seconds of each stage
+    def estimate_cost(self, maxWorkers, batchSize, callSeconds, rates, pageSize=None):
+        count = len(self.rotations)
+        batches = [min(batchSize, count - start) for start in range(0, count, batchSize)]
+        # The apply lists the secrets once to check nothing changed since the plan was made
+        pages = math.ceil(self.secretCount / pageSize) if pageSize else 1
+        stages = [{"stage": "check plan", "operation": "secrets.list", "calls": pages, "seconds": pages * callSeconds}]
+        stages += [{"stage": stage, "operation": operation, "calls": count, "seconds": 0} for stage, operation, family in STAGES]
+        # api family -> calls made so far (the rate limiters speed up as calls succeed)
+        made = {}
+        for size in batches:
+            for stage, (name, operation, family) in zip(stages[1:], STAGES):
+                limited = limited_seconds(rates[family], made.get(family, 0), size)
+                made[family] = made.get(family, 0) + size
+                stage["seconds"] += max(limited, math.ceil(size / maxWorkers) * callSeconds)
+                # Key creations are polled after a short wait
+                if operation == "operations.get":
+                    stage["seconds"] += 0.25
+        for stage in stages:
+            stage["seconds"] = round(stage["seconds"], 1)
+        self.estimate = {"maxWorkers": maxWorkers, "batchSize": batchSize, "callSeconds": round(callSeconds, 3), "batches": len(batches),
+                         "calls": sum(stage["calls"] for stage in stages), "seconds": round(sum(stage["seconds"] for stage in stages), 1), "stages": stages}
+        return self.estimate
+    # Save the plan to a file
+    # Arg:
+    #   fileName [str] - name of the plan file
+    def save(self, fileName):
+        data = {"format": self.formatName, "version": self.formatVersion, "projectId": self.projectId, "createTime": self.createTime,
+                "expiryTime": self.expiryTime, "source": self.source, "secretCount": self.secretCount, "apiKeyCount": self.apiKeyCount,
+                "actions": self.actions(), "estimate": self.estimate, "rotations": self.rotations, "skipped": self.skipped}
+        # Written in one step, so an apply never reads half a plan
+        tmpName = f"{fileName}.tmp"
+        with open(tmpName, "w") as file:
+            json.dump(data, file, indent=1)
+        os.replace(tmpName, fileName)
+    # Load a plan from a file
+    # Arg:
+    #   fileName [str] - name of the plan file
+    # Returns:
+    #   plan [obj] - loaded plan (raises ValueError if the file isn't a plan this version can read)
+    @classmethod
+    def load(cls, fileName):
+        with open(fileName) as file:
+            data = json.load(file)
+        if data.get("format") != cls.formatName:
+            raise ValueError(f"{fileName} is not a credential-manager rotation plan")
+        if data.get("version") != cls.formatVersion:
+            raise ValueError(f"{fileName} is plan version {data.get('version')} (expected {cls.formatVersion})")
+        plan = cls(data["projectId"], data["expiryTime"], data["rotations"], data["skipped"], data["secretCount"], data["apiKeyCount"],
+                   data["source"], data["createTime"])
+        plan.estimate = data.get("estimate")
+        return plan
+
+# Get how long a rate limiter takes to allow a run of calls
+# Each successful call raises the rate by 1/rate (up to 10 times the starting rate, see RateLimiter), so after k calls
+# the rate is about sqrt(rate^2 + 2k) and k calls take about sqrt(rate^2 + 2k) - rate seconds
+# Arg:
+#   rate [float] - starting calls per second
+#   start [int] - calls already made
+#   calls [int] - calls in the run
+# Returns:
+#   seconds [float] - seconds the run of calls takes
+def limited_seconds(rate, start, calls):
+    maxRate = rate * 10
+    capped = (maxRate ** 2 - rate ** 2) / 2
+    elapsed = lambda made: math.sqrt(rate ** 2 + 2 * made) - rate if made <= capped else maxRate - rate + (made - capped) / maxRate
+    return elapsed(start + calls) - elapsed(start)
+
+# Check whether an api key secret is due for rotation and work out its rotation
+# Arg:
+#   kMan [obj] - key manager instance (its key inventory holds the old key configs)
+#   record [obj] - secret record from the listing
+#   latestVersion [dict] - latest enabled version of the secret (None if it has none)
+#   expiryTime [int] - limit for how old secrets can be (in days)
+#   now [datetime] - current time
+# Returns:
+#   rotation [dict] - planned rotation (None if the secret isn't due)
+#   reason [str] - why the secret can't be rotated (None if it can, or isn't due)
+def plan_secret(kMan, record, latestVersion, expiryTime, now):
+    if not latestVersion:
+        return None, "no enabled version"
+    createDate = datetime.strptime(latestVersion.get("createTime"), "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+    if not now - createDate > timedelta(days=expiryTime):
+        return None, None
+    oldVersion = latestVersion.get("name").split("/")[-1]
+    oldKeyId = record.annotations.get(oldVersion)
+    if not oldKeyId:
+        return None, f"version {oldVersion} has no annotation"
+    try:
+        keyName, apiTargets, allowedIps = kMan.key_config(oldKeyId)
+    except GCPError as e:
+        return None, f"key {oldKeyId} could not be read: {e}"
+    return {"secretName": record.name, "etag": record.etag, "owner": record.annotations.get("notification"), "oldVersion": oldVersion,
+            "versionCreateTime": latestVersion.get("createTime"), "oldKeyId": oldKeyId, "keyName": keyName, "apiTargets": apiTargets,
+            "allowedIps": allowedIps}, None
+
+# Build a rotation plan from one read of the project's metadata
+# The secrets and keys are each listed once (at the same time) and the latest enabled version of each api key secret is
+# fetched as the secrets are listed; nothing is changed
+# Arg:
+#   sMan [obj] - secret manager instance
+#   kMan [obj] - key manager instance
+#   expiryTime [int] - limit for how old secrets can be (in days)
+#   maxWorkers [int] *opt - max number of secrets to fetch versions for at the same time (default=8)
+#   pageSize [int] *opt - number of secrets fetched per page (default=None)
+#   source [str] *opt - where the metadata is read from (default=live)
+# Returns:
+#   plan [obj] - rotation plan
+def build_plan(sMan, kMan, expiryTime, maxWorkers=8, pageSize=None, source="live"):
+    counts = {"secrets": 0, "api_key": 0}
+    now = datetime.now(timezone.utc)
+    rotations = []
+    skipped = []
+    with METRICS.span("discover"), ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        keysFuture = executor.submit(kMan.key_inventory)
+        def api_key_records():
+            for record in sMan.iter_records(pageSize):
+                counts["secrets"] += 1
+                if record.type == "api_key":
+                    counts["api_key"] += 1
+                    yield record
+        # Each secret is planned as its latest version comes back, so only the planned rotations are kept
+        for record, latestVersion in bounded_map(executor, lambda record: (record, sMan.latest_version(record.name)), api_key_records(), 2 * maxWorkers):
+            # The old key configs come from the key inventory
+            keysFuture.result()
+            rotation, reason = plan_secret(kMan, record, latestVersion, expiryTime, now)
+            if rotation:
+                rotations.append(rotation)
+            elif reason:
+                skipped.append({"secretName": record.name, "reason": reason})
+        keysFuture.result()
+    return RotationPlan(sMan.projectId, expiryTime, rotations, skipped, counts["secrets"], counts["api_key"], source)
+
+# Print a summary of a plan (and each planned rotation if asked)
+# Arg:
+#   plan [obj] - rotation plan
+#   verbose [bool] *opt - set to True to also list each rotation and skipped secret (default=False)
+def print_plan(plan, verbose=False):
+    actions = plan.actions()
+    print(f"Rotation plan for {plan.projectId} made {plan.createTime} from {plan.source} metadata (expiry {plan.expiryTime} day(s))")
+    print(f"  {len(plan.rotations)} of {plan.apiKeyCount} api_key secret(s) due for rotation ({plan.secretCount} secret(s) in the project)")
+    print(f"  {actions['create key']} key(s) to create, {actions['delete key']} key(s) to delete")
+    print(f"  {actions['add version']} version(s) to add, {actions['disable version']} version(s) to disable")
+    print(f"  {actions['write annotation']} annotation(s) to write")
+    if plan.skipped:
+        print(f"  {len(plan.skipped)} api_key secret(s) can't be rotated")
+    if verbose:
+        for rotation in plan.rotations:
+            print(f"  ~ {rotation['secretName']}: version {rotation['oldVersion']} ({rotation['versionCreateTime']}) -> new version, "
+                  f"key {rotation['oldKeyId']} ({rotation['keyName']}) -> new key")
+        for skip in plan.skipped:
+            print(f"  ! {skip['secretName']}: {skip['reason']}")
+    estimate = plan.estimate
+    if estimate:
+        print(f"Estimated cost: {estimate['calls']} api call(s) in {estimate['batches']} batch(es) of up to {estimate['batchSize']}, "
+              f"about {estimate['seconds']}s with {estimate['maxWorkers']} worker(s) at {estimate['callSeconds']}s per call")
+        for stage in estimate["stages"]:
+            print(f"  {stage['stage']:<22}{stage['calls']:>8} {stage['operation']:<26}~{stage['seconds']}s")
+
+# Run one step for every rotation in a batch at the same time, keeping the rotations it succeeded for
+# Arg:
+#   executor [obj] - thread pool to run the step on
+#   rotations [list of dict] - rotation states
+#   stage [str] - stage name (for errors)
+#   step [str] - journal step recorded when the step succeeds (None to not record it)
+#   phase [str] - metrics phase the step is timed under
+#   func [function] - does the step for a rotation, returning the details to keep (e.g. newVersion) or None
+#   journal [obj] *opt - rotation journal (default=None)
+#   failures [list of dict] *opt - each failed rotation is added with the stage it stopped at (default=None)
+# Returns:
+#   rotations [list of dict] - rotation states for the rotations that can go on to the next stage
+def run_stage(executor, rotations, stage, step, phase, func, journal=None, failures=None):
+    def attempt(rotation):
+        secretName = rotation["secretName"]
+        try:
+            with METRICS.span(phase, secretName):
+                data = func(rotation) or {}
+            if step:
+                if journal:
+                    journal.record(secretName, step, **data)
+                rotation["steps"].append(step)
+        except Exception as e:
+            print(f"Error: failed to rotate {secretName} ({stage}): {e}")
+            if failures is not None:
+                # A new key that exists but was never added to the secret has to be stored (--resume) or deleted
+                failures.append({"secretName": secretName, "stage": stage, "error": str(e),
+                                 "unstoredKeyId": rotation.get("newKeyId") if "newVersion" not in rotation else None})
+            return None
+        rotation.update(data)
+        return rotation
+    return [rotation for rotation in executor.map(attempt, rotations) if rotation]
+
+# Rotate one batch of secrets, stage by stage
+# A rotation that fails a stage is left where it stopped (with a journal, the next run with --resume finishes it)
+# Arg:
+#   sMan [obj] - secret manager instance
+#   kMan [obj] - key manager instance
+#   executor [obj] - thread pool to run the stages on
+#   batch [list of dict] - planned rotations
+#   maxWorkers [int] - max number of calls made at the same time
+#   journal [obj] *opt - rotation journal (default=None)
+# Returns:
+#   rotatedSecrets [list of obj] - rotation records for the rotations that finished
+#   failures [list of dict] - failed rotations (secretName, stage, error and unstoredKeyId, the new key if it was never stored)
+def apply_batch(sMan, kMan, executor, batch, maxWorkers, journal=None):
+    rotations = [{"secretName": planned["secretName"], "oldVersion": planned["oldVersion"], "oldKeyId": planned["oldKeyId"], "keyName": planned["keyName"],
+                  "apiTargets": planned["apiTargets"], "allowedIps": planned["allowedIps"], "steps": []} for planned in batch]
+    # Start every key creation before waiting on any of them
+    # The operations aren't journaled (a resumed rotation looks for its key by name instead)
+    operations = {}
+    failures = []
+    def create(rotation):
+        # Journaled before the key is requested, so a key created just before the apply stops is found by name when resuming
+        if journal:
+            journal.record(rotation["secretName"], "key requested", oldVersion=rotation["oldVersion"], oldKeyId=rotation["oldKeyId"], keyName=rotation["keyName"])
+        rotation["steps"].append("key requested")
+        operation = kMan.start_key(rotation["keyName"], rotation["apiTargets"], rotation["allowedIps"])
+        if not operation:
+            raise GCPError("key creation could not be started")
+        operations[rotation["secretName"]] = operation
+    rotations = run_stage(executor, rotations, "create keys", None, "rotate key", create, journal, failures)
+    newKeyIds = {}
+    with METRICS.span("rotate key"):
+        for index, newKeyId in kMan.wait_keys([operations[rotation["secretName"]] for rotation in rotations], maxWorkers):
+            newKeyIds[rotations[index]["secretName"]] = newKeyId
+    def created(rotation):
+        if not newKeyIds.get(rotation["secretName"]):
+            raise GCPError("new key was not created")
+        return {"newKeyId": newKeyIds[rotation["secretName"]]}
+    rotations = run_stage(executor, rotations, "wait for keys", "key created", "rotate key", created, journal, failures)
+    # Key strings are only kept in memory
+    rotations = run_stage(executor, rotations, "get key strings", None, "rotate key",
+                          lambda rotation: {"newKeyString": kMan.get_key_string(rotation["newKeyId"])}, journal, failures)
+    rotations = run_stage(executor, rotations, "add versions", "version added", "update secret",
+                          lambda rotation: {"newVersion": sMan.add_version(rotation["secretName"], rotation.pop("newKeyString"))}, journal, failures)
+    rotations = run_stage(executor, rotations, "disable old versions", "old version disabled", "update secret",
+                          lambda rotation: sMan.disable_version(rotation["secretName"], rotation["oldVersion"]), journal, failures)
+    rotations = run_stage(executor, rotations, "write annotations", "annotation added", "update secret",
+                          lambda rotation: sMan.add_annotation(rotation["secretName"], rotation["newVersion"], rotation["newKeyId"]), journal, failures)
+    def delete(rotation):
+        try:
+            kMan.delete_key(rotation["oldKeyId"])
+        except GCPError as e:
+            # A resumed run might have deleted the key just before it stopped
+            if not e.notFound:
+                raise
+    rotations = run_stage(executor, rotations, "delete old keys", "old key deleted", "rotate key", delete, journal, failures)
+    rotatedSecrets = [RotationRecord(rotation["secretName"], rotation["oldVersion"], rotation["newVersion"], rotation["keyName"], rotation["oldKeyId"], rotation["newKeyId"])
+                      for rotation in rotations]
+    return rotatedSecrets, failures
+
+# Apply a saved plan
+# The secrets are listed once first, and a secret that changed since the plan was made (or has an unfinished rotation) is left out
+# Arg:
+#   sMan [obj] - secret manager instance (each rotation, and each failure, is written to its report as its batch finishes)
+#   kMan [obj] - key manager instance
+#   plan [obj] - rotation plan
+#   maxWorkers [int] *opt - max number of calls made at the same time (default=8)
+#   batchSize [int] *opt - number of secrets that go through the stages together (default=100)
+#   pageSize [int] *opt - number of secrets fetched per page (default=None)
+#   journal [obj] *opt - rotation journal (default=None)
+# Returns:
+#   counts [dict] - planned, stale, unfinished, rotated and failed counts
+#   failures [list of dict] - failed rotations (secretName, stage, error and unstoredKeyId)
+def apply_plan(sMan, kMan, plan, maxWorkers=8, batchSize=100, pageSize=None, journal=None):
+    counts = {"planned": len(plan.rotations), "stale": 0, "unfinished": 0, "rotated": 0, "failed": 0}
+    # The listing also caches each secret's details, so writing the annotations doesn't need a describe call
+    etags = {record.name: record.etag for record in METRICS.timed_iter(sMan.iter_records(pageSize), phase="discover")}
+    rotations = []
+    failures = []
+    for planned in plan.rotations:
+        secretName = planned["secretName"]
+        if etags.get(secretName) != planned["etag"]:
+            print(f"Skipping {secretName}: it changed since the plan was made")
+            counts["stale"] += 1
+        elif journal and journal.is_incomplete(secretName):
+            print(f"Skipping {secretName}: it has an unfinished rotation")
+            counts["unfinished"] += 1
+        else:
+            # Keep the owner from the plan so notifying them doesn't need the secret again
+            sMan.owners[secretName] = planned["owner"]
+            rotations.append(planned)
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        for start in range(0, len(rotations), batchSize):
+            batch = rotations[start:start + batchSize]
+            print(f"-----\nRotating batch {start // batchSize + 1} of {math.ceil(len(rotations) / batchSize)} ({len(batch)} secret(s))...")
+            rotatedSecrets, batchFailures = apply_batch(sMan, kMan, executor, batch, maxWorkers, journal)
+            for rotatedSecret in rotatedSecrets:
+                sMan.record_rotation(rotatedSecret)
+                counts["rotated"] += 1
+            if sMan.report:
+                for failure in batchFailures:
+                    sMan.report.fail(failure)
+                sMan.report.flush()
+            failures += batchFailures
+    counts["failed"] = len(failures)
+    return counts, failures
+
+# Arg:
+#   projectId [str] - name of GCP project
+#   expiryTime [int] - limit for how old secrets can be (in days)
+#   fileName [str] - name of the plan file
+#   backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#   maxWorkers [int] *opt - max number of calls made at the same time, when planning and when applying (default=8)
+#   batchSize [int] *opt - number of secrets that go through the stages together when applying (default=100)
+#   pageSize [int] *opt - number of secrets fetched per page (default=None)
+#   rateLimits [dict] *opt - api family -> starting calls per second (default=None)
+#   snapshot [str] *opt - snapshot file (from secret_snapshot.py) to plan from instead of the project (default=None)
+#   inventory [str] *opt - inventory file (from secret_events.py) to plan from instead of listing the project (default=None)
+#   callSeconds [float] *opt - expected seconds per call for the estimate (default=latency of the first reads while planning, or 0.5 without live reads)
+def plan(projectId, expiryTime, fileName, backend="gcloud", maxWorkers=8, batchSize=100, pageSize=None, rateLimits=None, snapshot=None, inventory=None, callSeconds=None):
+    # Set the starting rates for the api families (the estimate uses them too)
+    if rateLimits:
+        set_rate_limits(rateLimits)
+    source = "live"
+    # Plan from a saved copy of the metadata (imported here since those modules import api_key_rotation)
+    # A snapshot replaces the project entirely, while an inventory still lists the keys from the project
+    try:
+        if snapshot:
+            from secret_snapshot import snapshot_backend
+            gcp = snapshot_backend(snapshot, projectId)
+            source = snapshot
+        elif inventory:
+            from secret_events import inventory_backend
+            gcp = inventory_backend(inventory, get_backend(projectId, backend))
+            source = inventory
+        else:
+            gcp = get_backend(projectId, backend)
+    except (OSError, ValueError) as e:
+        print(f"Error: could not read {snapshot or inventory}: {e}")
+        return
+    kMan = KeyManager(projectId, backend=gcp)
+    sMan = SecretManager(projectId, kMan, backend=gcp)
+    # An apply starts from the configured rates (planning speeds up the read limiter)
+    rates = {family: limiter.rate for family, limiter in LIMITERS.items()}
+    start = time.monotonic()
+    try:
+        rotationPlan = build_plan(sMan, kMan, expiryTime, maxWorkers, pageSize, source)
+    except GCPError as e:
+        print(f"Error: could not read the metadata of {projectId}: {e}")
+        return
+    readSeconds = time.monotonic() - start
+    # There might not be any secrets in the project
+    if not rotationPlan.secretCount:
+        print("Error: There are no secrets in this project")
+        return
+    # Use the latency of this run's reads unless the plan was made without any
+    # (only the first reads are used: the rate limiter's burst lets them through, so they don't include time waiting for it)
+    if callSeconds is None:
+        samples = METRICS.snapshot()["latencies"].get("versions.list")
+        callSeconds = METRICS.quantile(samples[:max(1, int(rates["secrets.read"]))], 0.5) if samples else 0.5
+    rotationPlan.estimate_cost(maxWorkers, batchSize, callSeconds, rates, pageSize)
+    rotationPlan.save(fileName)
+    print_plan(rotationPlan)
+    print(f"Planned in {readSeconds:.1f}s; saved to {fileName} (run it with: rotation_plan.py apply {fileName})")
+
+# Arg:
+#   fileName [str] - name of the plan file
+#   verbose [bool] *opt - set to True to also list each rotation and skipped secret (default=True)
+def show(fileName, verbose=True):
+    try:
+        rotationPlan = RotationPlan.load(fileName)
+    except (OSError, ValueError) as e:
+        print(f"Error: could not read plan {fileName}: {e}")
+        return
+    print_plan(rotationPlan, verbose)
+
+# Arg:
+#   fileName [str] - name of the plan file
+#   outputType [dict] - specifies output file name, sender/recipient(s) emails and metrics file names
+#   profileName [str] *opt - boto3 profile to send email (default=None)
+#   regionName [str] *opt - aws region to access secret (default=us-east-1)
+#   secretName [str] *opt - secret that contains service account key file (default=None)
+#   debug [bool] *opt - set to True to print debugging statements (default=False)
+#   backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#   maxWorkers [int] *opt - max number of calls made at the same time (default=the plan's)
+#   batchSize [int] *opt - number of secrets that go through the stages together (default=the plan's)
+#   pageSize [int] *opt - number of secrets fetched per page (default=None)
+#   rateLimits [dict] *opt - api family -> starting calls per second (default=None)
+#   journal [bool] *opt - set to True to journal rotation steps, so rotations the apply doesn't finish can be resumed with api_key_rotation.py --resume (default=False)
+#   journalDir [str] *opt - directory for the rotation journal (default=~/.cache/credential-manager)
+def apply(fileName, outputType, profileName=None, regionName="us-east-1", secretName=None, debug=False, backend="gcloud", maxWorkers=None, batchSize=None, pageSize=None, rateLimits=None, journal=False, journalDir=None):
+    try:
+        rotationPlan = RotationPlan.load(fileName)
+    except (OSError, ValueError) as e:
+        print(f"Error: could not read plan {fileName}: {e}")
+        return
+    estimate = rotationPlan.estimate or {}
+    maxWorkers = maxWorkers or estimate.get("maxWorkers", 8)
+    batchSize = batchSize or estimate.get("batchSize", 100)
+    projectId = rotationPlan.projectId
+    # Set the starting rates for the api families
+    if rateLimits:
+        set_rate_limits(rateLimits)
+    # Take the journal first, so an apply that another run is already journaling stops before authenticating
+    try:
+        rotationJournal = RotationJournal(projectId, journalDir) if journal else None
+    except JournalInUse as e:
+        print(f"Error: {e}")
+        return
+    try:
+        # boto3 is imported here (it is slow to import), as in api_key_rotation.py
+        import boto3
+        if profileName:
+            session = boto3.Session(profile_name=profileName, region_name=regionName)
+        else:
+            session = boto3.Session(region_name=regionName)
+        if secretName:
+            authenticate(session, secretName)
+        # Initialize the key and secret manager instances (sharing one backend)
+        gcp = get_backend(projectId, backend, debug)
+        kMan = KeyManager(projectId, debug, False, gcp)
+        sMan = SecretManager(projectId, kMan, debug, False, gcp)
+        print_plan(rotationPlan)
+        start = time.monotonic()
+        callsBefore = METRICS.snapshot()["calls"]
+        # Each batch's rotations are written to the report as the batch finishes
+        sMan.report = open_report(outputType, session, False)
+        try:
+            counts, failures = apply_plan(sMan, kMan, rotationPlan, maxWorkers, batchSize, pageSize, rotationJournal)
+        finally:
+            # Finish the report, notify and export metrics, even if the apply stopped partway (the keys that were rotated have changed)
+            sMan.report.close()
+    finally:
+        if rotationJournal:
+            rotationJournal.close()
+    calls = METRICS.snapshot()["calls"]
+    madeCalls = sum(calls.get(operation, 0) - callsBefore.get(operation, 0) for operation in {stage["operation"] for stage in estimate.get("stages", [])})
+    print(f"=====\nRotated {counts['rotated']} of {counts['planned']} planned secret(s) ({counts['failed']} failed, "
+          f"{counts['stale']} changed since the plan, {counts['unfinished']} with unfinished rotations)")
+    for failure in failures:
+        print(f"  failed: {failure['secretName']} at {failure['stage']}")
+    # These keys exist but no secret holds them
+    unstored = [failure for failure in failures if failure["unstoredKeyId"]]
+    if unstored:
+        print(f"{len(unstored)} new key(s) were created but never stored in their secret "
+              f"({'finish them with api_key_rotation.py --resume --journal' if rotationJournal else 'delete them, or store them by hand'}):")
+        for failure in unstored:
+            print(f"  {failure['secretName']}: {failure['unstoredKeyId']}")
+    if estimate:
+        print(f"Made {madeCalls} api call(s) in {time.monotonic() - start:.1f}s (estimated {estimate['calls']} in about {estimate['seconds']}s)")
+
+if __name__ == "__main__":
+    # Create an ArgumentParser object
+    parser = argparse.ArgumentParser(description="Use this script to plan a rotation (with its predicted cost) without changing anything, and to apply a saved plan")
+    commands = parser.add_subparsers(dest="command", required=True)
+    # Create arguments
+    planParser = commands.add_parser("plan", help="Work out which secrets are due and what rotating them will cost, and save the plan")
+    planParser.add_argument("projectId", type=str, help="Google Cloud Project Id")
+    planParser.add_argument("expiryTime", type=int, help="Time in days after which secrets should be rotated")
+    planParser.add_argument("--fileName", dest="fileName", type=str, help="Name of the plan file (\"<projectId>-plan.json\" if not specified)")
+    planParser.add_argument("--backend", dest="backend", type=str, default="gcloud", choices=BACKENDS, help="Backend for GCP calls (default='gcloud')")
+    planParser.add_argument("--maxWorkers", dest="maxWorkers", type=int, default=8, help="Max number of calls made at the same time, when planning and when applying (default=8)")
+    planParser.add_argument("--batchSize", dest="batchSize", type=int, default=100, help="Number of secrets that go through the stages together when applying (default=100)")
+    planParser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets fetched per page")
+    planParser.add_argument("--rateLimits", dest="rateLimits", type=str, nargs="+", help=f"Starting calls per second per api family, e.g. secrets.write=10 (families: {', '.join(LIMITERS)})")
+    planParser.add_argument("--snapshot", dest="snapshot", type=str, help="Plan from this snapshot (from secret_snapshot.py) without any calls")
+    planParser.add_argument("--inventory", dest="inventory", type=str, help="Plan from this inventory (kept current by secret_events.py) instead of listing the project")
+    planParser.add_argument("--callSeconds", dest="callSeconds", type=float, help="Expected seconds per call for the estimate (default=latency of the first reads while planning, or 0.5)")
+    showParser = commands.add_parser("show", help="Print a saved plan, listing each rotation")
+    showParser.add_argument("planFile", type=str, help="Plan file")
+    applyParser = commands.add_parser("apply", help="Apply a saved plan in batched, concurrent stages")
+    applyParser.add_argument("planFile", type=str, help="Plan file")
+    applyParser.add_argument("--fileName", dest="fileName", type=str, help="Name of your report file (include .csv or .jsonl extension)")
+    applyParser.add_argument("--profileName", dest="profileName", type=str, help="Profile to use for boto3")
+    applyParser.add_argument("--regionName", dest="regionName", type=str, default='us-east-1', help="aws region to access secret (default='us-east-1')")
+    applyParser.add_argument("--secretName", dest="secretName", type=str, help="Secret for GCP service account key info")
+    applyParser.add_argument("--sender", dest="sender", type=str, help="SES sender to send notification")
+    applyParser.add_argument("--recipients", dest="recipients", type=str, nargs='+', help="Recipient(s) to receive notification (e.g. 'abc@gmail.com' 'xyz@yahoo.com'")
+    applyParser.add_argument("--metricsFile", dest="metricsFile", type=str, help="Write call/phase metrics for the run to this JSON file")
+    applyParser.add_argument("--promFile", dest="promFile", type=str, help="Write call/phase metrics for the run to this Prometheus textfile (.prom)")
+    applyParser.add_argument("--debug", dest="debug", action="store_true", help="Enable debug mode")
+    applyParser.add_argument("--backend", dest="backend", type=str, default="gcloud", choices=BACKENDS, help="Backend for GCP calls (default='gcloud')")
+    applyParser.add_argument("--maxWorkers", dest="maxWorkers", type=int, help="Max number of calls made at the same time (default=the plan's)")
+    applyParser.add_argument("--batchSize", dest="batchSize", type=int, help="Number of secrets that go through the stages together (default=the plan's)")
+    applyParser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets fetched per page")
+    applyParser.add_argument("--rateLimits", dest="rateLimits", type=str, nargs="+", help=f"Starting calls per second per api family, e.g. secrets.write=10 (families: {', '.join(LIMITERS)})")
+    applyParser.add_argument("--journal", dest="journal", action="store_true", help="Journal rotation steps so rotations the apply doesn't finish can be resumed with api_key_rotation.py --resume")
+    applyParser.add_argument("--journalDir", dest="journalDir", type=str, help="Directory for the rotation journal (default=~/.cache/credential-manager)")
+    # Parse the command-line arguments
+    args = parser.parse_args(sys.argv[1:])
+    if args.command == "plan" and args.snapshot and args.inventory:
+        parser.error("--snapshot and --inventory can't be used together")
+    rateLimits = {family: float(rate) for family, rate in (item.split("=", 1) for item in args.rateLimits)} if getattr(args, "rateLimits", None) else None
+    # Pass arguments to the main functions
+    if args.command == "plan":
+        plan(args.projectId, args.expiryTime, args.fileName or f"{args.projectId}-plan.json", args.backend, args.maxWorkers, args.batchSize, args.pageSize,
+             rateLimits, args.snapshot, args.inventory, args.callSeconds)
+    elif args.command == "show":
+        show(args.planFile)
+    else:
+        outputType = {"fileName": args.fileName, "sender": args.sender, "recipients": args.recipients, "metricsFile": args.metricsFile, "promFile": args.promFile}
+        apply(args.planFile, outputType, args.profileName, args.regionName, args.secretName, args.debug, args.backend, args.maxWorkers, args.batchSize,
+              args.pageSize, rateLimits, args.journal, args.journalDir)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import sys
+import json
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+from api_key_rotation import SecretManager, KeyManager, GCPError, BACKENDS, LIMITERS, get_backend, set_rate_limits, bounded_map
+
+# Keep long-lived api key secrets small: every rotation adds a version and a version -> key uid annotation
+# and nothing removes them, so the secret's describe payload and version list keep growing.
+# Compaction drops all but the most recent version annotations and destroys disabled versions once they have been
+# replaced for longer than the retention window.
+
+# Plan the compaction of one api key secret
+# The annotation of an enabled version is always kept (rotation reads the latest one), other annotations such as
+# type and notification are never touched, and the latest version is never destroyed
+# Arg:
+#   secretName [str] - name of secret
+#   annotations [dict] - annotations of the secret
+#   versions [list of dict] - versions of the secret (newest first)
+#   keepAnnotations [int] - number of most recent version annotations to keep
+#   retentionDays [float] - days a disabled version is kept after a newer version replaced it
+#   now [datetime] - current time
+# Returns:
+#   actions [list of dict] - secretName, action ("remove annotation" or "destroy version") and target for each change
+def plan_compaction(secretName, annotations, versions, keepAnnotations, retentionDays, now):
+    actions = []
+    enabled = {version.get("name").split("/")[-1] for version in versions if version.get("state") == "ENABLED"}
+    # Version annotations, newest first
+    mappings = sorted((name for name in annotations if name.isdigit()), key=int, reverse=True)
+    for name in mappings[keepAnnotations:]:
+        if name not in enabled:
+            actions.append({"secretName": secretName, "action": "remove annotation", "target": name})
+    # A version's retention starts when the next version was added (which is when rotation disabled it)
+    cutoff = now - timedelta(days=retentionDays)
+    for newer, version in zip(versions, versions[1:]):
+        replaced = datetime.strptime(newer.get("createTime"), "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+        if version.get("state") == "DISABLED" and replaced < cutoff:
+            actions.append({"secretName": secretName, "action": "destroy version", "target": version.get("name").split("/")[-1]})
+    return actions
+
+# Carry out the planned changes for one secret (in test mode they are only printed)
+# The annotations are removed in one update, then the versions are destroyed one at a time
+# Arg:
+#   sMan [obj] - secret manager instance
+#   actions [list of dict] - planned changes for the secret
+# Returns:
+#   results [list of dict] - each action with its status ("DONE", "DRY RUN" or "FAILED") and error
+def compact_secret(sMan, actions):
+    results = []
+    status = "DRY RUN" if sMan.test else "DONE"
+    removals = [action for action in actions if action["action"] == "remove annotation"]
+    if removals:
+        try:
+            sMan.remove_annotations(removals[0]["secretName"], [action["target"] for action in removals])
+            results += [dict(action, status=status, error=None) for action in removals]
+        # Retryable errors have already been retried (a changed etag means the secret is compacted next time)
+        except GCPError as e:
+            results += [dict(action, status="FAILED", error=str(e)) for action in removals]
+    for action in actions:
+        if action["action"] != "destroy version":
+            continue
+        try:
+            sMan.destroy_version(action["secretName"], action["target"])
+            results.append(dict(action, status=status, error=None))
+        except GCPError as e:
+            results.append(dict(action, status="FAILED", error=str(e)))
+    return results
+
+# Plan and carry out the compaction of one api key secret
+# Arg:
+#   sMan [obj] - secret manager instance
+#   record [obj] - secret record from the listing
+#   keepAnnotations [int] - number of most recent version annotations to keep
+#   retentionDays [float] - days a disabled version is kept after a newer version replaced it
+#   pageSize [int] *opt - number of versions fetched per page (default=None)
+# Returns:
+#   results [list of dict] - result of each change (a single FAILED row if the versions couldn't be listed)
+def compact_record(sMan, record, keepAnnotations, retentionDays, pageSize=None):
+    try:
+        versions = list(sMan.iter_versions(record.name, pageSize))
+    except GCPError as e:
+        return [{"secretName": record.name, "action": "list versions", "target": "-", "status": "FAILED", "error": str(e)}]
+    actions = plan_compaction(record.name, record.annotations, versions, keepAnnotations, retentionDays, datetime.now(timezone.utc))
+    return compact_secret(sMan, actions) if actions else []
+
+# Format a compaction result as a line of the report
+# Arg:
+#   result [dict] - result of a change
+#   outputFormat [str] - "csv" or "jsonl"
+# Returns:
+#   line [str] - line for the report
+def format_result(result, outputFormat):
+    if outputFormat == "jsonl":
+        return json.dumps(result) + "\n"
+    return f"{result['secretName']}, {result['action']}, {result['target']}, {result['status']}, {result['error'] or '-'}\n"
+
+# Arg:
+#   projectId [str] - name of GCP project
+#   fileName [str] *opt - name of the report (default=compaction.csv)
+#   backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#   pageSize [int] *opt - number of secrets/versions fetched per page (default=None)
+#   maxWorkers [int] *opt - max number of secrets to compact at the same time (default=1)
+#   keepAnnotations [int] *opt - number of most recent version annotations to keep (default=5)
+#   retentionDays [float] *opt - days a disabled version is kept after a newer version replaced it (default=30)
+#   test [bool] *opt - set to True to testing mode, where nothing is changed (default=False)
+#   rateLimits [dict] *opt - api family -> starting calls per second (default=None)
+#   outputFormat [str] *opt - "csv" or "jsonl" (default=jsonl if fileName ends in .jsonl, otherwise csv)
+def main(projectId, fileName="compaction.csv", backend="gcloud", pageSize=None, maxWorkers=1, keepAnnotations=5, retentionDays=30, test=False, rateLimits=None, outputFormat=None):
+    outputFormat = outputFormat or ("jsonl" if fileName.endswith(".jsonl") else "csv")
+    # Set the starting rates for the api families
+    if rateLimits:
+        set_rate_limits(rateLimits)
+    # Initialize the key and secret manager instances (sharing one backend)
+    gcp = get_backend(projectId, backend)
+    kMan = KeyManager(projectId, debug=False, test=test, backend=gcp)
+    sMan = SecretManager(projectId, kMan, debug=False, test=test, backend=gcp)
+    counts = {"secrets": 0, "api_key": 0, "compacted": 0, "DONE": 0, "DRY RUN": 0, "FAILED": 0}
+    # Get the api key secrets as the secrets are listed page by page (the listing also caches their details and etags)
+    def api_key_records():
+        for record in sMan.iter_records(pageSize):
+            counts["secrets"] += 1
+            if record.type == "api_key":
+                counts["api_key"] += 1
+                yield record
+    # The report is opened once and written through its buffer
+    with open(fileName, "w") as file, ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        if outputFormat == "csv":
+            file.write("Secret Name, Action, Target, Status, Error\n")
+        for results in bounded_map(executor, lambda record: compact_record(sMan, record, keepAnnotations, retentionDays, pageSize), api_key_records(), 2 * maxWorkers):
+            counts["compacted"] += bool(results)
+            for result in results:
+                counts[result["status"]] += 1
+                if result["status"] == "FAILED":
+                    print(f"Error: could not {result['action']} {result['target']} of {result['secretName']}: {result['error']}")
+                file.write(format_result(result, outputFormat))
+    # There might not be any secrets in the project
+    if not counts["secrets"]:
+        print("Error: There are no secrets in this project")
+        return
+    if test:
+        print(f"Dry run: would make {counts['DRY RUN']} change(s) to {counts['compacted']} of {counts['api_key']} api_key secret(s)")
+    else:
+        print(f"Made {counts['DONE']} change(s) to {counts['compacted']} of {counts['api_key']} api_key secret(s) ({counts['FAILED']} failed)")
+    print(f"Wrote compaction report to {fileName}")
+
+if __name__ == "__main__":
+    # Create an ArgumentParser object
+    parser = argparse.ArgumentParser(description="Use this script to remove old version annotations and destroy old disabled versions of api key secrets")
+    # Create arguments
+    parser.add_argument("projectId", type=str, help="Google Cloud Project Id")
+    parser.add_argument("--fileName", dest="fileName", type=str, default="compaction.csv", help="Name of the report (\"compaction.csv\" if not specified)")
+    parser.add_argument("--backend", dest="backend", type=str, default="gcloud", choices=BACKENDS, help="Backend for GCP calls (default='gcloud')")
+    parser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets/versions fetched per page")
+    parser.add_argument("--maxWorkers", dest="maxWorkers", type=int, default=8, help="Max number of secrets to compact at the same time (default=8)")
+    parser.add_argument("--keepAnnotations", dest="keepAnnotations", type=int, default=5, help="Number of most recent version annotations to keep per secret (default=5)")
+    parser.add_argument("--retentionDays", dest="retentionDays", type=float, default=30, help="Days a disabled version is kept after a newer version replaced it (default=30)")
+    parser.add_argument("--test", dest="test", action="store_true", help="Enable dry-run testing mode (only prints what would change)")
+    parser.add_argument("--rateLimits", dest="rateLimits", type=str, nargs="+", help=f"Starting calls per second per api family, e.g. secrets.write=10 (families: {', '.join(LIMITERS)})")
+    parser.add_argument("--format", dest="outputFormat", type=str, choices=["csv", "jsonl"], help="Report format (default=jsonl if the file name ends in .jsonl, otherwise csv)")
+    # Parse the command-line arguments
+    args = parser.parse_args(sys.argv[1:])
+    if args.keepAnnotations < 1:
+        parser.error("--keepAnnotations must be at least 1")
+    projectId = args.projectId
+    fileName = args.fileName
+    backend = args.backend
+    pageSize = args.pageSize
+    maxWorkers = args.maxWorkers
+    keepAnnotations = args.keepAnnotations
+    retentionDays = args.retentionDays
+    test = args.test
+    rateLimits = {family: float(rate) for family, rate in (item.split("=", 1) for item in args.rateLimits)} if args.rateLimits else None
+    outputFormat = args.outputFormat
+    # Pass arguments to the main function
+    main(projectId, fileName, backend, pageSize, maxWorkers, keepAnnotations, retentionDays, test, rateLimits, outputFormat)
@@ -3,79 +3,230 @@ import sys
 import os
 import json
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import argparse
-from api_key_rotation import SecretManager, KeyManager
+from api_key_rotation import SecretManager, KeyManager, GCPError, BACKENDS, LIMITERS, get_backend, set_rate_limits, bounded_map
+from secret_snapshot import snapshot_backend
+
+# Audit an api key secret from a single versions listing
+# Arg:
+#   sMan [obj] - secret manager instance
+#   secretName [str] - name of secret
+#   pageSize [int] *opt - number of versions fetched per page (default=None)
+# Returns:
+#   row [dict] - audit result for the secret
+def audit_secret(sMan, secretName, pageSize=None):
+    row = {"secretName": secretName, "status": "INSUFFICIENT DATA", "latestVersion": None, "latestEnabled": None, "totalEnabled": None, "enabledVersions": [], "error": None, "detail": None}
+    # Go through the versions for the secret (newest first), keeping only the enabled version numbers
+    latestVersion = None
+    try:
+        for version in sMan.iter_versions(secretName, pageSize):
+            latestVersion = latestVersion or version
+            if version.get('state') == 'ENABLED':
+                row["enabledVersions"].append(version.get('name').split("/")[-1])
+    # The versions might not be readable (retryable errors have already been retried)
+    except GCPError as e:
+        row["error"] = "Could not list versions"
+        row["detail"] = str(e)
+        return row
+    # The secret might not have any versions
+    if not latestVersion:
+        row["error"] = "No versions"
+        return row
+    row["latestVersion"] = latestVersion.get('name').split("/")[-1]
+    row["latestEnabled"] = latestVersion.get('state')=='ENABLED'
+    row["totalEnabled"] = len(row["enabledVersions"])
+    # If latest is the only version enabled, it's OK
+    if row["latestEnabled"] and row["totalEnabled"] <= 1:
+        row["status"] = "OK"
+    # Otherwise, it's in violation
+    else:
+        row["status"] = "IN VIOLATION"
+        row["error"] = 'Latest version not enabled' if not row["latestEnabled"] else 'Multiple versions enabled'
+    return row
+
+# Format an audit result as a line of the output file
+# Arg:
+#   row [dict] - audit result for a secret
+#   outputFormat [str] - "csv" or "jsonl"
+# Returns:
+#   line [str] - line for the output file
+def format_row(row, outputFormat):
+    if outputFormat == "jsonl":
+        return json.dumps(row) + "\n"
+    if row["status"] == "INSUFFICIENT DATA":
+        return f"{row['secretName']}, INSUFFICIENT DATA, -, -, -, {row['error']}\n"
+    return f"{row['secretName']}, {row['status']}, {row['latestEnabled']}, {row['totalEnabled']}, {'/'.join(row['enabledVersions'])}, {row['error'] or '-'}\n"
+
+# Plan the version changes that bring a secret in line with the policy (only the latest version enabled)
+# The latest version is enabled before any other version is disabled, so the secret always has an enabled version
+# Arg:
+#   row [dict] - audit result for the secret
+# Returns:
+#   actions [list of dict] - secretName, action ("enable" or "disable") and version for each change, in order
+def plan_remediation(row):
+    if row["status"] != "IN VIOLATION":
+        return []
+    actions = []
+    if not row["latestEnabled"]:
+        actions.append({"secretName": row["secretName"], "action": "enable", "version": row["latestVersion"]})
+    for version in row["enabledVersions"]:
+        if version != row["latestVersion"]:
+            actions.append({"secretName": row["secretName"], "action": "disable", "version": version})
+    return actions
+
+# Carry out the planned changes for one secret (in test mode they are only printed)
+# If the latest version can't be enabled, the other versions are left enabled
+# Arg:
+#   sMan [obj] - secret manager instance
+#   actions [list of dict] - planned changes for the secret
+# Returns:
+#   results [list of dict] - each action with its status ("DONE", "DRY RUN", "FAILED" or "SKIPPED") and error
+def remediate_secret(sMan, actions):
+    results = []
+    enableFailed = False
+    for action in actions:
+        if enableFailed:
+            results.append(dict(action, status="SKIPPED", error="Latest version could not be enabled"))
+            continue
+        try:
+            if action["action"] == "enable":
+                sMan.enable_version(action["secretName"], action["version"])
+            else:
+                sMan.disable_version(action["secretName"], action["version"])
+        # Retryable errors have already been retried by the rate limiter
+        except GCPError as e:
+            enableFailed = action["action"] == "enable"
+            results.append(dict(action, status="FAILED", error=str(e)))
+            continue
+        results.append(dict(action, status="DRY RUN" if sMan.test else "DONE", error=None))
+    return results
+
+# Format a remediation result as a line of the remediation report
+# Arg:
+#   result [dict] - remediation result for a version
+#   outputFormat [str] - "csv" or "jsonl"
+# Returns:
+#   line [str] - line for the report
+def format_result(result, outputFormat):
+    if outputFormat == "jsonl":
+        return json.dumps(result) + "\n"
+    return f"{result['secretName']}, {result['action']}, {result['version']}, {result['status']}, {result['error'] or '-'}\n"
+
+# Remediate the planned secrets in parallel and write a report of what changed
+# The writes go through the secrets.write rate limiter, which backs off when GCP throttles
+# Arg:
+#   sMan [obj] - secret manager instance
+#   plans [list of list] - planned changes for each secret in violation
+#   fileName [str] - name of the remediation report
+#   maxWorkers [int] - max number of secrets to remediate at the same time
+#   outputFormat [str] - "csv" or "jsonl"
+def remediate_violations(sMan, plans, fileName, maxWorkers, outputFormat):
+    counts = {"DONE": 0, "DRY RUN": 0, "FAILED": 0, "SKIPPED": 0}
+    with open(fileName, "w") as file, ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        if outputFormat == "csv":
+            file.write("Secret Name, Action, Version, Status, Error\n")
+        for results in executor.map(lambda actions: remediate_secret(sMan, actions), plans):
+            for result in results:
+                counts[result["status"]] += 1
+                if result["status"] == "FAILED":
+                    print(f"Error: could not {result['action']} version {result['version']} of {result['secretName']}: {result['error']}")
+                file.write(format_result(result, outputFormat))
+    totalActions = sum(counts.values())
+    if sMan.test:
+        print(f"Dry run: would change {counts['DRY RUN']} version(s) across {len(plans)} secret(s)")
+    else:
+        print(f"Changed {counts['DONE']} of {totalActions} version(s) across {len(plans)} secret(s) ({counts['FAILED']} failed, {counts['SKIPPED']} skipped)")
+    print(f"Wrote remediation report to {fileName}")
 
 # Arg:
 #   projectId [str] - name of GCP project
-#   fileName [str] *opt - name of the output file (default=secrets-rotation.csv)
-def main(projectId, fileName="secrets-config.csv"):
-    # Initialize the key and secret manager instances
-    kMan = KeyManager(projectId, debug=False, test=False)
-    sMan = SecretManager(projectId, kMan, debug=False, test=False)
-    # Begin the file and write the headers
-    with open(fileName, "w") as file:
-        file.write("Secret Name, Status, Is Latest Enabled?, How Many Versions Enabled?, Which Versions Enabled?, Error\n")
-    # List all the secrets
-    secrets = sMan.list_secrets()
+#   fileName [str] *opt - name of the output file (default=secrets-config.csv)
+#   backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#   pageSize [int] *opt - number of secrets/versions fetched per page (default=None)
+#   snapshot [str] *opt - snapshot file to audit offline instead of calling GCP (default=None)
+#   maxWorkers [int] *opt - max number of secrets to audit at the same time (default=1)
+#   outputFormat [str] *opt - "csv" or "jsonl" (default=jsonl if fileName ends in .jsonl, otherwise csv)
+#   remediate [bool] *opt - set to True to fix the secrets in violation (default=False)
+#   test [bool] *opt - set to True to testing mode, where remediation only prints what it would change (default=False)
+#   remediationFile [str] *opt - name of the remediation report (default=remediation.csv, or .jsonl to match outputFormat)
+#   rateLimits [dict] *opt - api family -> starting calls per second (default=None)
+def main(projectId, fileName="secrets-config.csv", backend="gcloud", pageSize=None, snapshot=None, maxWorkers=1, outputFormat=None, remediate=False, test=False, remediationFile=None, rateLimits=None):
+    outputFormat = outputFormat or ("jsonl" if fileName.endswith(".jsonl") else "csv")
+    remediationFile = remediationFile or f"remediation.{outputFormat}"
+    # Set the starting rates for the api families
+    if rateLimits:
+        set_rate_limits(rateLimits)
+    # Initialize the key and secret manager instances (against the snapshot if there is one)
+    gcp = snapshot_backend(snapshot, projectId) if snapshot else get_backend(projectId, backend)
+    projectId = gcp.projectId
+    kMan = KeyManager(projectId, debug=False, test=False, backend=gcp)
+    sMan = SecretManager(projectId, kMan, debug=False, test=test, backend=gcp)
+    totalSecrets = 0
+    # Planned changes for each secret in violation
+    plans = []
+    # Get the api key secrets as the secrets are listed page by page (the type comes from the listing)
+    def api_key_secrets():
+        nonlocal totalSecrets
+        for record in sMan.iter_records(pageSize):
+            totalSecrets += 1
+            if record.type=="api_key":
+                yield record.name
+    # The output file is opened once and written through its buffer
+    with open(fileName, "w") as file, ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        # Begin the file and write the headers
+        if outputFormat == "csv":
+            file.write("Secret Name, Status, Is Latest Enabled?, How Many Versions Enabled?, Which Versions Enabled?, Error\n")
+        # Each secret is audited as it is listed (a few ahead of the row being written) and the rows come back in listing order
+        for row in bounded_map(executor, lambda secretName: audit_secret(sMan, secretName, pageSize), api_key_secrets(), 2 * maxWorkers):
+            print(f"-----\nSecret Name: {row['secretName']}")
+            if row["status"] == "INSUFFICIENT DATA":
+                print(f"Error: {row['secretName']}: {row['detail'] or row['error']}")
+            else:
+                print(f"{row['secretName']}:\n  is latest enabled: {row['latestEnabled']}\n  total versions enabled: {row['totalEnabled']}")
+            file.write(format_row(row, outputFormat))
+            actions = plan_remediation(row) if remediate else []
+            if actions:
+                plans.append(actions)
     # There might not be any secrets in the project
-    if not secrets:
+    if not totalSecrets:
         print("Error: There are no secrets in this project")
-    for secret in secrets:
-        secretName = secret.get("name").split("/")[-1]
-        print(f"-----\nSecret Name: {secretName}")
-        secretType = sMan.check_type(secretName)
-        # Check that the secret is for an api key
-        if not secretType=="api_key":
-            print(f"{secretName} is not an api_key")
-            continue
-        # List the versions for the secret
-        versions = sMan.list_versions(secretName)
-        # The secret might not have any versions
-        if not versions:
-            print(f"Error: {secretName} has no versions")
-            with open(fileName, "a") as file:
-                file.write(f"{secretName}, INSUFFICIENT DATA, -, -, -, No versions\n")
-            continue
-        # Check the enabled versions
-        enabledVersions = []
-        for version in versions:
-            if version.get('state') == 'ENABLED':
-                enabledVersions.append(version.get('name').split("/")[-1])
-        totalEnabled = len(enabledVersions)
-        enabledVersions = "/".join(enabledVersions)
-        # Check if the latest version is enabled
-        latestVersion = sMan.latest_version(secretName, enabled=False)
-        latestEnabled = latestVersion.get('state')=='ENABLED'
-        print(f"{secretName}:\n  is latest enabled: {latestEnabled}\n  total versions enabled: {totalEnabled}")
-        # Write results to output file
-        with open(fileName, "a") as file:
-            file.write(f"{secretName}")
-        # If latest is the only version enabled
-        if latestEnabled and totalEnabled <= 1:
-            with open(fileName, "a") as file:
-                file.write(", OK")
-                error = "-"
-        # Otherwise, it's in violation
-        else:
-            with open(fileName, "a") as file:
-                file.write(", IN VIOLATION")
-            if not latestVersion:
-                error = 'Latest version not enabled'
-            elif totalEnabled > 1:
-                error = 'Multiple versions enabled'
-        with open(fileName, "a") as file:
-            file.write(f", {latestEnabled}, {totalEnabled}, {enabledVersions}, {error}\n")
+    # Fix the violations once the audit is written
+    if remediate:
+        remediate_violations(sMan, plans, remediationFile, maxWorkers, outputFormat)
 
 if __name__ == "__main__":
     # Create an ArgumentParser object
     parser = argparse.ArgumentParser(description="Use this script to rotate keys associated with old secrets")
     # Create arguments
-    parser.add_argument("projectId", type=str, help="Google Cloud Project Id")
+    parser.add_argument("projectId", type=str, nargs="?", help="Google Cloud Project Id (optional with --snapshot)")
     parser.add_argument("--fileName", dest="fileName", type=str, default="secrets-config.csv", help="Name of your file (\"secrets-config.csv\" if not specified)")
+    parser.add_argument("--backend", dest="backend", type=str, default="gcloud", choices=BACKENDS, help="Backend for GCP calls (default='gcloud')")
+    parser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets/versions fetched per page")
+    parser.add_argument("--snapshot", dest="snapshot", type=str, help="Audit this snapshot file (from secret_snapshot.py) offline instead of calling GCP")
+    parser.add_argument("--maxWorkers", dest="maxWorkers", type=int, default=8, help="Max number of secrets to audit at the same time (default=8)")
+    parser.add_argument("--format", dest="outputFormat", type=str, choices=["csv", "jsonl"], help="Output format (default=jsonl if the file name ends in .jsonl, otherwise csv)")
+    parser.add_argument("--remediate", dest="remediate", action="store_true", help="Enable the latest version and disable the others for every secret in violation")
+    parser.add_argument("--test", dest="test", action="store_true", help="Enable dry-run testing mode (remediation only prints what it would change)")
+    parser.add_argument("--remediationFile", dest="remediationFile", type=str, help="Name of the remediation report (default=remediation.csv, or .jsonl with --format jsonl)")
+    parser.add_argument("--rateLimits", dest="rateLimits", type=str, nargs="+", help=f"Starting calls per second per api family, e.g. secrets.write=10 (families: {', '.join(LIMITERS)})")
     # Parse the command-line arguments
     args = parser.parse_args(sys.argv[1:])
+    if not args.projectId and not args.snapshot:
+        parser.error("a projectId or --snapshot is required")
+    # A snapshot can't be changed, but it can be used to plan a remediation
+    if args.remediate and args.snapshot and not args.test:
+        parser.error("--remediate with --snapshot needs --test")
     projectId = args.projectId
     fileName = args.fileName
+    backend = args.backend
+    pageSize = args.pageSize
+    snapshot = args.snapshot
+    maxWorkers = args.maxWorkers
+    outputFormat = args.outputFormat
+    remediate = args.remediate
+    test = args.test
+    remediationFile = args.remediationFile
+    rateLimits = {family: float(rate) for family, rate in (item.split("=", 1) for item in args.rateLimits)} if args.rateLimits else None
     # Pass arguments to the main function
-    main(projectId, fileName)
\ No newline at end of file
+    main(projectId, fileName, backend, pageSize, snapshot, maxWorkers, outputFormat, remediate, test, remediationFile, rateLimits)
\ No newline at end of file
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import base64
+import time
+import threading
+from datetime import datetime, timezone, timedelta
+import argparse
+from api_key_rotation import GCPError, BACKENDS, get_backend
+from secret_snapshot import Snapshot, SnapshotBackend
+
+# Keep a local inventory of a project's secrets current from Secret Manager change events, so the other scripts
+# don't have to list the whole project to see what changed.
+# Secret Manager publishes an event to the secrets' Pub/Sub topic whenever a secret or one of its versions changes
+# (the message data is the secret or version as it was after the change). The inventory is a snapshot file (see
+# secret_snapshot.py), so secret_config_check.py and secret_lookup.py read it with --snapshot and api_key_rotation.py
+# with --inventory. A full reconcile (a new snapshot) replaces it every reconcileHours, which also picks up anything
+# that didn't send an event (e.g. key changes, or secrets without a topic).
+
+# Event types that change the inventory (other events, e.g. SECRET_ROTATE, are acknowledged and skipped)
+SECRET_EVENTS = {"SECRET_CREATE", "SECRET_UPDATE", "SECRET_DELETE"}
+VERSION_EVENTS = {"SECRET_VERSION_ADD", "SECRET_VERSION_ENABLE", "SECRET_VERSION_DISABLE", "SECRET_VERSION_DESTROY"}
+
+# Read a change event from a received Pub/Sub message
+# Arg:
+#   received [dict] - received message ({"ackId": ..., "message": {...}}) or a bare Pub/Sub message
+# Returns:
+#   event [dict] - eventType, secretName, resource (secret or version name), data and publishTime (datetime)
+def read_event(received):
+    message = received.get("message", received)
+    attributes = message.get("attributes") or {}
+    data = message.get("data")
+    # Secret and version names use the project number, so only the last parts are kept
+    resource = attributes.get("versionId") or attributes.get("secretId") or ""
+    parts = resource.split("/")
+    return {"eventType": attributes.get("eventType"), "secretName": parts[3] if len(parts) > 3 else None,
+            "resource": "/".join(parts[3:]), "data": json.loads(base64.b64decode(data)) if data else {},
+            "publishTime": datetime.fromisoformat(message.get("publishTime")) if message.get("publishTime") else datetime.now(timezone.utc)}
+
+# Class to read change events from a Pub/Sub subscription
+class SubscriptionSource:
+    # Init Arg:
+    #   gcp [obj] - backend instance
+    #   subscription [str] - subscription id (or full subscription name)
+    def __init__(self, gcp, subscription):
+        self.gcp = gcp
+        self.subscription = subscription
+    # Arg:
+    #   maxMessages [int] - max number of messages returned
+    # Returns:
+    #   received [list of dict] - received messages (empty once the subscription is drained)
+    def pull(self, maxMessages):
+        return self.gcp.pull_messages(self.subscription, maxMessages)
+    # Arg:
+    #   ackIds [list of str] - ack ids of the messages that were applied
+    def ack(self, ackIds):
+        self.gcp.ack_messages(self.subscription, ackIds)
+
+# Class to read change events from a local file instead of a subscription (e.g. for testing)
+# The file has one Pub/Sub message per line (as pulled, or bare). The number of lines acknowledged so far is
+# kept in {fileName}.offset, so each message is applied once even if the file keeps growing.
+class FileSource:
+    # Init Arg:
+    #   fileName [str] - events file (JSON lines)
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.offsetName = f"{fileName}.offset"
+        try:
+            with open(self.offsetName) as file:
+                self.offset = int(file.read().strip() or 0)
+        except FileNotFoundError:
+            self.offset = 0
+        self.position = self.offset
+    # (see SubscriptionSource for args/returns)
+    def pull(self, maxMessages):
+        received = []
+        with open(self.fileName) as file:
+            for lineNum, line in enumerate(file):
+                if lineNum < self.position or not line.strip():
+                    continue
+                if len(received) == maxMessages:
+                    break
+                received.append(dict(json.loads(line), ackId=str(lineNum)))
+                self.position = lineNum + 1
+        return received
+    def ack(self, ackIds):
+        # Messages are acknowledged in the order they were pulled, so the offset is the line after the last one
+        self.offset = max([self.offset] + [int(ackId) + 1 for ackId in ackIds])
+        with open(self.offsetName, "w") as file:
+            file.write(str(self.offset))
+
+# Class to keep a snapshot of a project up to date from change events
+class EventInventory:
+    # Init Arg:
+    #   gcp [obj] - backend instance (used for full reconciles)
+    #   fileName [str] - inventory file (a snapshot file)
+    #   reconcileHours [float] *opt - hours between full reconciles (default=24)
+    #   maxWorkers [int] *opt - max number of secrets to fetch versions for at the same time when reconciling (default=8)
+    #   pageSize [int] *opt - number of secrets fetched per page when reconciling (default=None)
+    def __init__(self, gcp, fileName, reconcileHours=24, maxWorkers=8, pageSize=None):
+        self.gcp = gcp
+        self.fileName = fileName
+        self.reconcileHours = reconcileHours
+        self.maxWorkers = maxWorkers
+        self.pageSize = pageSize
+        self.snapshot = Snapshot.load(fileName) if os.path.exists(fileName) else None
+        if self.snapshot and self.snapshot.projectId != gcp.projectId:
+            raise ValueError(f"{fileName} is an inventory of {self.snapshot.projectId}, not {gcp.projectId}")
+    # Check if the inventory needs a full reconcile
+    # Returns:
+    #   reconcile [bool] - True if there is no inventory yet or it was last reconciled more than reconcileHours ago
+    def reconcile_due(self):
+        return not self.snapshot or datetime.now(timezone.utc) - datetime.fromisoformat(self.snapshot.createTime) >= timedelta(hours=self.reconcileHours)
+    # Replace the inventory with a new snapshot of the project
+    def reconcile(self):
+        self.snapshot = Snapshot.capture(self.gcp, self.maxWorkers, self.pageSize)
+        print(f"Reconciled inventory: {len(self.snapshot.secrets)} secret(s), {len(self.snapshot.keys)} key(s)")
+    # Apply a change event to the inventory
+    # Events can arrive late, twice or out of order, so an event is only applied if it is newer than the snapshot
+    # and than the last event applied to the same secret or version
+    # Arg:
+    #   event [dict] - change event (from read_event)
+    # Returns:
+    #   applied [bool] - True if the event changed the inventory
+    def apply(self, event):
+        if event["eventType"] not in SECRET_EVENTS | VERSION_EVENTS or not event["secretName"]:
+            return False
+        publishTime = event["publishTime"].isoformat()
+        lastTime = self.snapshot.updates.get(event["resource"])
+        if event["publishTime"] <= datetime.fromisoformat(self.snapshot.createTime) or (lastTime and publishTime <= lastTime):
+            return False
+        self.snapshot.updates[event["resource"]] = publishTime
+        if event["eventType"] == "SECRET_DELETE":
+            self.snapshot.remove_secret(event["secretName"])
+        elif event["eventType"] in SECRET_EVENTS:
+            self.snapshot.put_secret(event["data"])
+        # A version event for a secret the inventory doesn't have yet (its create event is still to come) is kept for it
+        else:
+            self.snapshot.put_version(event["secretName"], event["data"])
+        return True
+    # Bring the inventory up to date: reconcile if it is due, then apply the waiting events
+    # Each pull is applied, saved and acknowledged before the next one, so the messages are acknowledged well within
+    # their ack deadline and aren't delivered again while the sync is still running (applying an event twice is harmless,
+    # and the inventory is always saved before its events are acknowledged, so an event is never lost)
+    # Arg:
+    #   source [obj] - event source (SubscriptionSource or FileSource)
+    #   reconcile [bool] *opt - set to True to force a full reconcile (default=False)
+    #   maxMessages [int] *opt - max number of messages pulled at a time (default=100)
+    #   maxSeconds [float] *opt - stop pulling after this many seconds, leaving the rest for the next sync (default=300)
+    # Returns:
+    #   counts [dict] - events received and applied, and whether the inventory was reconciled
+    def sync(self, source, reconcile=False, maxMessages=100, maxSeconds=300):
+        counts = {"received": 0, "applied": 0, "reconciled": False}
+        if reconcile or self.reconcile_due():
+            self.reconcile()
+            self.snapshot.save(self.fileName)
+            counts["reconciled"] = True
+        deadline = time.monotonic() + maxSeconds
+        while time.monotonic() < deadline:
+            received = source.pull(maxMessages)
+            if not received:
+                break
+            applied = 0
+            for message in received:
+                counts["received"] += 1
+                applied += self.apply(read_event(message))
+            counts["applied"] += applied
+            if applied:
+                self.snapshot.save(self.fileName)
+            source.ack([message.get("ackId") for message in received])
+        return counts
+
+# Class to serve the secret reads for a run from an inventory, while everything else goes to the live backend
+# Once a secret is changed (or is marked with bypass), its reads go to the live backend too, so a rotation always
+# sees the versions and annotations it has just written.
+class InventoryBackend:
+    # Init Arg:
+    #   snapshot [obj] - loaded inventory
+    #   gcp [obj] - live backend instance
+    def __init__(self, snapshot, gcp):
+        self.inventory = SnapshotBackend(snapshot)
+        self.gcp = gcp
+        self.projectId = gcp.projectId
+        # Secrets whose reads go to the live backend
+        self.live = set()
+        self.lock = threading.Lock()
+    # Pass the key, Pub/Sub and other calls through to the live backend
+    def __getattr__(self, name):
+        return getattr(self.gcp, name)
+    # Read some secrets from the live backend from now on
+    # Arg:
+    #   secretNames [iterable of str] - names of secrets
+    def bypass(self, secretNames):
+        with self.lock:
+            self.live.update(secretNames)
+    # Get the backend to read a secret from
+    def reader(self, secretName):
+        with self.lock:
+            live = secretName in self.live or secretName not in self.inventory.snapshot.secretsByName
+        return self.gcp if live else self.inventory
+    # Same operations as GCP (see api_key_rotation.py for args/returns)
+    def list_secrets(self, limit=None, createdAfter=None):
+        return self.inventory.list_secrets(limit, createdAfter)
+    def iter_secrets(self, pageSize=None, createdAfter=None):
+        return self.inventory.iter_secrets(pageSize, createdAfter)
+    def describe_secret(self, secretName):
+        return self.reader(secretName).describe_secret(secretName)
+    def list_versions(self, secretName, limit=None, enabled=False):
+        return self.reader(secretName).list_versions(secretName, limit, enabled)
+    def iter_versions(self, secretName, pageSize=None, enabled=False):
+        return self.reader(secretName).iter_versions(secretName, pageSize, enabled)
+    def enable_version(self, secretName, version):
+        self.bypass([secretName])
+        return self.gcp.enable_version(secretName, version)
+    def disable_version(self, secretName, version):
+        self.bypass([secretName])
+        return self.gcp.disable_version(secretName, version)
+    def destroy_version(self, secretName, version):
+        self.bypass([secretName])
+        return self.gcp.destroy_version(secretName, version)
+    def update_annotations(self, secretName, annotations):
+        self.bypass([secretName])
+        return self.gcp.update_annotations(secretName, annotations)
+    def remove_annotations(self, secretName, annotations, names, etag=None):
+        self.bypass([secretName])
+        return self.gcp.remove_annotations(secretName, annotations, names, etag)
+    def add_version(self, secretName, payload):
+        self.bypass([secretName])
+        return self.gcp.add_version(secretName, payload)
+
+# Load an inventory to read a run's secrets from
+# Arg:
+#   fileName [str] - inventory file
+#   gcp [obj] - live backend instance
+# Returns:
+#   gcp [obj] - inventory backend (raises ValueError if the inventory is for another project)
+def inventory_backend(fileName, gcp):
+    snapshot = Snapshot.load(fileName)
+    if snapshot.projectId != gcp.projectId:
+        raise ValueError(f"{fileName} is an inventory of {snapshot.projectId}, not {gcp.projectId}")
+    updateTime = snapshot.update_time()
+    print(f"Using inventory of {snapshot.projectId} reconciled {snapshot.createTime}" + (f" (changes applied up to {updateTime})" if updateTime else ""))
+    return InventoryBackend(snapshot, gcp)
+
+# Arg:
+#   projectId [str] - name of GCP project
+#   fileName [str] - inventory file
+#   subscription [str] *opt - Pub/Sub subscription for the project's secret events (default=None)
+#   eventsFile [str] *opt - file to read events from instead of a subscription (default=None)
+#   backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#   reconcileHours [float] *opt - hours between full reconciles (default=24)
+#   reconcile [bool] *opt - set to True to force a full reconcile (default=False)
+#   maxWorkers [int] *opt - max number of secrets to fetch versions for at the same time when reconciling (default=8)
+#   pageSize [int] *opt - number of secrets fetched per page when reconciling (default=None)
+#   maxMessages [int] *opt - max number of messages pulled at a time (default=100)
+#   maxSeconds [float] *opt - stop pulling after this many seconds, leaving the rest for the next sync (default=300)
+def sync(projectId, fileName, subscription=None, eventsFile=None, backend="gcloud", reconcileHours=24, reconcile=False, maxWorkers=8, pageSize=None, maxMessages=100, maxSeconds=300):
+    gcp = get_backend(projectId, backend)
+    source = FileSource(eventsFile) if eventsFile else SubscriptionSource(gcp, subscription)
+    try:
+        inventory = EventInventory(gcp, fileName, reconcileHours, maxWorkers, pageSize)
+        counts = inventory.sync(source, reconcile, maxMessages, maxSeconds)
+    except (OSError, ValueError, GCPError) as e:
+        print(f"Error: could not sync inventory {fileName}: {e}")
+        return
+    print(f"Inventory of {projectId} saved to {fileName}: applied {counts['applied']} of {counts['received']} event(s)"
+          + (" after a full reconcile" if counts["reconciled"] else ""))
+
+if __name__ == "__main__":
+    # Create an ArgumentParser object
+    parser = argparse.ArgumentParser(description="Use this script to keep a local inventory of a project's secrets current from Secret Manager change events")
+    commands = parser.add_subparsers(dest="command", required=True)
+    # Create arguments
+    syncParser = commands.add_parser("sync", help="Apply the waiting change events to the inventory (reconciling first if it is due)")
+    syncParser.add_argument("projectId", type=str, help="Google Cloud Project Id")
+    syncParser.add_argument("--fileName", dest="fileName", type=str, help="Name of the inventory file (\"<projectId>-inventory.json.gz\" if not specified)")
+    syncParser.add_argument("--subscription", dest="subscription", type=str, help="Pub/Sub subscription on the secrets' notification topic")
+    syncParser.add_argument("--eventsFile", dest="eventsFile", type=str, help="Read the events from this file (one Pub/Sub message per line) instead of a subscription")
+    syncParser.add_argument("--backend", dest="backend", type=str, default="gcloud", choices=BACKENDS, help="Backend for GCP calls (default='gcloud')")
+    syncParser.add_argument("--reconcileHours", dest="reconcileHours", type=float, default=24, help="Hours between full reconciles of the inventory (default=24)")
+    syncParser.add_argument("--reconcile", dest="reconcile", action="store_true", help="Fully reconcile the inventory now")
+    syncParser.add_argument("--maxWorkers", dest="maxWorkers", type=int, default=8, help="Max number of secrets to fetch versions for at the same time when reconciling (default=8)")
+    syncParser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets fetched per page when reconciling")
+    syncParser.add_argument("--maxMessages", dest="maxMessages", type=int, default=100, help="Max number of messages pulled at a time (default=100)")
+    syncParser.add_argument("--maxSeconds", dest="maxSeconds", type=float, default=300, help="Stop pulling after this many seconds and leave the rest for the next sync (default=300)")
+    # Parse the command-line arguments
+    args = parser.parse_args(sys.argv[1:])
+    if not args.subscription and not args.eventsFile:
+        parser.error("--subscription or --eventsFile is required")
+    # Pass arguments to the main functions
+    sync(args.projectId, args.fileName or f"{args.projectId}-inventory.json.gz", args.subscription, args.eventsFile, args.backend,
+         args.reconcileHours, args.reconcile, args.maxWorkers, args.pageSize, args.maxMessages, args.maxSeconds)
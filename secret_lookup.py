@@ -2,34 +2,192 @@
 import sys
 import os
 import json
+import sqlite3
 from datetime import datetime, timezone, timedelta
 import argparse
-from api_key_rotation import SecretManager, KeyManager
+from api_key_rotation import SecretManager, KeyManager, BACKENDS, get_backend
+from secret_snapshot import snapshot_backend
+
+# Class to keep a local index of which secret (and version) each key uid belongs to
+# The index is a SQLite file per project, so repeated lookups don't need to list every secret
+class KeyIndex:
+    # Init Arg:
+    #   sMan [obj] - secret manager instance (used to refresh the index)
+    #   cacheDir [str] *opt - directory for the index file (default=~/.cache/credential-manager)
+    #   pageSize [int] *opt - number of secrets fetched per page when refreshing (default=None)
+    def __init__(self, sMan, cacheDir=None, pageSize=None):
+        self.sMan = sMan
+        self.pageSize = pageSize
+        cacheDir = cacheDir or os.path.join(os.path.expanduser("~"), ".cache", "credential-manager")
+        os.makedirs(cacheDir, exist_ok=True)
+        self.path = os.path.join(cacheDir, f"{sMan.projectId}-keys.sqlite")
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS secrets (name TEXT PRIMARY KEY, createTime TEXT, etag TEXT, currentKey TEXT, currentVersion TEXT);
+            CREATE TABLE IF NOT EXISTS keys (keyId TEXT PRIMARY KEY, secretName TEXT, version TEXT);
+            CREATE INDEX IF NOT EXISTS keysBySecret ON keys (secretName);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+        """)
+    # Get a value from the meta table
+    def get_meta(self, name):
+        row = self.db.execute("SELECT value FROM meta WHERE name=?", (name,)).fetchone()
+        return row[0] if row else None
+    # Set a value in the meta table
+    def set_meta(self, name, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+    # Check how long ago the index was fully synced
+    # Returns:
+    #   age [timedelta] - time since the last full sync (None if it has never been synced)
+    def age(self):
+        lastSync = self.get_meta("lastFullSync")
+        return datetime.now(timezone.utc) - datetime.fromisoformat(lastSync) if lastSync else None
+    # Add or replace the entries for a secret
+    # Arg:
+    #   secret [dict] - secret details (from list_secrets)
+    # Returns:
+    #   changed [bool] - True if the secret was new or had changed
+    def upsert(self, secret):
+        secretName = secret.get("name").split("/")[-1]
+        etag = secret.get("etag")
+        row = self.db.execute("SELECT etag FROM secrets WHERE name=?", (secretName,)).fetchone()
+        if row and etag and row[0] == etag:
+            return False
+        annotations = secret.get("annotations") or {}
+        # Annotations map version number -> key uid
+        versions = {version: keyId for version, keyId in annotations.items() if version.isdigit()}
+        currentVersion = max(versions, key=int) if versions else None
+        self.db.execute("DELETE FROM keys WHERE secretName=?", (secretName,))
+        self.db.executemany("INSERT OR REPLACE INTO keys VALUES (?, ?, ?)", [(keyId, secretName, version) for version, keyId in versions.items()])
+        self.db.execute("INSERT OR REPLACE INTO secrets VALUES (?, ?, ?, ?, ?)", (secretName, secret.get("createTime"), etag, versions.get(currentVersion), currentVersion))
+        return True
+    # Add or replace the entries for secrets as they are listed
+    # Arg:
+    #   secrets [iterable of dict] - secrets (from iter_secrets)
+    # Returns:
+    #   names [set of str] - names of the listed secrets
+    #   changed [int] - number of new or changed secrets
+    def upsert_all(self, secrets):
+        names = set()
+        changed = 0
+        watermark = self.get_meta("createWatermark") or ""
+        for secret in secrets:
+            names.add(secret.get("name").split("/")[-1])
+            changed += self.upsert(secret)
+            watermark = max(watermark, secret.get("createTime") or "")
+        # Save the newest create time seen so the next incremental refresh starts from there
+        if watermark:
+            self.set_meta("createWatermark", watermark)
+        return names, changed
+    # Rebuild the index from a full listing of the secrets
+    # Unchanged secrets (same etag) are left as they are and deleted secrets are removed
+    def full_sync(self):
+        names, changed = self.upsert_all(self.sMan.iter_secrets(self.pageSize))
+        removed = [name for (name,) in self.db.execute("SELECT name FROM secrets") if name not in names]
+        for name in removed:
+            self.db.execute("DELETE FROM secrets WHERE name=?", (name,))
+            self.db.execute("DELETE FROM keys WHERE secretName=?", (name,))
+        self.set_meta("lastFullSync", datetime.now(timezone.utc).isoformat())
+        self.db.commit()
+        print(f"Index synced: {len(names)} secret(s), {changed} changed, {len(removed)} removed")
+    # Add secrets created since the last refresh
+    def incremental_sync(self):
+        _, changed = self.upsert_all(self.sMan.iter_secrets(self.pageSize, self.get_meta("createWatermark")))
+        self.db.commit()
+        print(f"Index refreshed: {changed} new or changed secret(s)")
+    # Bring the index up to date
+    # Arg:
+    #   refresh [bool] *opt - set to True to force a full sync (default=False)
+    #   maxAge [float] *opt - hours after which a full sync is needed (default=24)
+    # Returns:
+    #   synced [bool] - True if a full sync was done
+    def refresh(self, refresh=False, maxAge=24):
+        age = self.age()
+        if refresh or age is None or age > timedelta(hours=maxAge):
+            self.full_sync()
+            return True
+        return False
+    # Look up the secrets for key uids
+    # Arg:
+    #   keyIds [list of str] - key uids to search for
+    # Returns:
+    #   matches [dict] - key uid -> (secret name, version, is current key)
+    def lookup(self, keyIds):
+        matches = {}
+        for keyId, secretName, version, currentKey in self.db.execute(
+                f"SELECT keys.keyId, keys.secretName, keys.version, secrets.currentKey FROM keys JOIN secrets ON keys.secretName = secrets.name "
+                f"WHERE keys.keyId IN ({','.join('?' * len(keyIds))})", keyIds):
+            matches[keyId] = (secretName, version, keyId == currentKey)
+        return matches
+    # Look up key uids, refreshing the index for any that aren't found
+    # New secrets are picked up with an incremental refresh first, then a full sync (which also sees
+    # rotations on existing secrets) if keys are still missing
+    # Arg:
+    #   keyIds [list of str] - key uids to search for
+    #   synced [bool] *opt - set to True if the index was just fully synced (default=False)
+    # Returns:
+    #   matches [dict] - key uid -> (secret name, version, is current key)
+    def find(self, keyIds, synced=False):
+        matches = self.lookup(keyIds)
+        if len(matches) < len(keyIds) and not synced:
+            self.incremental_sync()
+            matches = self.lookup(keyIds)
+            if len(matches) < len(keyIds):
+                self.full_sync()
+                matches = self.lookup(keyIds)
+        return matches
 
 # Arg:
 #   projectId [str] - name of GCP project
-#   keyId [str] - the key uid to search for
-def main(projectId, keyId):
-    # Initialize the key and secret manager instances
-    kMan = KeyManager(projectId, debug=False, test=False)
-    sMan = SecretManager(projectId, kMan, debug=False, test=False)
-    # Get list of all secrets
-    secrets = sMan.list_secrets()
-    # Search for secret that has annotation matching the key Id
-    secret = next((secret for secret in secrets if any(keyId == v for v in secret["annotations"].values())), None)
-    # Report the secret name
-    secretName = secret.get("name").split("/")[-1]
-    print(f"Key uid: {keyId}\n Secret: {secretName}")
-    
+#   keyIds [str or list of str] - the key uid(s) to search for
+#   backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#   refresh [bool] *opt - set to True to fully re-sync the local index first (default=False)
+#   maxAge [float] *opt - hours after which the local index is fully re-synced (default=24)
+#   cacheDir [str] *opt - directory for the local index (default=~/.cache/credential-manager)
+#   pageSize [int] *opt - number of secrets fetched per page (default=None)
+#   snapshot [str] *opt - snapshot file to search offline instead of calling GCP (default=None)
+def main(projectId, keyIds, backend="gcloud", refresh=False, maxAge=24, cacheDir=None, pageSize=None, snapshot=None):
+    keyIds = [keyIds] if isinstance(keyIds, str) else list(keyIds)
+    # A snapshot is searched in memory, so the local index isn't needed
+    if snapshot:
+        matches = snapshot_backend(snapshot, projectId).snapshot.lookup(keyIds)
+    else:
+        # Initialize the key and secret manager instances
+        gcp = get_backend(projectId, backend)
+        kMan = KeyManager(projectId, debug=False, test=False, backend=gcp)
+        sMan = SecretManager(projectId, kMan, debug=False, test=False, backend=gcp)
+        # Search the local index for secrets that have annotations matching the key Ids
+        index = KeyIndex(sMan, cacheDir, pageSize)
+        synced = index.refresh(refresh, maxAge)
+        matches = index.find(keyIds, synced)
+    # Report the secret names
+    for keyId in keyIds:
+        if keyId not in matches:
+            print(f"Key uid: {keyId}\n Secret: not found")
+            continue
+        secretName, version, current = matches[keyId]
+        print(f"Key uid: {keyId}\n Secret: {secretName}\n Version: {version}{' (current)' if current else ''}")
+
 if __name__ == "__main__":
     # Create an ArgumentParser object
     parser = argparse.ArgumentParser(description="Use this script to rotate keys associated with old secrets")
     # Create arguments
     parser.add_argument("projectId", type=str, help="Google Cloud Project Id")
-    parser.add_argument("keyId", type=str, help="The key uid that you would like to search with")
+    parser.add_argument("keyIds", type=str, nargs='+', help="The key uid(s) that you would like to search with")
+    parser.add_argument("--backend", dest="backend", type=str, default="gcloud", choices=BACKENDS, help="Backend for GCP calls (default='gcloud')")
+    parser.add_argument("--refresh", dest="refresh", action="store_true", help="Fully re-sync the local key index before searching")
+    parser.add_argument("--maxAge", dest="maxAge", type=float, default=24, help="Hours after which the local key index is fully re-synced (default=24)")
+    parser.add_argument("--cacheDir", dest="cacheDir", type=str, help="Directory for the local key index (default=~/.cache/credential-manager)")
+    parser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets fetched per page")
+    parser.add_argument("--snapshot", dest="snapshot", type=str, help="Search this snapshot file (from secret_snapshot.py) offline instead of calling GCP")
     # Parse the command-line arguments
     args = parser.parse_args(sys.argv[1:])
     projectId = args.projectId
-    keyId = args.keyId
+    keyIds = args.keyIds
+    backend = args.backend
+    refresh = args.refresh
+    maxAge = args.maxAge
+    cacheDir = args.cacheDir
+    pageSize = args.pageSize
+    snapshot = args.snapshot
     # Pass arguments to the main function
-    main(projectId, keyId)
\ No newline at end of file
+    main(projectId, keyIds, backend, refresh, maxAge, cacheDir, pageSize, snapshot)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import gzip
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+from api_key_rotation import GCPError, BACKENDS, get_backend, bounded_map
+
+# Class to hold a dump of a project's secret metadata, versions, annotations and api key configs
+# Secret payloads and key strings are never fetched, so a snapshot can be shared like any other audit output.
+# Snapshots are gzipped JSON with a format version, and lookups against a loaded snapshot use in-memory indexes.
+class Snapshot:
+    formatName = "credential-manager-snapshot"
+    formatVersion = 1
+    # Init Arg:
+    #   projectId [str] - name of GCP project
+    #   secrets [list of dict] - secrets (in api order)
+    #   versions [dict] - secret name -> versions (newest first)
+    #   keys [list of dict] - api keys
+    #   createTime [str] *opt - when the snapshot was taken (default=now)
+    #   updates [dict] *opt - secret or version name -> publish time of the last change event applied to it (default=None)
+    def __init__(self, projectId, secrets, versions, keys, createTime=None, updates=None):
+        self.projectId = projectId
+        self.secrets = secrets
+        self.versions = versions
+        self.keys = keys
+        self.createTime = createTime or datetime.now(timezone.utc).isoformat()
+        self.updates = updates or {}
+        self.secretsByName = {secret.get("name").split("/")[-1]: secret for secret in secrets}
+        # Keys can be looked up by uid or by the last part of their resource name
+        self.keysById = {}
+        for key in keys:
+            self.keysById[key.get("name", "").split("/")[-1]] = key
+            if key.get("uid"):
+                self.keysById[key.get("uid")] = key
+        # key uid -> (secret name, version, is current key), built by lookup
+        self.keyIndex = None
+    # Take a snapshot of a project
+    # The secrets are listed once and their versions are fetched in parallel while the keys are listed
+    # Arg:
+    #   gcp [obj] - backend instance
+    #   maxWorkers [int] *opt - max number of secrets to fetch versions for at the same time (default=8)
+    #   pageSize [int] *opt - number of secrets fetched per page (default=None)
+    # Returns:
+    #   snapshot [obj] - snapshot of the project
+    @classmethod
+    def capture(cls, gcp, maxWorkers=8, pageSize=None):
+        createTime = datetime.now(timezone.utc).isoformat()
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            keysFuture = executor.submit(gcp.list_keys)
+            secrets = []
+            # Keep each secret as it is listed and fetch its versions straight away
+            def listed():
+                for secret in gcp.iter_secrets(pageSize):
+                    secrets.append(secret)
+                    yield secret.get("name").split("/")[-1]
+            def fetch_versions(secretName):
+                return secretName, gcp.list_versions(secretName)
+            versions = dict(bounded_map(executor, fetch_versions, listed(), 2 * maxWorkers))
+            keys = keysFuture.result()
+        # Drop anything that could hold a key string
+        keys = [{field: value for field, value in key.items() if field != "keyString"} for key in keys]
+        versions = {secretName: [{field: value for field, value in version.items() if field != "payload"} for version in secretVersions]
+                    for secretName, secretVersions in versions.items()}
+        return cls(gcp.projectId, secrets, versions, keys, createTime)
+    # Save the snapshot to a file
+    # Arg:
+    #   fileName [str] - name of the snapshot file
+    def save(self, fileName):
+        data = {"format": self.formatName, "version": self.formatVersion, "projectId": self.projectId, "createTime": self.createTime,
+                "secrets": self.secrets, "versions": self.versions, "keys": self.keys, "updates": self.updates}
+        # Write to a temporary file first so a failed export doesn't replace a good snapshot
+        tmpName = f"{fileName}.tmp"
+        with gzip.open(tmpName, "wt", encoding="utf-8") as file:
+            json.dump(data, file, separators=(",", ":"))
+        os.replace(tmpName, fileName)
+    # Load a snapshot from a file
+    # Arg:
+    #   fileName [str] - name of the snapshot file
+    # Returns:
+    #   snapshot [obj] - loaded snapshot (raises ValueError if the file isn't a snapshot this version can read)
+    @classmethod
+    def load(cls, fileName):
+        with gzip.open(fileName, "rt", encoding="utf-8") as file:
+            data = json.load(file)
+        if data.get("format") != cls.formatName:
+            raise ValueError(f"{fileName} is not a credential-manager snapshot")
+        if data.get("version") != cls.formatVersion:
+            raise ValueError(f"{fileName} is snapshot version {data.get('version')} (expected {cls.formatVersion})")
+        return cls(data["projectId"], data["secrets"], data["versions"], data["keys"], data["createTime"], data.get("updates"))
+    # Get the time of the last change applied to the snapshot
+    # Returns:
+    #   updateTime [str] - publish time of the newest change event applied (None if no events were applied)
+    def update_time(self):
+        return max(self.updates.values()) if self.updates else None
+    # Add or replace a secret (e.g. from a change event)
+    # Arg:
+    #   secret [dict] - secret details
+    def put_secret(self, secret):
+        secretName = secret.get("name").split("/")[-1]
+        if secretName in self.secretsByName:
+            self.secrets[self.secrets.index(self.secretsByName[secretName])] = secret
+        else:
+            self.secrets.append(secret)
+            self.versions.setdefault(secretName, [])
+        self.secretsByName[secretName] = secret
+        self.keyIndex = None
+    # Remove a secret and its versions
+    # Arg:
+    #   secretName [str] - name of secret
+    def remove_secret(self, secretName):
+        secret = self.secretsByName.pop(secretName, None)
+        if secret is not None:
+            self.secrets.remove(secret)
+        self.versions.pop(secretName, None)
+        self.keyIndex = None
+    # Add or replace a version of a secret (versions are kept newest first)
+    # Arg:
+    #   secretName [str] - name of secret
+    #   version [dict] - version details (the payload is never kept)
+    def put_version(self, secretName, version):
+        version = {field: value for field, value in version.items() if field != "payload"}
+        number = version.get("name").split("/")[-1]
+        versions = [existing for existing in self.versions.get(secretName, []) if existing.get("name").split("/")[-1] != number]
+        versions.append(version)
+        self.versions[secretName] = sorted(versions, key=lambda existing: int(existing.get("name").split("/")[-1]), reverse=True)
+    # Look up the secrets for key uids (the index is built on the first lookup)
+    # Arg:
+    #   keyIds [list of str] - key uids to search for
+    # Returns:
+    #   matches [dict] - key uid -> (secret name, version, is current key)
+    def lookup(self, keyIds):
+        if self.keyIndex is None:
+            self.keyIndex = {}
+            for secretName, secret in self.secretsByName.items():
+                # Annotations map version number -> key uid
+                versions = {version: keyId for version, keyId in (secret.get("annotations") or {}).items() if version.isdigit()}
+                currentVersion = max(versions, key=int) if versions else None
+                for version, keyId in versions.items():
+                    self.keyIndex[keyId] = (secretName, version, version == currentVersion)
+        return {keyId: self.keyIndex[keyId] for keyId in keyIds if keyId in self.keyIndex}
+
+# Compare two snapshots of a project
+# Arg:
+#   old [obj] - earlier snapshot
+#   new [obj] - later snapshot
+# Returns:
+#   changes [dict] - added/removed/changed secret names and key uids (changed secrets list what changed)
+def diff_snapshots(old, new):
+    # Get the state of each version of a secret
+    def version_states(snapshot, secretName):
+        return {version.get("name").split("/")[-1]: version.get("state") for version in snapshot.versions.get(secretName, [])}
+    # Get the parts of a key that matter for a comparison
+    def key_config(key):
+        return {"displayName": key.get("displayName"), "restrictions": key.get("restrictions")}
+    changes = {"secrets": {"added": [], "removed": [], "changed": {}}, "keys": {"added": [], "removed": [], "changed": []}}
+    for secretName in sorted(set(old.secretsByName) | set(new.secretsByName)):
+        oldSecret = old.secretsByName.get(secretName)
+        newSecret = new.secretsByName.get(secretName)
+        if not oldSecret:
+            changes["secrets"]["added"].append(secretName)
+        elif not newSecret:
+            changes["secrets"]["removed"].append(secretName)
+        else:
+            changed = []
+            if (oldSecret.get("annotations") or {}) != (newSecret.get("annotations") or {}):
+                changed.append("annotations")
+            if (oldSecret.get("labels") or {}) != (newSecret.get("labels") or {}):
+                changed.append("labels")
+            if version_states(old, secretName) != version_states(new, secretName):
+                changed.append("versions")
+            if changed:
+                changes["secrets"]["changed"][secretName] = changed
+    oldKeys = {key.get("uid"): key for key in old.keys}
+    newKeys = {key.get("uid"): key for key in new.keys}
+    for keyId in sorted(set(oldKeys) | set(newKeys)):
+        if keyId not in oldKeys:
+            changes["keys"]["added"].append(keyId)
+        elif keyId not in newKeys:
+            changes["keys"]["removed"].append(keyId)
+        elif key_config(oldKeys[keyId]) != key_config(newKeys[keyId]):
+            changes["keys"]["changed"].append(keyId)
+    return changes
+
+# Class to serve the read-only backend calls from a snapshot (write calls raise GCPError)
+# It can be passed to KeyManager/SecretManager in place of a live backend, so audits run fully offline.
+class SnapshotBackend:
+    # Init Arg:
+    #   snapshot [obj] - loaded snapshot
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.projectId = snapshot.projectId
+    # Raise for calls that would change the project or read a payload
+    def read_only(self, *args, **kwargs):
+        raise GCPError("not available when running from a snapshot", "FAILED_PRECONDITION")
+    enable_version = disable_version = destroy_version = update_annotations = remove_annotations = add_version = read_only
+    get_key_string = create_key = create_key_async = get_operation = delete_key = read_only
+    # Same operations as GCP (see api_key_rotation.py for args/returns)
+    def list_secrets(self, limit=None, createdAfter=None):
+        secrets = sorted(self.iter_secrets(createdAfter=createdAfter), key=lambda secret: secret.get("createTime", ""), reverse=True)
+        return secrets[:limit] if limit else secrets
+    def iter_secrets(self, pageSize=None, createdAfter=None):
+        return (secret for secret in self.snapshot.secrets if not createdAfter or secret.get("createTime", "") > createdAfter)
+    def describe_secret(self, secretName):
+        secret = self.snapshot.secretsByName.get(secretName)
+        if secret is None:
+            raise GCPError(f"Secret [{secretName}] not found in snapshot", "NOT_FOUND")
+        return secret
+    def list_versions(self, secretName, limit=None, enabled=False):
+        self.describe_secret(secretName)
+        versions = [version for version in self.snapshot.versions.get(secretName, []) if not enabled or version.get("state") == "ENABLED"]
+        return versions[:limit] if limit else versions
+    def iter_versions(self, secretName, pageSize=None, enabled=False):
+        return iter(self.list_versions(secretName, enabled=enabled))
+    def list_keys(self, limit=None):
+        keys = sorted(self.snapshot.keys, key=lambda key: key.get("createTime", ""), reverse=True)
+        return keys[:limit] if limit else keys
+    def describe_key(self, keyId):
+        key = self.snapshot.keysById.get(keyId)
+        if key is None:
+            raise GCPError(f"Key [{keyId}] not found in snapshot", "NOT_FOUND")
+        return key
+
+# Load a snapshot and check it is for the expected project
+# Arg:
+#   fileName [str] - name of the snapshot file
+#   projectId [str] *opt - expected project (default=None, any project)
+# Returns:
+#   gcp [obj] - snapshot backend
+def snapshot_backend(fileName, projectId=None):
+    snapshot = Snapshot.load(fileName)
+    if projectId and snapshot.projectId != projectId:
+        raise ValueError(f"{fileName} is a snapshot of {snapshot.projectId}, not {projectId}")
+    updateTime = snapshot.update_time()
+    print(f"Using snapshot of {snapshot.projectId} taken {snapshot.createTime}" + (f" (changes applied up to {updateTime})" if updateTime else ""))
+    return SnapshotBackend(snapshot)
+
+# Arg:
+#   projectId [str] - name of GCP project
+#   fileName [str] - name of the snapshot file
+#   backend [str] *opt - backend for GCP calls, "gcloud" or "rest" (default=gcloud)
+#   maxWorkers [int] *opt - max number of secrets to fetch versions for at the same time (default=8)
+#   pageSize [int] *opt - number of secrets fetched per page (default=None)
+def export(projectId, fileName, backend="gcloud", maxWorkers=8, pageSize=None):
+    gcp = get_backend(projectId, backend)
+    snapshot = Snapshot.capture(gcp, maxWorkers, pageSize)
+    snapshot.save(fileName)
+    print(f"Snapshot of {projectId} saved to {fileName}: {len(snapshot.secrets)} secret(s), "
+          f"{sum(len(versions) for versions in snapshot.versions.values())} version(s), {len(snapshot.keys)} key(s)")
+
+# Arg:
+#   oldFile [str] - name of the earlier snapshot file
+#   newFile [str] - name of the later snapshot file
+def diff(oldFile, newFile):
+    old = Snapshot.load(oldFile)
+    new = Snapshot.load(newFile)
+    if old.projectId != new.projectId:
+        print(f"Warning: comparing snapshots of different projects ({old.projectId}, {new.projectId})")
+    changes = diff_snapshots(old, new)
+    print(f"Changes from {old.createTime} to {new.createTime}:")
+    for secretName in changes["secrets"]["added"]:
+        print(f"  + secret {secretName}")
+    for secretName in changes["secrets"]["removed"]:
+        print(f"  - secret {secretName}")
+    for secretName, changed in changes["secrets"]["changed"].items():
+        print(f"  ~ secret {secretName} ({', '.join(changed)})")
+    for keyId in changes["keys"]["added"]:
+        print(f"  + key {keyId}")
+    for keyId in changes["keys"]["removed"]:
+        print(f"  - key {keyId}")
+    for keyId in changes["keys"]["changed"]:
+        print(f"  ~ key {keyId}")
+    if not any(changes["secrets"].values()) and not any(changes["keys"].values()):
+        print("  no changes")
+
+if __name__ == "__main__":
+    # Create an ArgumentParser object
+    parser = argparse.ArgumentParser(description="Use this script to take an offline snapshot of a project's secret metadata and api key configs, or compare two snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+    # Create arguments
+    exportParser = commands.add_parser("export", help="Save a snapshot of a project")
+    exportParser.add_argument("projectId", type=str, help="Google Cloud Project Id")
+    exportParser.add_argument("--fileName", dest="fileName", type=str, help="Name of the snapshot file (\"<projectId>-snapshot.json.gz\" if not specified)")
+    exportParser.add_argument("--backend", dest="backend", type=str, default="gcloud", choices=BACKENDS, help="Backend for GCP calls (default='gcloud')")
+    exportParser.add_argument("--maxWorkers", dest="maxWorkers", type=int, default=8, help="Max number of secrets to fetch versions for at the same time (default=8)")
+    exportParser.add_argument("--pageSize", dest="pageSize", type=int, help="Number of secrets fetched per page")
+    diffParser = commands.add_parser("diff", help="Show what changed between two snapshots")
+    diffParser.add_argument("oldFile", type=str, help="Earlier snapshot file")
+    diffParser.add_argument("newFile", type=str, help="Later snapshot file")
+    # Parse the command-line arguments
+    args = parser.parse_args(sys.argv[1:])
+    # Pass arguments to the main functions
+    if args.command == "export":
+        export(args.projectId, args.fileName or f"{args.projectId}-snapshot.json.gz", args.backend, args.maxWorkers, args.pageSize)
+    else:
+        diff(args.oldFile, args.newFile)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The scripts are run from the repo root and import each other by name, and the fake cloud lives in benchmarks
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (REPO_DIR, os.path.join(REPO_DIR, "benchmarks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,40 @@
+import time
+import random
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from api_key_rotation import bounded_map
+
+class BoundedMapTest(unittest.TestCase):
+    def test_results_come_back_in_item_order(self):
+        def slow_double(item):
+            time.sleep(random.uniform(0, 0.01))
+            return item * 2
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            self.assertEqual(list(bounded_map(executor, slow_double, range(50), 8)), [item * 2 for item in range(50)])
+    def test_items_are_taken_a_window_at_a_time(self):
+        taken = []
+        def items():
+            for item in range(100):
+                taken.append(item)
+                yield item
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = bounded_map(executor, lambda item: item, items(), 4)
+            self.assertEqual(next(results), 0)
+            # The window, and the item that was waiting for room in it
+            self.assertEqual(len(taken), 5)
+            self.assertEqual(next(results), 1)
+            self.assertEqual(len(taken), 6)
+            self.assertEqual(list(results), list(range(2, 100)))
+    def test_errors_are_raised_in_order(self):
+        def fail_on_three(item):
+            if item == 3:
+                raise ValueError(item)
+            return item
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = bounded_map(executor, fail_on_three, range(10), 4)
+            self.assertEqual([next(results) for _ in range(3)], [0, 1, 2])
+            with self.assertRaises(ValueError):
+                next(results)
+
+if __name__ == "__main__":
+    unittest.main()
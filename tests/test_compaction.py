@@ -0,0 +1,37 @@
+import unittest
+from datetime import datetime, timezone, timedelta
+from secret_compaction import plan_compaction
+
+NOW = datetime(2026, 1, 31, tzinfo=timezone.utc)
+
+# Build a version as the listing returns it
+def version(number, state, daysAgo):
+    return {"name": f"projects/p/secrets/s/versions/{number}", "state": state,
+            "createTime": (NOW - timedelta(days=daysAgo)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+
+class PlanCompactionTest(unittest.TestCase):
+    def targets(self, actions, action):
+        return [entry["target"] for entry in actions if entry["action"] == action]
+    def test_keeps_the_most_recent_annotations(self):
+        annotations = {str(number): f"key-{number}" for number in range(1, 7)}
+        annotations.update(type="api_key", notification="owner@example.com")
+        versions = [version(6, "ENABLED", 1)] + [version(number, "DISABLED", 1) for number in range(5, 0, -1)]
+        actions = plan_compaction("s", annotations, versions, 2, 30, NOW)
+        self.assertEqual(self.targets(actions, "remove annotation"), ["4", "3", "2", "1"])
+        self.assertTrue(all(entry["secretName"] == "s" for entry in actions))
+    def test_never_removes_the_annotation_of_an_enabled_version(self):
+        annotations = {"1": "key-1", "2": "key-2", "3": "key-3"}
+        versions = [version(3, "ENABLED", 1), version(2, "DISABLED", 2), version(1, "ENABLED", 3)]
+        actions = plan_compaction("s", annotations, versions, 1, 30, NOW)
+        self.assertEqual(self.targets(actions, "remove annotation"), ["2"])
+    def test_destroys_versions_replaced_before_the_retention_window(self):
+        # Version 2 was replaced 10 days ago and version 1 was replaced 40 days ago
+        versions = [version(3, "ENABLED", 10), version(2, "DISABLED", 40), version(1, "DISABLED", 100)]
+        actions = plan_compaction("s", {}, versions, 5, 30, NOW)
+        self.assertEqual(self.targets(actions, "destroy version"), ["1"])
+    def test_leaves_enabled_and_latest_versions(self):
+        versions = [version(3, "DISABLED", 100), version(2, "ENABLED", 200), version(1, "DESTROYED", 300)]
+        self.assertEqual(plan_compaction("s", {}, versions, 5, 30, NOW), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import json
+import base64
+import tempfile
+import unittest
+from datetime import datetime, timezone, timedelta
+from secret_snapshot import Snapshot
+from secret_events import EventInventory, FileSource, read_event
+
+# The inventory was taken an hour ago, so it isn't due a reconcile
+START = datetime.now(timezone.utc) - timedelta(hours=1)
+
+# Class to stand in for the backend (events are applied without any calls)
+class OfflineBackend:
+    projectId = "p"
+
+# Build a received Pub/Sub message for a change event
+# Arg:
+#   eventType [str] - event type (e.g. SECRET_UPDATE)
+#   resource [str] - secret name, or secret/versions/number for a version event
+#   data [dict] - the secret or version after the change
+#   minutes [int] - publish time, in minutes after the inventory was taken
+def message(eventType, resource, data, minutes):
+    attribute = "versionId" if "/versions/" in resource else "secretId"
+    return {"ackId": f"{eventType}-{resource}-{minutes}",
+            "message": {"attributes": {"eventType": eventType, attribute: f"projects/123/secrets/{resource}"},
+                        "data": base64.b64encode(json.dumps(data).encode()).decode(),
+                        "publishTime": (START + timedelta(minutes=minutes)).isoformat()}}
+
+def secret(name, **annotations):
+    return {"name": f"projects/123/secrets/{name}", "annotations": annotations}
+
+class EventInventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.fileName = os.path.join(self.tmp.name, "inventory.json.gz")
+        self.inventory = EventInventory(OfflineBackend(), self.fileName)
+        self.inventory.snapshot = Snapshot("p", [secret("s1", type="api_key")], {"s1": [{"name": "projects/123/secrets/s1/versions/1", "state": "ENABLED"}]},
+                                           [], createTime=START.isoformat())
+    def apply(self, *args):
+        return self.inventory.apply(read_event(message(*args)))
+    def test_applies_secret_events(self):
+        self.assertTrue(self.apply("SECRET_CREATE", "s2", secret("s2"), 1))
+        self.assertTrue(self.apply("SECRET_UPDATE", "s1", secret("s1", type="api_key", notification="owner"), 2))
+        self.assertEqual(self.inventory.snapshot.secretsByName["s1"]["annotations"]["notification"], "owner")
+        self.assertTrue(self.apply("SECRET_DELETE", "s2", {}, 3))
+        self.assertEqual(set(self.inventory.snapshot.secretsByName), {"s1"})
+    def test_applies_version_events(self):
+        self.assertTrue(self.apply("SECRET_VERSION_ADD", "s1/versions/2", {"name": "projects/123/secrets/s1/versions/2", "state": "ENABLED", "payload": {"data": "c2VjcmV0"}}, 1))
+        self.assertTrue(self.apply("SECRET_VERSION_DISABLE", "s1/versions/1", {"name": "projects/123/secrets/s1/versions/1", "state": "DISABLED"}, 2))
+        versions = self.inventory.snapshot.versions["s1"]
+        self.assertEqual([(version["name"].split("/")[-1], version["state"]) for version in versions], [("2", "ENABLED"), ("1", "DISABLED")])
+        # Payloads are never kept
+        self.assertNotIn("payload", versions[0])
+    def test_skips_late_duplicate_and_out_of_order_events(self):
+        # Published before the inventory was taken
+        self.assertFalse(self.apply("SECRET_UPDATE", "s1", secret("s1", stale="yes"), -5))
+        self.assertTrue(self.apply("SECRET_UPDATE", "s1", secret("s1", newest="yes"), 10))
+        self.assertFalse(self.apply("SECRET_UPDATE", "s1", secret("s1", newest="yes"), 10))
+        self.assertFalse(self.apply("SECRET_UPDATE", "s1", secret("s1", older="yes"), 5))
+        self.assertEqual(self.inventory.snapshot.secretsByName["s1"]["annotations"], {"newest": "yes"})
+    def test_skips_other_event_types(self):
+        self.assertFalse(self.apply("SECRET_ROTATE", "s1", secret("s1", rotated="yes"), 1))
+        self.assertNotIn("rotated", self.inventory.snapshot.secretsByName["s1"]["annotations"])
+    def test_sync_saves_before_acknowledging(self):
+        eventsName = os.path.join(self.tmp.name, "events.jsonl")
+        with open(eventsName, "w") as file:
+            for minutes in range(1, 6):
+                file.write(json.dumps(message("SECRET_CREATE", f"new{minutes}", secret(f"new{minutes}"), minutes)) + "\n")
+        source = FileSource(eventsName)
+        counts = self.inventory.sync(source, maxMessages=2)
+        self.assertEqual(counts, {"received": 5, "applied": 5, "reconciled": False})
+        self.assertEqual(source.offset, 5)
+        self.assertEqual(len(Snapshot.load(self.fileName).secrets), 6)
+        # Nothing is left to pull
+        self.assertEqual(self.inventory.sync(FileSource(eventsName))["received"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import json
+import tempfile
+import unittest
+from api_key_rotation import RotationJournal, JournalInUse
+
+class RotationJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dir = self.tmp.name
+    # Record a rotation up to (and including) the given number of steps
+    def rotate(self, journal, secretName, steps):
+        data = {"key requested": {"oldVersion": "3", "oldKeyId": "old-key", "keyName": f"{secretName}-key"},
+                "key created": {"newKeyId": "new-key"}, "version added": {"newVersion": "4"}}
+        for step in RotationJournal.steps[:steps]:
+            journal.record(secretName, step, **data.get(step, {}))
+    def test_replays_unfinished_rotations(self):
+        journal = RotationJournal("p", self.dir)
+        self.rotate(journal, "done", len(RotationJournal.steps))
+        self.rotate(journal, "partway", 3)
+        self.rotate(journal, "requested", 1)
+        journal.close()
+        journal = RotationJournal("p", self.dir)
+        self.addCleanup(journal.close)
+        rotations = {rotation["secretName"]: rotation for rotation in journal.incomplete()}
+        self.assertEqual(set(rotations), {"partway", "requested"})
+        self.assertEqual(rotations["partway"]["steps"], ["key requested", "key created", "version added"])
+        self.assertEqual((rotations["partway"]["oldKeyId"], rotations["partway"]["newKeyId"], rotations["partway"]["newVersion"]), ("old-key", "new-key", "4"))
+        self.assertEqual(rotations["requested"]["keyName"], "requested-key")
+        self.assertTrue(journal.is_incomplete("partway"))
+        self.assertFalse(journal.is_incomplete("done"))
+        self.assertFalse(journal.is_incomplete("never-started"))
+    def test_finishing_or_abandoning_a_rotation_clears_it(self):
+        journal = RotationJournal("p", self.dir)
+        self.addCleanup(journal.close)
+        self.rotate(journal, "s1", 2)
+        self.rotate(journal, "s2", 2)
+        self.assertTrue(journal.is_incomplete("s1"))
+        journal.record("s1", "abandoned")
+        journal.record("s2", "old key deleted")
+        self.assertEqual(journal.incomplete(), [])
+    def test_reopening_compacts_the_journal(self):
+        journal = RotationJournal("p", self.dir)
+        self.rotate(journal, "done", len(RotationJournal.steps))
+        self.rotate(journal, "partway", 2)
+        journal.close()
+        journal = RotationJournal("p", self.dir)
+        journal.close()
+        with open(journal.path) as file:
+            entries = [json.loads(line) for line in file]
+        self.assertEqual([(entry["secretName"], entry["step"]) for entry in entries], [("partway", "key requested"), ("partway", "key created")])
+        # The replay survives the rewrite
+        journal = RotationJournal("p", self.dir)
+        self.addCleanup(journal.close)
+        self.assertEqual(journal.incomplete()[0]["newKeyId"], "new-key")
+    def test_ignores_a_cut_off_last_line(self):
+        journal = RotationJournal("p", self.dir)
+        self.rotate(journal, "partway", 2)
+        journal.close()
+        with open(os.path.join(self.dir, "p-journal.jsonl"), "a") as file:
+            file.write('{"secretName": "partway", "step": "vers')
+        journal = RotationJournal("p", self.dir)
+        self.addCleanup(journal.close)
+        self.assertEqual(journal.incomplete()[0]["steps"], ["key requested", "key created"])
+    def test_only_one_worker_can_use_a_journal(self):
+        journal = RotationJournal("p", self.dir)
+        with self.assertRaises(JournalInUse):
+            RotationJournal("p", self.dir)
+        journal.close()
+        RotationJournal("p", self.dir).close()
+
+if __name__ == "__main__":
+    unittest.main()
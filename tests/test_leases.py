@@ -0,0 +1,52 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+from api_key_rotation import LeaseStore
+
+class LeaseStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.first = LeaseStore("p", self.tmp.name, leaseSeconds=60, owner="first")
+        self.second = LeaseStore("p", self.tmp.name, leaseSeconds=60, owner="second")
+    def owner(self, secretName):
+        with open(self.first.path(secretName)) as file:
+            return json.load(file)["owner"]
+    def test_a_live_lease_is_not_taken(self):
+        self.assertTrue(self.first.acquire("s1"))
+        self.assertFalse(self.second.acquire("s1"))
+        self.assertEqual(self.owner("s1"), "first")
+        self.first.release("s1")
+        self.assertTrue(self.second.acquire("s1"))
+        self.assertEqual(self.owner("s1"), "second")
+    def test_an_expired_lease_is_taken_over(self):
+        with open(self.first.path("s1"), "w") as file:
+            json.dump({"owner": "dead", "expires": time.time() - 1}, file)
+        self.assertTrue(self.second.acquire("s1"))
+        self.assertEqual(self.owner("s1"), "second")
+        self.assertEqual(self.second.held, {"s1"})
+        # No stale copies are left behind
+        self.assertEqual(os.listdir(self.first.dir), ["s1.lease"])
+    def test_a_new_unreadable_lease_is_not_taken(self):
+        # e.g. a worker that has created the file but not written it yet
+        open(self.first.path("s1"), "w").close()
+        self.assertFalse(self.second.acquire("s1"))
+    def test_an_old_unreadable_lease_expires(self):
+        path = self.first.path("s1")
+        with open(path, "w") as file:
+            file.write("{not json")
+        old = time.time() - 61
+        os.utime(path, (old, old))
+        self.assertTrue(self.second.acquire("s1"))
+        self.assertEqual(self.owner("s1"), "second")
+    def test_renew_drops_a_lease_taken_by_another_worker(self):
+        self.assertTrue(self.first.acquire("s1"))
+        self.second.write(self.first.path("s1"))
+        self.first.renew()
+        self.assertEqual(self.first.held, set())
+        self.assertEqual(self.owner("s1"), "second")
+
+if __name__ == "__main__":
+    unittest.main()
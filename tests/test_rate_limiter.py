@@ -0,0 +1,71 @@
+import time
+import unittest
+from api_key_rotation import RateLimiter, GCPError, SESError
+
+# Class to make a call that fails with the given errors before it succeeds
+class FlakyCall:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+class RateLimiterTest(unittest.TestCase):
+    def limiter(self, rate=1000):
+        limiter = RateLimiter("test", rate)
+        limiter.baseDelay = 0
+        return limiter
+    def test_retries_retryable_errors(self):
+        limiter = self.limiter()
+        call = FlakyCall([GCPError("unavailable", 503), GCPError("internal", "INTERNAL")])
+        self.assertEqual(limiter.call(call), "ok")
+        self.assertEqual(call.calls, 3)
+        self.assertEqual(limiter.state()["retries"], 2)
+        self.assertEqual(limiter.state()["failures"], 0)
+    def test_raises_other_errors_at_once(self):
+        limiter = self.limiter()
+        call = FlakyCall([GCPError("missing", "NOT_FOUND")])
+        with self.assertRaises(GCPError):
+            limiter.call(call)
+        self.assertEqual(call.calls, 1)
+        self.assertEqual(limiter.state()["failures"], 1)
+    def test_gives_up_after_the_last_attempt(self):
+        limiter = self.limiter()
+        call = FlakyCall([GCPError("unavailable", 503)] * 10)
+        with self.assertRaises(GCPError):
+            limiter.call(call)
+        self.assertEqual(call.calls, RateLimiter.attempts)
+    def test_throttling_halves_the_rate(self):
+        limiter = self.limiter(rate=100)
+        limiter.call(FlakyCall([GCPError("quota", 429)]))
+        state = limiter.state()
+        self.assertEqual(state["throttles"], 1)
+        # Halved to 50, then one success
+        self.assertAlmostEqual(state["rate"], 50 + 1 / 50, places=3)
+    def test_retries_ses_errors(self):
+        limiter = self.limiter()
+        call = FlakyCall([SESError("Throttling", 429)])
+        self.assertEqual(limiter.call(call), "ok")
+        self.assertEqual(limiter.state()["throttles"], 1)
+    def test_rate_grows_up_to_max_rate(self):
+        limiter = self.limiter(rate=1000)
+        for _ in range(50):
+            limiter.succeeded()
+        self.assertGreater(limiter.rate, 1000)
+        limiter.configure(2, maxRate=3)
+        for _ in range(50):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, 3)
+    def test_waits_once_the_burst_is_used(self):
+        limiter = self.limiter(rate=20)
+        start = time.monotonic()
+        # 20 calls go through on the burst, the next 10 at 20 calls per second
+        for _ in range(30):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+if __name__ == "__main__":
+    unittest.main()
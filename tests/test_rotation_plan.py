@@ -0,0 +1,121 @@
+import os
+import math
+import tempfile
+import unittest
+from unittest import mock
+import api_key_rotation
+from api_key_rotation import SecretManager, KeyManager, RotationJournal, GCPRest, get_backend, set_rate_limits
+from rotation_plan import RotationPlan, STAGES, limited_seconds, build_plan, apply_plan
+
+# Starting rates high enough that the limiters never hold the tests up
+FAST_RATES = {"secrets.read": 1e6, "secrets.write": 1e6, "api-keys": 1e6}
+
+def planned(count):
+    return [{"secretName": f"s{index}"} for index in range(count)]
+
+class EstimateCostTest(unittest.TestCase):
+    def test_counts_the_calls_of_each_stage(self):
+        plan = RotationPlan("p", 30, planned(30), [], 95, 40)
+        estimate = plan.estimate_cost(10, 25, 1.0, FAST_RATES, pageSize=10)
+        self.assertEqual(estimate["batches"], 2)
+        self.assertEqual(estimate["stages"][0], {"stage": "check plan", "operation": "secrets.list", "calls": 10, "seconds": 10.0})
+        self.assertEqual([(stage["operation"], stage["calls"]) for stage in estimate["stages"][1:]], [(operation, 30) for stage, operation, family in STAGES])
+        self.assertEqual(estimate["calls"], 10 + 30 * len(STAGES))
+    def test_workers_bound_the_runtime_when_the_rates_do_not(self):
+        plan = RotationPlan("p", 30, planned(30), [], 95, 40)
+        estimate = plan.estimate_cost(10, 25, 1.0, FAST_RATES)
+        # Batches of 25 and 5 take 3 and 1 rounds of calls per stage (plus the wait before polling key creations), after one listing
+        self.assertEqual(estimate["seconds"], 1 + 4 * len(STAGES) + 0.5)
+    def test_rates_bound_the_runtime_when_calls_are_fast(self):
+        plan = RotationPlan("p", 30, planned(100), [], 100, 100)
+        rates = {"secrets.read": 10, "secrets.write": 10, "api-keys": 5}
+        estimate = plan.estimate_cost(100, 100, 0.001, rates)
+        writes = [stage for stage in estimate["stages"] if stage["operation"] == "versions.add"][0]
+        self.assertEqual(writes["seconds"], round(limited_seconds(10, 0, 100), 1))
+        self.assertGreater(estimate["seconds"], 10)
+    def test_an_empty_plan_only_lists(self):
+        estimate = RotationPlan("p", 30, [], [], 5, 0).estimate_cost(8, 100, 0.5, FAST_RATES)
+        self.assertEqual((estimate["calls"], estimate["batches"]), (1, 0))
+
+class LimitedSecondsTest(unittest.TestCase):
+    def test_matches_the_limiter_speeding_up(self):
+        # After k calls the rate is about sqrt(rate^2 + 2k)
+        self.assertAlmostEqual(limited_seconds(10, 0, 100), math.sqrt(300) - 10)
+        self.assertAlmostEqual(limited_seconds(10, 0, 100), limited_seconds(10, 0, 40) + limited_seconds(10, 40, 60))
+    def test_stops_speeding_up_at_the_max_rate(self):
+        capped = (100 ** 2 - 10 ** 2) / 2
+        self.assertAlmostEqual(limited_seconds(10, capped, 1000), 1000 / 100)
+
+# Apply plans against the local stand-in for GCP (benchmarks/fake_cloud.py) through the REST backend
+class ApplyPlanTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from bench import FakeServer, BENCH_DIR
+        cls.server = FakeServer()
+        cls.addClassCleanup(cls.server.stop)
+        # The REST backend reads its endpoints when it is imported, and takes its token from the fake gcloud
+        for attribute, path in (("secretsUrl", "/v1"), ("keysUrl", "/v2"), ("pubsubUrl", "/v1")):
+            patcher = mock.patch.object(GCPRest, attribute, cls.server.url + path)
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        environ = mock.patch.dict(os.environ, {"FAKE_GCP_URL": cls.server.url, "PATH": os.path.join(BENCH_DIR, "bin") + os.pathsep + os.environ["PATH"]})
+        environ.start()
+        cls.addClassCleanup(environ.stop)
+        set_rate_limits(FAST_RATES)
+    def setUp(self):
+        self.server.seed("p", 30)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+    def managers(self):
+        gcp = get_backend("p", "rest")
+        kMan = KeyManager("p", backend=gcp)
+        return SecretManager("p", kMan, backend=gcp), kMan
+    def plan(self):
+        sMan, kMan = self.managers()
+        plan = build_plan(sMan, kMan, 30)
+        self.assertGreater(len(plan.rotations), 2)
+        return plan
+    def test_rotates_every_planned_secret(self):
+        plan = self.plan()
+        sMan, kMan = self.managers()
+        counts, failures = apply_plan(sMan, kMan, plan, batchSize=4)
+        self.assertEqual(counts, {"planned": len(plan.rotations), "stale": 0, "unfinished": 0, "rotated": len(plan.rotations), "failed": 0})
+        self.assertEqual(failures, [])
+        self.assertEqual({record.secretName for record in sMan.rotatedSecrets}, {rotation["secretName"] for rotation in plan.rotations})
+    def test_skips_secrets_that_changed_or_have_unfinished_rotations(self):
+        plan = self.plan()
+        changed, unfinished = plan.rotations[0]["secretName"], plan.rotations[1]["secretName"]
+        # Changing the secret's annotations changes its etag
+        sMan, kMan = self.managers()
+        sMan.add_annotation(changed, "99", "another-key")
+        journal = RotationJournal("p", self.tmp.name)
+        self.addCleanup(journal.close)
+        journal.record(unfinished, "key requested", oldVersion="1", oldKeyId="old-key", keyName="key")
+        sMan, kMan = self.managers()
+        counts, failures = apply_plan(sMan, kMan, plan, journal=journal)
+        self.assertEqual((counts["stale"], counts["unfinished"], counts["rotated"], counts["failed"]), (1, 1, len(plan.rotations) - 2, 0))
+        self.assertNotIn(changed, {record.secretName for record in sMan.rotatedSecrets})
+        self.assertNotIn(unfinished, {record.secretName for record in sMan.rotatedSecrets})
+        # Applying the same plan again (without the journal) only finds the secret that was held back unchanged
+        sMan, kMan = self.managers()
+        counts, failures = apply_plan(sMan, kMan, plan)
+        self.assertEqual((counts["stale"], counts["rotated"]), (len(plan.rotations) - 1, 1))
+        self.assertEqual([record.secretName for record in sMan.rotatedSecrets], [unfinished])
+    def test_reports_where_a_rotation_stopped(self):
+        plan = self.plan()
+        broken = plan.rotations[0]["secretName"]
+        sMan, kMan = self.managers()
+        addVersion = sMan.add_version
+        def add_version(secretName, payload):
+            if secretName == broken:
+                raise api_key_rotation.GCPError("denied", "PERMISSION_DENIED")
+            return addVersion(secretName, payload)
+        sMan.add_version = add_version
+        counts, failures = apply_plan(sMan, kMan, plan)
+        self.assertEqual(counts["failed"], 1)
+        self.assertEqual([(failure["secretName"], failure["stage"]) for failure in failures], [(broken, "add versions")])
+        # Its new key was created but never stored
+        self.assertTrue(failures[0]["unstoredKeyId"])
+
+if __name__ == "__main__":
+    unittest.main()
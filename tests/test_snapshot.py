@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+from secret_snapshot import Snapshot, diff_snapshots
+
+# Build a snapshot of project p from secret name -> (annotations, version states newest first) and key uid -> display name
+def snapshot(secrets, keys):
+    return Snapshot("p", [{"name": f"projects/p/secrets/{name}", "annotations": annotations} for name, (annotations, states) in secrets.items()],
+                    {name: [{"name": f"projects/p/secrets/{name}/versions/{len(states) - index}", "state": state} for index, state in enumerate(states)]
+                     for name, (annotations, states) in secrets.items()},
+                    [{"name": f"projects/p/locations/global/keys/{uid}", "uid": uid, "displayName": displayName} for uid, displayName in keys.items()])
+
+class DiffSnapshotsTest(unittest.TestCase):
+    def test_no_changes(self):
+        old = snapshot({"s1": ({"1": "k1"}, ["ENABLED"])}, {"k1": "s1-key"})
+        new = snapshot({"s1": ({"1": "k1"}, ["ENABLED"])}, {"k1": "s1-key"})
+        self.assertEqual(diff_snapshots(old, new), {"secrets": {"added": [], "removed": [], "changed": {}}, "keys": {"added": [], "removed": [], "changed": []}})
+    def test_added_removed_and_changed(self):
+        old = snapshot({"kept": ({"1": "k1"}, ["ENABLED"]), "rotated": ({"1": "k2"}, ["ENABLED"]), "gone": ({}, ["ENABLED"])},
+                       {"k1": "kept-key", "k2": "rotated-key", "k3": "renamed"})
+        new = snapshot({"kept": ({"1": "k1"}, ["ENABLED"]), "rotated": ({"1": "k2", "2": "k4"}, ["ENABLED", "DISABLED"]), "new": ({}, ["ENABLED"])},
+                       {"k1": "kept-key", "k3": "renamed again", "k4": "rotated-key"})
+        changes = diff_snapshots(old, new)
+        self.assertEqual(changes["secrets"], {"added": ["new"], "removed": ["gone"], "changed": {"rotated": ["annotations", "versions"]}})
+        self.assertEqual(changes["keys"], {"added": ["k4"], "removed": ["k2"], "changed": ["k3"]})
+    def test_a_saved_snapshot_diffs_clean_against_itself(self):
+        old = snapshot({"s1": ({"1": "k1"}, ["ENABLED", "DISABLED"])}, {"k1": "s1-key"})
+        with tempfile.TemporaryDirectory() as tmp:
+            fileName = os.path.join(tmp, "p.json.gz")
+            old.save(fileName)
+            new = Snapshot.load(fileName)
+        changes = diff_snapshots(old, new)
+        self.assertEqual((changes["secrets"]["changed"], changes["keys"]["changed"]), ({}, []))
+
+if __name__ == "__main__":
+    unittest.main()